@@ -4,5 +4,15 @@ from .fs import (
     Directory,
     RootDirectory,
     CachedRootDirectory,
+    NameIndex,
+    MetadataDict,
+    MetadataIndex,
+    QueryNode,
+    QueryCompare,
+    QueryAnd,
+    QueryOr,
+    QueryNot,
+    QuerySyntaxError,
+    parseQuery,
     mkRootDirectoryBaseClass,
 )
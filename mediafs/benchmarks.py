@@ -0,0 +1,742 @@
+"""
+MediaFS: A pure-Python filesystem caching system for easy searching and metadata storage
+
+Author: Judd Cohen
+License: MIT (See accompanying file LICENSE or copy at http://opensource.org/licenses/MIT)
+
+Benchmarks for the in-memory directory tree. Run with ``python benchmarks.py [name ...]``
+from this directory. With no arguments, every benchmark is run.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import hashlib
+import binascii
+import asyncio
+import tracemalloc
+
+import fs
+from fs import *
+
+# the synced module is only importable when mediafs is installed as a package
+try:
+    from mediafs.synced import SyncedRootDirectory, ScriptedEventSource
+except ImportError:
+    SyncedRootDirectory = None
+
+
+def _syntheticTree(numDirs=1000, filesPerDir=100, rootPath="/media/library"):
+    """
+    Builds an in-memory tree of ``numDirs`` directories containing ``filesPerDir`` files
+    each, without touching the filesystem. Paths and file fields are filled in the same
+    way they would be after a refresh followed by hashing every file.
+    """
+    root = Directory(rootPath)
+    root._contents = {}
+    for d in range(numDirs):
+        dirName = "album %05d" % d
+        dirobj = Directory(os.path.join(rootPath, dirName), parent=root)
+        dirobj._contents = {}
+        dirobj._relpath = dirName
+        dirobj._abspath = dirobj._path
+        root._contents[dirName] = dirobj
+        for f in range(filesPerDir):
+            fileName = "%02d - track number %d.flac" % (f, f)
+            fileobj = File(os.path.join(dirobj._path, fileName), parent=dirobj)
+            fileobj._relpath = os.path.join(dirName, fileName)
+            fileobj._abspath = fileobj._path
+            fileobj._size = 20000000 + f
+            fileobj._fasthash = "%032x" % (d * filesPerDir + f)
+            dirobj._contents[fileName] = fileobj
+    return root
+
+
+def bench_node_memory():
+    """
+    Memory used per node of a synthetic tree with 100k files
+    """
+    numDirs, filesPerDir = 1000, 100
+    numNodes = numDirs * (filesPerDir + 1)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    root = _syntheticTree(numDirs, filesPerDir)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    total = after - before
+    print("%d nodes: %.1f MB total, %d bytes per node" % (numNodes, total / 2**20, total // numNodes))
+    return root
+
+
+def _deepTree(depth=500, filesPerDir=20, rootPath="/media/library"):
+    """
+    Builds an in-memory tree that is a chain of ``depth`` nested directories containing
+    ``filesPerDir`` files each
+    """
+    root = Directory(rootPath)
+    dirobj = root
+    for d in range(depth):
+        dirobj._contents = {}
+        for f in range(filesPerDir):
+            fileName = "file %02d.flac" % f
+            dirobj._contents[fileName] = File(os.path.join(dirobj._path, fileName), parent=dirobj)
+        subdir = Directory(os.path.join(dirobj._path, "dir %d" % d), parent=dirobj)
+        dirobj._contents[subdir.name] = subdir
+        dirobj = subdir
+    dirobj._contents = {}
+    return root
+
+
+def _nestedWalk(directory):
+    """
+    The recursive generator that ``Directory.all(recursive=True)`` used before it walked
+    the tree iteratively, for comparison
+    """
+    for key in directory.order:
+        item = directory.contents[key]
+        yield item
+        if item.isdir:
+            for subitem in _nestedWalk(item):
+                yield subitem
+
+
+def bench_walk():
+    """
+    Time per item to walk a wide tree with 100k files and a 500 level deep tree with 10k files
+    """
+    path = tempfile.mkdtemp(prefix="mediafs_bench")
+    trees = []
+    for name, tree in (("wide", _syntheticTree(rootPath=path)), ("deep", _deepTree(rootPath=path))):
+        # give the tree a root, which decides the order of each directory
+        root = RootDirectory(path)
+        root._contents = tree._contents
+        for item in root._contents.values():
+            item.parent = root
+        trees.append((name, root))
+    os.rmdir(path)
+
+    walks = [
+        ("nested generators", lambda root: _nestedWalk(root)),
+        ("all() pre-order", lambda root: root.all(recursive=True)),
+        ("all() post-order", lambda root: root.all(recursive=True, traversal="post")),
+        ("all() breadth-first", lambda root: root.all(recursive=True, traversal="breadth")),
+    ]
+    for treeName, root in trees:
+        count = sum(1 for item in root.all(recursive=True))
+        for name, walk in walks:
+            start = time.perf_counter()
+            for item in walk(root):
+                pass
+            total = time.perf_counter() - start
+            print("%s %-20s %6d items %.4fs, %4d ns per item" % (treeName, name, count, total, total / count * 1e9))
+
+
+def bench_directory_totals():
+    """
+    Time to get the size of the root of a tree with 100k files, before and after a file changes
+    """
+    root = _cachedRoot()
+    try:
+        start = time.perf_counter()
+        size = root.size
+        print("first size %.4fs (%d files, %d MB)" % (time.perf_counter() - start, root.fileCount, size // 2**20))
+
+        item = root['album 00500']['00 - track number 0.flac']
+        start = time.perf_counter()
+        for i in range(1000):
+            item._updateStat((item._size + 1, i, 1, 1))
+            size = root.size
+        print("1000 size changes followed by root.size %.4fs" % (time.perf_counter() - start))
+    finally:
+        shutil.rmtree(root.path)
+
+
+class _PathlessRootDirectory(RootDirectory):
+    storePaths = False
+
+
+def bench_path_memory():
+    """
+    Memory used by a synthetic tree with 2M files with and without storing paths, and the
+    time to get every relative path
+    """
+    numDirs, filesPerDir = 2000, 1000
+    base = tempfile.mkdtemp(prefix="mediafs_bench")
+    path = os.path.join(base, "media", "music library")
+    os.makedirs(path)
+    try:
+        for Cls in (RootDirectory, _PathlessRootDirectory):
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            root = Cls(path)
+            root._contents = {}
+            for d in range(numDirs):
+                dirobj = Directory(os.path.join(path, "artist %04d" % d), parent=root)
+                dirobj._contents = {}
+                root._contents[dirobj.name] = dirobj
+                for f in range(filesPerDir):
+                    fileobj = File(os.path.join(path, dirobj.name, "%04d - track number %d.flac" % (f, f)), parent=dirobj)
+                    dirobj._contents[fileobj.name] = fileobj
+                    # the paths are cached on the nodes once they are used
+                    fileobj.relpath, fileobj.abspath
+            after = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            start = time.perf_counter()
+            for dirobj in root._contents.values():
+                for item in dirobj._contents.values():
+                    item.relpath
+            total = time.perf_counter() - start
+
+            numNodes = numDirs * (filesPerDir + 1)
+            print("storePaths=%-5s %d nodes: %.1f MB total, %d bytes per node, all relpaths %.2fs" % (
+                Cls.storePaths, numNodes, (after - before) / 2**20, (after - before) // numNodes, total))
+            del root, dirobj, fileobj
+    finally:
+        shutil.rmtree(base)
+
+
+class _CustomOrderRootDirectory(RootDirectory):
+    def _orderDirectory(self, contents):
+        return sorted(contents)
+
+
+def bench_directory_order():
+    """
+    Time per change to a directory with 100k files, with the default ordering and with an
+    overridden _orderDirectory()
+    """
+    path = tempfile.mkdtemp(prefix="mediafs_bench")
+    try:
+        for Cls in (RootDirectory, _CustomOrderRootDirectory):
+            root = Cls(path)
+            root._contents = {}
+            names = [ "IMG_%06d.jpg" % i for i in range(100000) ]
+            random.shuffle(names)
+            for name in names:
+                root._contents[name] = File(os.path.join(path, name), parent=root)
+                root._contents[name]._size = 0
+            root.order
+
+            # each round removes, adds and renames a file
+            rounds = 50
+            start = time.perf_counter()
+            for i in range(rounds):
+                item = root._pop(root._contents[names[i]])
+                root._push(item)
+                item.rename(item.name + ".bak", syscall=False)
+            total = time.perf_counter() - start
+            print("%-26s %.3f ms per change" % (Cls.__name__, total / (rounds * 3) * 1000))
+    finally:
+        shutil.rmtree(path)
+
+
+def _cachedRoot(Cls=CachedRootDirectory, **kwargs):
+    """
+    Returns a root directory object for a new temp directory, with the contents of a synthetic
+    tree with 100k files attached to it. The temp directory is only used for the cache files.
+    """
+    path = tempfile.mkdtemp(prefix="mediafs_bench")
+    root = Cls(path, metadataFile=None, **kwargs)
+    tree = _syntheticTree(1000, 100, path)
+    root._contents = tree._contents
+    for item in root._contents.values():
+        item.parent = root
+    # the nodes found their root while the tree was built
+    for item in root.all(recursive=True):
+        item._root = None
+    root._order = root._orderDirectory(root._contents)
+    return root
+
+
+def bench_tree_cache():
+    """
+    Save and load times of the tree cache with 100k files, in each format
+    """
+    for treeFormat in ("json", "binary"):
+        root = _cachedRoot(treeFormat=treeFormat)
+        try:
+            start = time.perf_counter()
+            root.save()
+            saveTime = time.perf_counter() - start
+
+            loadTime = None
+            for i in range(3):
+                start = time.perf_counter()
+                loaded = CachedRootDirectory(root.path, metadataFile=None)
+                elapsed = time.perf_counter() - start
+                if loadTime is None or elapsed < loadTime:
+                    loadTime = elapsed
+
+            assert len(loaded[...]) == len(root[...])
+            print("%-6s save %.2fs, load %.2fs, %.1f MB" % (treeFormat, saveTime, loadTime,
+                os.path.getsize(root._treeFile) / 2**20))
+        finally:
+            shutil.rmtree(root.path)
+
+
+def bench_incremental_save():
+    """
+    Time to save the binary tree cache with 100k files after changing one directory
+    """
+    root = _cachedRoot(treeFormat="binary")
+    try:
+        start = time.perf_counter()
+        root.save()
+        fullTime = time.perf_counter() - start
+        fullSize = os.path.getsize(root._treeFile)
+
+        dirobj = root[500]
+        dirobj._pop(dirobj[0])
+        start = time.perf_counter()
+        root.save()
+        incrementalTime = time.perf_counter() - start
+
+        print("full save %.3fs (%.1f MB), incremental save %.4fs (%d bytes appended)" % (
+            fullTime, fullSize / 2**20, incrementalTime, os.path.getsize(root._treeFile) - fullSize))
+    finally:
+        shutil.rmtree(root.path)
+
+
+def bench_lazy_load():
+    """
+    Time and memory to load the binary tree cache with 100k files and look up one file
+    """
+    root = _cachedRoot(treeFormat="binary")
+    try:
+        root.save()
+        root._contents = None
+        for lazyLoad in (False, True):
+            tracemalloc.start()
+            start = time.perf_counter()
+            loaded = CachedRootDirectory(root.path, metadataFile=None, lazyLoad=lazyLoad)
+            loaded['album 00500']['07 - track number 7.flac']
+            elapsed = time.perf_counter() - start
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print("lazyLoad=%-5s %.4fs, %.1f MB" % (lazyLoad, elapsed, used / 2**20))
+            del loaded
+    finally:
+        shutil.rmtree(root.path)
+
+
+def bench_name_index():
+    """
+    Recursive filter() and search() on a tree with 100k files, with and without a name index
+    """
+    root = _cachedRoot()
+    try:
+        searches = [
+            ("filter *00500*", lambda: list(root.filter("*00500*", recursive=True))),
+            ("filter *number 7.flac", lambda: list(root.filter("*number 7.flac", recursive=True))),
+            ("search album 0050\\d", lambda: list(root.search(r"album 0050\d", recursive=True))),
+        ]
+        for name, func in searches:
+            start = time.perf_counter()
+            count = len(func())
+            print("%-24s %4d results, no index  %.4fs" % (name, count, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        root.createNameIndex()
+        root._updateNameIndex()
+        print("building the index %.4fs" % (time.perf_counter() - start))
+
+        for name, func in searches:
+            start = time.perf_counter()
+            count = len(func())
+            print("%-24s %4d results, index     %.4fs" % (name, count, time.perf_counter() - start))
+    finally:
+        shutil.rmtree(root.path)
+
+
+def bench_path_lookup():
+    """
+    Looking up 100k relative paths, with and without a path index
+    """
+    root = _cachedRoot()
+    try:
+        relpaths = [ item.relpath for item in root.all(recursive=True) ]
+        random.shuffle(relpaths)
+        for name in ("no index", "index"):
+            if name == "index":
+                start = time.perf_counter()
+                root.createPathIndex()
+                print("building the index %.4fs" % (time.perf_counter() - start))
+
+            start = time.perf_counter()
+            for relpath in relpaths:
+                root.lookup(relpath)
+            total = time.perf_counter() - start
+            print("%-8s %.3fs, %.2f us per lookup" % (name, total, total / len(relpaths) * 1e6))
+    finally:
+        shutil.rmtree(root.path)
+
+
+def bench_metadata_index():
+    """
+    Looking up files by metadata in a tree with 100k files, with and without a metadata index
+    """
+    root = _cachedRoot()
+    try:
+        for i, item in enumerate(root.all(recursive=True, dirs=False)):
+            if i % 10 == 0:
+                item.metadata['author'] = "author %d" % (i % 1000)
+                item.metadata['year'] = 1950 + i % 70
+
+        searches = [
+            ("query author", lambda: list(root.query(lambda f: f.get('author') == "author 420", recursive=True))),
+            ("lookupMetadata author", lambda: list(root.lookupMetadata('author', "author 420"))),
+            ("lookupMetadataRange year", lambda: list(root.lookupMetadataRange('year', 2000, 2001))),
+        ]
+        for name, func in searches:
+            start = time.perf_counter()
+            count = len(func())
+            print("%-26s %5d results, no index %.4fs" % (name, count, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        root.createIndex('author')
+        root.createIndex('year')
+        root._findMetadataLocations()
+        print("building the indexes %.4fs" % (time.perf_counter() - start))
+
+        for name, func in searches[1:]:
+            start = time.perf_counter()
+            count = len(func())
+            print("%-26s %5d results, index    %.4fs" % (name, count, time.perf_counter() - start))
+    finally:
+        shutil.rmtree(root.path)
+
+
+def bench_query_planner():
+    """
+    Query strings on a tree with 100k files, with and without the name and metadata indexes
+    """
+    root = _cachedRoot()
+    try:
+        for i, item in enumerate(root.all(recursive=True, dirs=False)):
+            if i % 10 == 0:
+                item.metadata['author'] = "author %d" % (i % 1000)
+                item.metadata['year'] = 1950 + i % 70
+
+        queries = [
+            'author == "author 420" and size >= 0',
+            'year >= 2005 and name ~ "*number 70.*"',
+            'name ~ "album 0042*" and size > 0',
+            'relpath ~ "album 00042/*" and size > 20000050',
+        ]
+        for query in queries:
+            start = time.perf_counter()
+            count = len(list(root.query(query, recursive=True)))
+            print("%-48s %5d results, no index %.4fs" % (query, count, time.perf_counter() - start))
+
+        root.createNameIndex()
+        root.createIndex('author')
+        root.createIndex('year')
+        root._updateNameIndex()
+        root._findMetadataLocations()
+
+        for query in queries:
+            start = time.perf_counter()
+            count = len(list(root.query(query, recursive=True)))
+            print("%-48s %5d results, index    %.4fs" % (query, count, time.perf_counter() - start))
+    finally:
+        shutil.rmtree(root.path)
+
+
+def _fileTree(numFiles=200, fileSize=2**20):
+    """
+    Creates a temp directory containing ``numFiles`` files of random data, spread over
+    10 subdirectories, and returns its path
+    """
+    path = tempfile.mkdtemp(prefix="mediafs_bench")
+    for i in range(numFiles):
+        dirPath = os.path.join(path, "dir %d" % (i % 10))
+        os.makedirs(dirPath, exist_ok=True)
+        with open(os.path.join(dirPath, "file %04d.bin" % i), 'wb') as fp:
+            fp.write(os.urandom(fileSize))
+    return path
+
+
+def bench_scan_stat():
+    """
+    Syscalls and time to refresh a tree with 20k empty files and get the size and mtime of every file
+    """
+    path = _fileTree(20000, 0)
+    calls = [0]
+    def counted(func):
+        def wrapper(*args, **kwargs):
+            calls[0] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    origStat, origGetsize, origGetmtime = os.stat, os.path.getsize, os.path.getmtime
+    os.stat, os.path.getsize, os.path.getmtime = counted(origStat), counted(origGetsize), counted(origGetmtime)
+    try:
+        root = RootDirectory(path)
+        start = time.perf_counter()
+        root.refresh(recursive=True)
+        print("refresh            %.4fs" % (time.perf_counter() - start))
+
+        calls[0] = 0
+        start = time.perf_counter()
+        total = root.size
+        for item in root.all(recursive=True, dirs=False):
+            item.mtime()
+        print("size and mtimes    %.4fs, %d stat calls" % (time.perf_counter() - start, calls[0]))
+    finally:
+        os.stat, os.path.getsize, os.path.getmtime = origStat, origGetsize, origGetmtime
+        shutil.rmtree(path)
+
+
+def bench_sync_moves():
+    """
+    Syncing after 1000 of 5000 files were moved to other directories, with and without detectMoves
+    """
+    path = tempfile.mkdtemp(prefix="mediafs_bench")
+    try:
+        for d in range(100):
+            os.makedirs(os.path.join(path, "dir %d" % d))
+            for f in range(50):
+                with open(os.path.join(path, "dir %d" % d, "file %d.bin" % f), 'wb') as fp:
+                    fp.write(os.urandom(1024 + f))
+        roots = [ RootDirectory(path), RootDirectory(path) ]
+        for root in roots:
+            root.refresh(recursive=True)
+            root.sync(recursive=True)
+
+        for d in range(100):
+            for f in range(10):
+                os.rename(os.path.join(path, "dir %d" % d, "file %d.bin" % f),
+                    os.path.join(path, "dir %d" % ((d + 1) % 100), "moved %d %d.bin" % (d, f)))
+
+        for root, detectMoves in zip(roots, (False, True)):
+            counts = { "added": 0, "deleted": 0, "moved": 0 }
+            def count(kind):
+                def callback(*args):
+                    counts[kind] += 1
+                return callback
+            start = time.perf_counter()
+            root.sync(recursive=True, detectMoves=detectMoves,
+                onAdded=count("added"), onDeleted=count("deleted"), onMoved=count("moved"))
+            print("detectMoves=%-5s %.4fs, %d added, %d deleted, %d moved" % (detectMoves,
+                time.perf_counter() - start, counts["added"], counts["deleted"], counts["moved"]))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_async_refresh():
+    """
+    Longest event loop stall while 20k files in 200 directories are scanned with refresh() and arefresh()
+    """
+    path = tempfile.mkdtemp(prefix="mediafs_bench")
+    try:
+        for d in range(200):
+            os.makedirs(os.path.join(path, "dir %d" % d))
+            for f in range(100):
+                open(os.path.join(path, "dir %d" % d, "file %d.bin" % f), 'wb').close()
+
+        async def measure(scan):
+            stalls = [ 0.0 ]
+            done = False
+            async def tick():
+                last = time.perf_counter()
+                while not done:
+                    await asyncio.sleep(0)
+                    now = time.perf_counter()
+                    stalls.append(now - last)
+                    last = now
+            ticker = asyncio.ensure_future(tick())
+            await asyncio.sleep(0)
+            start = time.perf_counter()
+            await scan()
+            total = time.perf_counter() - start
+            done = True
+            await ticker
+            return total, max(stalls)
+
+        async def blocking(root):
+            root.refresh(recursive=True)
+
+        for name, scan in (("refresh", blocking), ("arefresh", lambda root: root.arefresh(recursive=True))):
+            root = RootDirectory(path)
+            total, stall = asyncio.run(measure(lambda: scan(root)))
+            print("%-8s %.3fs total, longest stall %.1f ms" % (name, total, stall * 1000))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_sync_events():
+    """
+    Events per second handled by processFilesystemEvents() for 1M scripted events on 10k files
+    """
+    if SyncedRootDirectory is None:
+        print("mediafs.synced can't be imported")
+        return
+
+    path = _fileTree(10000, 0)
+    try:
+        source = ScriptedEventSource()
+        rng = random.Random(0)
+        names = sorted(os.listdir(path))
+        dirs = [ (os.path.join(path, name), sorted(os.listdir(os.path.join(path, name)))) for name in names ]
+
+        # the scripted events don't change anything on disk, so every script leaves the
+        # files where they were
+        def modify():
+            dirPath, files = rng.choice(dirs)
+            return source.modify(os.path.join(dirPath, rng.choice(files)))
+        def createDelete():
+            newPath = os.path.join(rng.choice(dirs)[0], "new %d.tmp" % rng.randrange(100))
+            return source.create(newPath) + source.delete(newPath)
+        def moveBack():
+            srcDir, destDir = rng.sample(dirs, 2)
+            src = os.path.join(srcDir[0], rng.choice(srcDir[1]))
+            dest = os.path.join(destDir[0], os.path.basename(src))
+            return source.move(src, dest) + source.move(dest, src)
+
+        async def measure(script, count):
+            root = SyncedRootDirectory(path, asyncio.get_running_loop(), eventSource=source)
+            root.refresh(recursive=True)
+            events = []
+            while len(events) < count:
+                events.extend(script())
+
+            start = time.perf_counter()
+            # one replay per read of an inotify file descriptor with a 64k buffer
+            for i in range(0, len(events), 2048):
+                source.replay(events[i:i + 2048])
+            while root._eventBuffer or not root._eventBatches.empty():
+                await root.processFilesystemEvents(wait=True)
+            total = time.perf_counter() - start
+            if not root.isSynced():
+                print("tree is out of sync")
+            return len(events), total
+
+        for name, script in (("modify", modify), ("create+delete", createDelete), ("move", moveBack)):
+            count, total = asyncio.run(measure(script, 1000000 // 3))
+            print("%-14s %7d events %.3fs, %8.0f events/s" % (name, count, total, count / total))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_hash_all():
+    """
+    Time to md5 200 1MB files one at a time and with hashAll()
+    """
+    path = _fileTree()
+    try:
+        root = RootDirectory(path)
+        start = time.perf_counter()
+        for item in root.all(recursive=True, dirs=False):
+            item.md5()
+        print("serial      %.4fs" % (time.perf_counter() - start))
+
+        for workers in (2, 4, 8):
+            root = RootDirectory(path)
+            start = time.perf_counter()
+            root.hashAll(kind="md5", workers=workers)
+            print("workers=%-3d %.4fs" % (workers, time.perf_counter() - start))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_find_duplicates():
+    """
+    Bytes read by findDuplicates() for 210 files of 1-2MB, with 10 copies and 40 shared sizes
+    """
+    path = _fileTree(numFiles=0)
+    try:
+        os.makedirs(os.path.join(path, "copies"))
+        for i in range(200):
+            size = 2**20 + (i % 20 if i < 40 else i * 4096)
+            data = os.urandom(size)
+            with open(os.path.join(path, "file %04d.bin" % i), 'wb') as fp:
+                fp.write(data)
+            if i % 20 == 0:
+                with open(os.path.join(path, "copies", "file %04d.bin" % i), 'wb') as fp:
+                    fp.write(data)
+
+        root = RootDirectory(path)
+        total = root.size
+        start = time.perf_counter()
+        groups = root.findDuplicates()
+        elapsed = time.perf_counter() - start
+
+        # every file with a fasthash had 4KB read, and every file with an md5 was read completely
+        read = 0
+        for item in root.all(recursive=True, dirs=False):
+            if item._md5 is not None:
+                read += item.size
+            elif item._fasthash is not None:
+                read += 4096
+        print("%d groups in %.4fs, read %.1f MB of %.1f MB (%.1f%%)" % (
+            len(groups), elapsed, read / 2**20, total / 2**20, read / total * 100))
+
+        start = time.perf_counter()
+        root.hashAll(kind="md5", refresh=True)
+        print("md5 of every file %.4fs" % (time.perf_counter() - start))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_hash_throughput():
+    """
+    md5 and crc throughput on a 256MB file, compared with reading it in small chunks
+    """
+    path = tempfile.mkdtemp(prefix="mediafs_bench")
+    try:
+        filePath = os.path.join(path, "large.bin")
+        size = 2**28
+        with open(filePath, 'wb') as fp:
+            for i in range(size // 2**20):
+                fp.write(os.urandom(2**20))
+
+        def smallChunks(update, chunkSize):
+            with open(filePath, 'rb') as fp:
+                chunk = fp.read(chunkSize)
+                while chunk:
+                    update(chunk)
+                    chunk = fp.read(chunkSize)
+
+        def crcSmallChunks():
+            c = 0
+            with open(filePath, 'rb') as fp:
+                chunk = fp.read(1024)
+                while chunk:
+                    c = binascii.crc32(chunk, c)
+                    chunk = fp.read(1024)
+
+        tests = [
+            ("md5, 2KB chunks", lambda: smallChunks(hashlib.md5().update, 2048)),
+            ("md5, _fileMd5", lambda: fs._fileMd5(filePath)),
+            ("crc, 1KB chunks", crcSmallChunks),
+            ("crc, _fileCrc", lambda: fs._fileCrc(filePath)),
+        ]
+        for name, func in tests:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            print("%-16s %.3fs, %.0f MB/s" % (name, elapsed, size / 2**20 / elapsed))
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    names = sys.argv[1:]
+    if len(names) == 0:
+        names = sorted(name[len("bench_"):] for name in globals() if name.startswith("bench_"))
+
+    for name in names:
+        func = globals()["bench_" + name]
+        print("== %s: %s" % (name, func.__doc__.strip()))
+        start = time.perf_counter()
+        func()
+        print("   (%.2fs)" % (time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,24 @@ License: MIT (See accompanying file LICENSE or copy at http://opensource.org/lic
 """
 import os
 import re
+import gc
 import sys
+import ast
 import json
+import mmap
+import array
+import bisect
+import struct
+import marshal
 import fnmatch
+import asyncio
 import hashlib
 import binascii
+import threading
+from stat import S_ISDIR, S_ISREG
+from collections import deque, OrderedDict
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 # Python 3.5 has scandir built-in, so grab that if it's available
 if hasattr(os, 'scandir'):
@@ -25,26 +37,470 @@ else:
         scandir = None
 
 
-# Provide the same interface for both scandir and listdir so we can use scandir if available
+# Provide the same interface for both scandir and listdir so we can use scandir if available.
+# Each item is a (name, isdir, isfile, signature) tuple, where signature is the stat
+# signature of a file (see _statSignature()) or None. The stat results are kept on the
+# File objects, so their size doesn't need another syscall later.
 if scandir is None:
     def dirlisting(path):
         for item in os.listdir(path):
             itemPath = os.path.join(path, item)
-            yield (item, os.path.isdir(itemPath), os.path.isfile(itemPath))
+            yield _pathListing(item, itemPath)
 else:
     def dirlisting(path):
         try:
             for item in scandir(path):
-                yield (item.name, item.is_dir(), item.is_file())
+                isfile = item.is_file()
+                signature = None
+                if isfile:
+                    # free on Windows, and the only syscall per file on other systems
+                    try:
+                        signature = _statSignature(item.stat())
+                    except OSError:
+                        pass
+                yield (item.name, item.is_dir(), isfile, signature)
         except:
             return
 
 
+def _pathListing(name, path):
+    """
+    Returns the ``dirlisting()`` tuple for a single path, using one ``os.stat()`` call
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (name, False, False, None)
+    if S_ISREG(st.st_mode):
+        return (name, False, True, _statSignature(st))
+    return (name, S_ISDIR(st.st_mode), False, None)
+
+
+
+class _ParallelLister(object):
+    """
+    Reads directory listings on a thread pool ahead of a recursive ``Directory.refresh()``.
+
+    Every listing that is read submits listings for its own subdirectories, so the pool
+    stays busy with sibling directories while the refreshing thread builds the tree.
+    Only the listings are read concurrently - all FSObjects are created and all refresh
+    callbacks are called by the thread that called ``refresh()``, in the same order as a
+    serial refresh.
+    """
+
+    def __init__(self, root, workers):
+        self._root = root
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = {}
+        self._lock = threading.Lock()
+        # set when the refresh is over, so that no more listings are submitted
+        self._stopped = False
+
+
+    def submit(self, path):
+        """
+        Schedule a listing of ``path`` to be read in the background.
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            self._pending[path] = self._pool.submit(self._list, path)
+
+
+    def get(self, path):
+        """
+        Returns the listing of ``path`` in the same format as ``dirlisting()``,
+        waiting for it to be read if necessary.
+        """
+        with self._lock:
+            future = self._pending.pop(path, None)
+        if future is None:
+            return self._list(path)
+        return future.result()
+
+
+    def shutdown(self):
+        # the refresh may have been stopped by an exception, so the listings that weren't
+        # started yet are dropped instead of reading the rest of the tree
+        with self._lock:
+            self._stopped = True
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+    def _list(self, path):
+        listing = list(dirlisting(path))
+        for name, isdir, isfile, signature in listing:
+            if self._stopped:
+                break
+            if isdir:
+                fullPath = os.path.join(path, name)
+                if not self._root._ignorePath(name, fullPath, isdir):
+                    self.submit(fullPath)
+        return listing
+
+
+
+class _SyncMoves(object):
+    """
+    Collects the changes found by ``Directory.sync()`` with ``detectMoves=True``, so that
+    files that were moved between directories can be matched up once the whole tree was
+    scanned.
+
+    Files and directories that disappeared are left in the tree until ``finish()`` is
+    called, so that the files inside removed directories can be matched too. New files are
+    only added by ``finish()``, if they weren't moved from somewhere else.
+    """
+
+    def __init__(self):
+        # files and directories that disappeared
+        self.removed = []
+        # (directory, File) pairs of new files that aren't in the tree yet
+        self.added = []
+        # new directories, which are in the tree already
+        self.addedDirs = []
+
+
+    def finish(self, root, onAdded, onDeleted, onMoved):
+        """
+        Matches the new files with the files that disappeared, first by their stat signature
+        (moving a file within a filesystem keeps its inode and mtime), then by their size
+        and fasthash. Matched files are moved to their new place in the tree, and everything
+        else is added to or removed from the tree.
+        """
+        bySignature = {}
+        byHash = {}
+        sizes = set()
+        for item in self._removedFiles():
+            if item._inode is not None:
+                bySignature[(item._size, item._mtimeNs, item._inode, item._device)] = item
+            if item._fasthash is not None:
+                byHash[(item._size, item._fasthash)] = item
+                sizes.add(item._size)
+
+        # new files, and the files inside new directories
+        candidates = [ (dirobj, item, False) for dirobj, item in self.added ]
+        seen = set()
+        for newDir in self.addedDirs:
+            for item in newDir.all(recursive=True, dirs=False):
+                if item not in seen:
+                    seen.add(item)
+                    candidates.append((item.parent, item, True))
+
+        matched = set()
+        for dirobj, newFile, inTree in candidates:
+            signature = (newFile._size, newFile._mtimeNs, newFile._inode, newFile._device)
+            match = bySignature.get(signature) if newFile._inode is not None else None
+            # only files that have the size of a removed file have to be hashed
+            if (match is None or match in matched) and newFile._size in sizes:
+                match = byHash.get((newFile._size, newFile.fasthash()))
+
+            if match is None or match in matched:
+                if not inTree:
+                    dirobj._push(newFile)
+                    root._fileRefresh(newFile)
+                    if onAdded is not None:
+                        onAdded(newFile)
+                continue
+
+            # move the old file object, which keeps its cached hashes
+            matched.add(match)
+            oldRelpath = match.relpath
+            match._updateStat(signature)
+            if match._fasthash is None:
+                match._fasthash = newFile._fasthash
+            match.parent._pop(match)
+            if inTree:
+                dirobj._pop(newFile)
+            match.name = newFile.name
+            dirobj._push(match)
+            root._fileRefresh(match)
+            if onMoved is not None:
+                onMoved(oldRelpath, match)
+
+        for item in self.removed:
+            if item in matched:
+                continue
+            if onDeleted is not None:
+                onDeleted(item)
+            root._pathDelete(item)
+            item.parent._pop(item)
+
+
+    def _removedFiles(self):
+        """
+        Generator that yields every file that disappeared, including the files inside
+        removed directories that are loaded or in the tree cache
+        """
+        stack = list(self.removed)
+        while len(stack) > 0:
+            item = stack.pop()
+            if not item.isdir:
+                yield item
+            elif item._loadCachedContents():
+                stack.extend(item._contents.values())
+
+
+
+# files smaller than this are hashed completely by File.fasthash()
+_FASTHASH_FULL_SIZE = 2**19
+
+# files are hashed by reading them into a buffer of this size, which is allocated once
+# per thread and reused for every file
+_HASH_BUFFER_SIZE = 2**20
+_hashBuffers = threading.local()
+
+
+def _readBlocks(path):
+    """
+    Generator that reads the file at ``path`` into the current thread's hash buffer and
+    yields a memoryview of each block that was read. Each view is only valid until
+    the next one is yielded.
+    """
+    buf = getattr(_hashBuffers, 'buf', None)
+    if buf is None:
+        buf = _hashBuffers.buf = memoryview(bytearray(_HASH_BUFFER_SIZE))
+
+    # unbuffered, so the data is read straight into our buffer without an extra copy
+    with open(path, 'rb', buffering=0) as fp:
+        n = fp.readinto(buf)
+        while n:
+            yield buf[:n]
+            n = fp.readinto(buf)
+
+
+def _fileCrc(path):
+    """
+    Calculates the CRC of the file at ``path``
+    """
+    c = 0
+    for block in _readBlocks(path):
+        c = binascii.crc32(block, c)
+    return c
+
+
+def _fileMd5(path):
+    """
+    Calculates the MD5 sum of the file at ``path`` and returns it as a hex string
+    """
+    h = hashlib.md5()
+    for block in _readBlocks(path):
+        h.update(block)
+    return h.hexdigest()
+
+
+def _fileFasthash(path, size):
+    """
+    Calculates the fasthash of the file at ``path``, which is ``size`` bytes long.
+    See ``File.fasthash()``.
+    """
+    # for small files, just use the md5 of the whole file
+    if size < _FASTHASH_FULL_SIZE:
+        return _fileMd5(path)
+
+    # for larger files, hash some bits at the beginning, some bits
+    # at the end, and the size of the file. that gives reasonable results.
+    h = hashlib.md5()
+    with open(path, 'rb') as fp:
+        fp.seek(1024 * 8)
+        h.update(fp.read(2048))
+        fp.seek(-4096, 2) # 4k before the end of the file
+        h.update(fp.read(2048))
+
+    # factor in the filesize so that very similar files can still be
+    # easily distinguished
+    h.update(str(size).encode())
+    return h.hexdigest()
+
+
+def _statSignature(st):
+    """
+    Returns the parts of the ``os.stat_result`` ``st`` that are used to detect whether a
+    file changed since it was last hashed, as a tuple of (size, mtime in ns, inode, device).
+    """
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+
+
+def _hashFile(kind, path):
+    """
+    Calculates one kind of hash ("crc", "md5" or "fasthash") of the file at ``path`` and
+    returns a 2-tuple of the file's stat signature (see ``_statSignature()``) and the hash.
+    This only depends on its arguments so that ``Directory.hashAll()`` can run it in other
+    threads or processes.
+    """
+    signature = _statSignature(os.stat(path))
+    if kind == "crc":
+        return (signature, _fileCrc(path))
+    elif kind == "md5":
+        return (signature, _fileMd5(path))
+    else:
+        return (signature, _fileFasthash(path, signature[0]))
+
+
+
+def _joinRelpath(relpath, name):
+    """
+    Returns the relative path of an item called ``name`` inside the directory with the
+    relative path ``relpath``. The relative path of the root directory is ".".
+    """
+    if relpath == ".":
+        return name
+    return os.path.join(relpath, name)
+
+
+def _updatePathIndex(index, item, oldRelpath, newRelpath):
+    """
+    Moves ``item`` and everything inside it that is loaded from ``oldRelpath`` to ``newRelpath``
+    in the path index ``index``. Either path can be None to only add or only remove the
+    entries. Entries are only removed if they still point at the same object.
+    """
+    stack = [ (item, oldRelpath, newRelpath) ]
+    while len(stack) > 0:
+        obj, oldRelpath, newRelpath = stack.pop()
+        if oldRelpath is not None and index.get(oldRelpath) is obj:
+            del index[oldRelpath]
+        if newRelpath is not None:
+            index[newRelpath] = obj
+        if obj.isdir and obj._contents is not None:
+            for name, child in obj._contents.items():
+                stack.append((child,
+                              None if oldRelpath is None else _joinRelpath(oldRelpath, name),
+                              None if newRelpath is None else _joinRelpath(newRelpath, name)))
+
+
+# everything in a glob pattern that isn't matched literally: wildcards, character
+# sets (which can start with "]"), and any "[" that doesn't start a character set
+_GLOB_SPECIAL = re.compile(r'\*|\?|\[!?\]?[^\]]*\]|\[')
+
+def _globLiterals(pattern):
+    """
+    Returns a list of the strings that are part of every name matched by the
+    ``fnmatch`` pattern ``pattern``.
+    """
+    return [ part for part in _GLOB_SPECIAL.split(pattern) if part ]
+
+
+# the number of hex digits in the escapes for character codes
+_hexEscapeLengths = { 'x': 2, 'u': 4, 'U': 8 }
+
+
+def _regexLiterals(regex, flags=0):
+    """
+    Returns a list of strings that are part of every string ``regex`` can match, or None
+    if the regex is too complicated to tell. Only literal characters outside of groups
+    and character sets are used, so for example ``'(.*)qwerty(.*)[.]txt'`` returns
+    ``['qwerty', 'txt']``. The list doesn't have to be complete, it just can't contain
+    anything that isn't required.
+    """
+    # alternations can make any part of the regex optional, and whitespace is ignored in verbose mode
+    if '|' in regex or flags & re.VERBOSE or re.search(r'\(\?[a-zA-Z]*x', regex):
+        return None
+
+    n = len(regex)
+    def skipCharSet(i):
+        # returns the index after the character set starting at i, which can start with "]"
+        i += 1
+        if i < n and regex[i] == '^':
+            i += 1
+        if i < n and regex[i] == ']':
+            i += 1
+        while i < n and regex[i] != ']':
+            if regex[i] == '\\':
+                i += 1
+            i += 1
+        return i + 1
+
+    literals = []
+    current = []
+    def flush():
+        if current:
+            literals.append("".join(current))
+            del current[:]
+
+    i = 0
+    while i < n:
+        c = regex[i]
+        if c == '\\':
+            escaped = regex[i+1:i+2]
+            i += 2
+            # escaped punctuation is a literal, anything else is a character class, anchor or backreference
+            if escaped and not escaped.isalnum():
+                current.append(escaped)
+            else:
+                flush()
+                # the rest of a character code like \x41, \u0041, \N{name} or \101, or of a
+                # backreference like \12 or \g<name>, isn't a literal either
+                if escaped in _hexEscapeLengths:
+                    end = min(i + _hexEscapeLengths[escaped], n)
+                    while i < end and regex[i] in "0123456789abcdefABCDEF":
+                        i += 1
+                elif escaped in ('N', 'g') and regex[i:i+1] in ('{', '<'):
+                    end = regex.find('}' if regex[i] == '{' else '>', i)
+                    i = n if end == -1 else end + 1
+                elif escaped.isdigit():
+                    while i < n and regex[i].isdigit():
+                        i += 1
+
+        elif c == '[':
+            flush()
+            i = skipCharSet(i)
+
+        elif c == '(':
+            # skip over the whole group, since it could be optional
+            flush()
+            depth = 0
+            while i < n:
+                c = regex[i]
+                if c == '\\':
+                    i += 2
+                    continue
+                elif c == '[':
+                    i = skipCharSet(i)
+                    continue
+                elif c == '(':
+                    depth += 1
+                elif c == ')':
+                    depth -= 1
+                    if depth == 0:
+                        i += 1
+                        break
+                i += 1
+
+        elif c in '*?{':
+            # the last character is optional, and anything after the quantifier can't be
+            # part of the same literal
+            if current:
+                current.pop()
+            flush()
+            if c == '{':
+                end = regex.find('}', i)
+                i = n if end == -1 else end
+            i += 1
+
+        elif c in '.^$+)':
+            # a "+" requires the last character at least once, but it can be repeated
+            flush()
+            i += 1
+
+        else:
+            current.append(c)
+            i += 1
+
+    flush()
+    return literals
+
+
 
 class FSObject(object):
     """
     Base class for all filesystem objects
     """
+    # File and directory objects use __slots__ instead of a per-instance __dict__, which
+    # roughly halves the memory used by each node in large trees. Subclasses that don't
+    # declare __slots__ themselves get a __dict__ as usual, so they can still add any
+    # attributes they need. Subclasses that only add methods should declare
+    # ``__slots__ = ()`` to stay compact.
+    __slots__ = ('name', 'parent', '_path', '_metadata', '_root', '_size', '_relpath', '_abspath')
+
     # is this object a directory?
     isdir = False
 
@@ -55,6 +511,9 @@ class FSObject(object):
         self.name = os.path.basename(path)
         self.parent = parent
         self._path = path
+        if parent is not None and not getattr(parent.root, 'storePaths', True):
+            # the path is put together from the parent chain when it's needed
+            self._path = None
 
         # deferred values:
         self._metadata = None
@@ -102,6 +561,22 @@ class FSObject(object):
         return inst
 
 
+    @classmethod
+    def _deserializeRecord(cls, fields, values):
+        """
+        Same as ``deserialize()``, but takes the attribute names and values as two
+        sequences instead of a dict. Used by the binary tree cache, which stores
+        objects as tuples of values.
+        """
+        inst = cls.__new__(cls)
+        for attr, val in zip(fields, values):
+            setattr(inst, attr, val)
+        inst.parent = None
+        inst._metadata = None
+        inst._root = None
+        return inst
+
+
     def rename(self, newName, syscall=True):
         """
         Renames the file or directory. Raises a FileExistsError exception if the
@@ -131,6 +606,9 @@ class FSObject(object):
         # clear cached values that probably contain the name
         self._relpath = None
         self._abspath = None
+        forgetPaths = getattr(self.root, '_forgetPaths', None)
+        if forgetPaths is not None:
+            forgetPaths(self)
 
         # do the actual file rename if requested
         if syscall:
@@ -189,6 +667,10 @@ class FSObject(object):
         for moving and renaming files.
         """
         if self._path is None:
+            root = self.root
+            if self is not root and not getattr(root, 'storePaths', True):
+                return root._materializePath(self)
+
             parts = [self.name]
             # go up the parent chain and figure out the path in reverse
             obj = self
@@ -214,6 +696,11 @@ class FSObject(object):
         Lazily evaluated and cached.
         """
         if self._abspath is None:
+            if self._path is None:
+                root = self.root
+                if self is not root and not getattr(root, 'storePaths', True):
+                    # paths put together from the parent chain are already absolute
+                    return root._materializePath(self)
             self._abspath = os.path.abspath(self.path)
         return self._abspath
 
@@ -251,6 +738,9 @@ class FSObject(object):
         The file or directory path relative to the root directory.
         """
         if self._relpath is None:
+            root = self.root
+            if self is not root and not getattr(root, 'storePaths', True):
+                return root._materializePath(self)[root._relpathStart:]
             self._relpath = os.path.relpath(self.path, os.path.commonprefix([self.root.path, self.path]))
         return self._relpath
 
@@ -306,6 +796,27 @@ class FSObject(object):
         return self.hash() == other.hash()
 
 
+    def _markDirty(self):
+        """
+        Marks the directory containing this object as changed since the directory tree
+        was last saved, so that it gets written out again on the next ``save()``.
+        """
+        if self.parent is not None:
+            self.parent._markDirty()
+
+
+    async def _runBlocking(self, func, *args):
+        """
+        Runs ``func(*args)`` on the thread pool of the root directory (see
+        ``RootDirectory.asyncWorkers``) without blocking the event loop, and returns the
+        result. ``func`` must not touch any FSObjects, which are only changed by the thread
+        that runs the event loop.
+        """
+        getExecutor = getattr(self.root, '_getAsyncExecutor', None)
+        executor = None if getExecutor is None else getExecutor()
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
     # All FSObjects should have some kind of implementation for __len__, __iter__,
     # __contains__, and __getitem__ to elegantly support Directory.query().
     # The default implementations here assumes the object has NO contents at all.
@@ -339,10 +850,15 @@ class File(FSObject):
     """
     Object that represents a file in the filesystem
     """
+    __slots__ = ('_crc', '_md5', '_fasthash', '_mtimeNs', '_inode', '_device')
+
     isdir = False
 
     # what fields should be serialized when FSObject.serialize() is called?
-    serializeFields = FSObject.serializeFields + ('_crc', '_md5', '_fasthash')
+    serializeFields = FSObject.serializeFields + ('_crc', '_md5', '_fasthash', '_mtimeNs', '_inode', '_device')
+
+    # stat fields that are missing from tree caches written by older versions
+    _statFields = ('_mtimeNs', '_inode', '_device')
 
     def __init__(self, path, parent=None):
         FSObject.__init__(self, path, parent)
@@ -351,6 +867,29 @@ class File(FSObject):
         self._md5 = None
         self._fasthash = None
 
+        # stat signature of the file when it was last hashed, together with _size
+        self._mtimeNs = None
+        self._inode = None
+        self._device = None
+
+
+    @classmethod
+    def deserialize(cls, attrs):
+        inst = super(File, cls).deserialize(attrs)
+        for attr in cls._statFields:
+            if attr not in attrs:
+                setattr(inst, attr, None)
+        return inst
+
+
+    @classmethod
+    def _deserializeRecord(cls, fields, values):
+        inst = super(File, cls)._deserializeRecord(fields, values)
+        if '_mtimeNs' not in fields:
+            for attr in cls._statFields:
+                setattr(inst, attr, None)
+        return inst
+
 
     def crc(self, refresh=False):
         """
@@ -359,13 +898,7 @@ class File(FSObject):
         then the result is recalculated.
         """
         if refresh or self._crc is None:
-            c = 0
-            with open(self.path, 'rb') as fp:
-                chunk = fp.read(1024)
-                while chunk:
-                    c = binascii.crc32(chunk, c)
-                    chunk = fp.read(1024)
-            self._crc = c
+            self._storeHash('_crc', _fileCrc(self.path))
         return self._crc
 
 
@@ -376,13 +909,7 @@ class File(FSObject):
         then the result is recalculated.
         """
         if refresh or self._md5 is None:
-            h = hashlib.md5()
-            with open(self.path, 'rb') as fp:
-                chunk = fp.read(2048)
-                while chunk:
-                    h.update(chunk)
-                    chunk = fp.read(2048)
-            self._md5 = h.hexdigest()
+            self._storeHash('_md5', _fileMd5(self.path))
         return self._md5
 
 
@@ -397,27 +924,104 @@ class File(FSObject):
             size = self.size
 
             # for small files, just use the md5 of the whole file
-            if size < 2**19:
-                self._fasthash = self.md5()
-
-            # for larger files, hash some bits at the beginning, some bits
-            # at the end, and the size of the file. that gives reasonable results.
+            if size < _FASTHASH_FULL_SIZE:
+                self._storeHash('_fasthash', self.md5())
             else:
-                h = hashlib.md5()
-                with open(self.path, 'rb') as fp:
-                    fp.seek(1024 * 8)
-                    h.update(fp.read(2048))
-                    fp.seek(-4096, 2) # 4k before the end of the file
-                    h.update(fp.read(2048))
-
-                # factor in the filesize so that very similar files can still be
-                # easily distinguished
-                h.update(str(size).encode())
-                self._fasthash = h.hexdigest()
+                self._storeHash('_fasthash', _fileFasthash(self.path, size))
 
         return self._fasthash
 
 
+    async def acrc(self, refresh=False):
+        """
+        Awaitable version of ``crc()``, which reads the file on the thread pool of the root
+        directory so that the event loop keeps running
+        """
+        return await self._ahash("crc", refresh)
+
+
+    async def amd5(self, refresh=False):
+        """
+        Awaitable version of ``md5()``, see ``acrc()``
+        """
+        return await self._ahash("md5", refresh)
+
+
+    async def afasthash(self, refresh=False):
+        """
+        Awaitable version of ``fasthash()``, see ``acrc()``
+        """
+        return await self._ahash("fasthash", refresh)
+
+
+    async def _ahash(self, kind, refresh):
+        """
+        Does the actual work for ``acrc()``, ``amd5()`` and ``afasthash()``
+        """
+        attr = "_" + kind
+        if refresh or getattr(self, attr) is None:
+            signature, value = await self._runBlocking(_hashFile, kind, self.path)
+            self._storeHashResult(kind, signature, value)
+        return getattr(self, attr)
+
+
+    def _storeHash(self, attr, value):
+        """
+        Stores a newly calculated hash value in the ``attr`` attribute, and marks the file
+        as changed if the value is different from the one that was stored before.
+        """
+        if value != getattr(self, attr):
+            setattr(self, attr, value)
+            self._markDirty()
+
+
+    def _storeHashResult(self, kind, signature, value):
+        """
+        Stores a result of ``_hashFile()`` that was calculated on another thread
+        """
+        self._updateStat(signature)
+        self._storeHash("_" + kind, value)
+        # fasthash is the same as md5 for small files, so store both
+        if kind == "fasthash" and signature[0] < _FASTHASH_FULL_SIZE:
+            self._storeHash('_md5', value)
+
+
+    def mtime(self):
+        """
+        Last modified time as reported by the underlying filesystem, as a datetime object.
+        Uses the modification time recorded when the file was last scanned, synced or hashed
+        if there is one, like ``size``. Otherwise calls ``os.path.getmtime()`` on the file.
+        """
+        if self._mtimeNs is not None:
+            return datetime.fromtimestamp(self._mtimeNs / 1e9)
+        return FSObject.mtime(self)
+
+
+    def _statChanged(self, signature):
+        """
+        Returns True if the stat signature (see ``_statSignature()``) is different from
+        the one that was recorded for this file, or if none was recorded yet.
+        """
+        return signature != (self._size, self._mtimeNs, self._inode, self._device)
+
+
+    def _updateStat(self, signature):
+        """
+        Records the stat signature (see ``_statSignature()``) of this file. If it changed,
+        the cached hashes are cleared, since the contents of the file may have changed too.
+        """
+        if self._statChanged(signature):
+            oldSize = self._size
+            self._size, self._mtimeNs, self._inode, self._device = signature
+            parent = self.parent
+            if oldSize is not None and oldSize != self._size and parent is not None:
+                parent._addTotals(self._size - oldSize, 0, 0)
+            self._crc = None
+            self._md5 = None
+            self._fasthash = None
+            self._markDirty()
+
+
     def hash(self):
         """
         For files, instead of returning the relative path of the file, return the
@@ -433,16 +1037,28 @@ class Directory(FSObject):
     """
     Object that represents a directory in the filesystem
     """
+    __slots__ = ('_contents', '_order', '_treeBlock', '_fileCount', '_dirCount')
+
     isdir = True
 
     # what fields should be serialized when FSObject.serialize() is called?
-    serializeFields = FSObject.serializeFields + ('_contents',)
+    serializeFields = FSObject.serializeFields + ('_fileCount', '_dirCount', '_contents')
 
     def __init__(self, path, parent=None):
         FSObject.__init__(self, path, parent)
         self._contents = None
         self._order = None
 
+        # the total size and the number of files and directories inside this directory
+        # (recursively) are kept up to date as the tree changes once they are calculated.
+        # If they are known for a directory, they are also known for every subdirectory.
+        self._fileCount = None
+        self._dirCount = None
+
+        # the location of this directory's contents in a binary tree cache file, if
+        # it hasn't changed since the tree cache was last loaded or saved
+        self._treeBlock = None
+
 
     @classmethod
     def deserialize(cls, attrs):
@@ -452,26 +1068,155 @@ class Directory(FSObject):
         """
         inst = super(Directory, cls).deserialize(attrs)
         inst._order = None
+        inst._treeBlock = None
+        if '_fileCount' not in attrs:
+            # older tree caches counted the size of subdirectories twice
+            inst._size = inst._fileCount = inst._dirCount = None
         if inst._contents is not None:
             for key in inst._contents.keys():
                 inst._contents[key].parent = inst
         return inst
 
 
+    @classmethod
+    def _deserializeRecord(cls, fields, values):
+        """
+        Same as ``deserialize()``, but takes the attribute names and values as two
+        sequences instead of a dict. The contents of the directory are not part of
+        the record, so ``_contents`` must be set by the caller.
+        """
+        inst = super(Directory, cls)._deserializeRecord(fields, values)
+        inst._contents = None
+        inst._order = None
+        inst._treeBlock = None
+        if '_fileCount' not in fields:
+            # older tree caches counted the size of subdirectories twice
+            inst._size = inst._fileCount = inst._dirCount = None
+        return inst
+
+
     @property
     def size(self):
         """
-        For directories, recursively calculate the size of the contents of the directory.
-        This value is lazily evaluated and cached.
+        For directories, the total size of all files inside the directory, recursively.
+        The first time it is requested for a directory, every file inside that isn't
+        already known is checked. After that the total is kept up to date when files
+        are added, removed or change size, so it is available immediately.
         """
         if self._size is None:
-            total = 0
-            for item in self.all(recursive=True):
-                total += item.size
-            self._size = total
+            self._calculateTotals()
         return self._size
 
 
+    @property
+    def fileCount(self):
+        """
+        The number of files inside this directory, recursively. Kept up to date
+        the same way as ``size``.
+        """
+        if self._fileCount is None:
+            self._calculateTotals()
+        return self._fileCount
+
+
+    @property
+    def dirCount(self):
+        """
+        The number of directories inside this directory, recursively. Kept up to date
+        the same way as ``size``.
+        """
+        if self._dirCount is None:
+            self._calculateTotals()
+        return self._dirCount
+
+
+    def _calculateTotals(self):
+        """
+        Calculates the size, file count and directory count of this directory and every
+        directory inside it whose totals aren't known, from the bottom up
+        """
+        stack = [ (self, False) ]
+        while stack:
+            dirobj, childrenDone = stack.pop()
+            if not childrenDone:
+                stack.append((dirobj, True))
+                for item in dirobj.contents.values():
+                    if item.isdir and item._size is None:
+                        stack.append((item, False))
+                continue
+
+            size = fileCount = dirCount = 0
+            for item in dirobj._contents.values():
+                if item.isdir:
+                    size += item._size
+                    fileCount += item._fileCount
+                    dirCount += item._dirCount + 1
+                else:
+                    size += item.size
+                    fileCount += 1
+            dirobj._size, dirobj._fileCount, dirobj._dirCount = size, fileCount, dirCount
+
+            # the totals are saved in the tree cache along with the sizes of the files
+            dirobj._treeBlock = None
+
+        self._markDirty()
+
+
+    def _addTotals(self, size, fileCount, dirCount):
+        """
+        Adds to the size, file count and directory count of this directory and each of its
+        parents whose totals are known
+        """
+        obj = self
+        while obj is not None and obj._size is not None:
+            obj._size += size
+            obj._fileCount += fileCount
+            obj._dirCount += dirCount
+            obj = obj.parent
+        if obj is not self:
+            self._markDirty()
+
+
+    def _clearTotals(self):
+        """
+        Forgets the totals of this directory, which means its parents' totals have to be
+        calculated again too. They only need to look at their direct contents to do that.
+        """
+        obj = self
+        while obj is not None and obj._size is not None:
+            obj._size = obj._fileCount = obj._dirCount = None
+            obj = obj.parent
+        if obj is not self:
+            self._markDirty()
+
+
+    def _updateTotals(self, item, sign):
+        """
+        Adds (``sign`` = 1) or subtracts (``sign`` = -1) the totals of ``item`` to or from
+        the totals of this directory and its parents when ``item`` is added or removed
+        """
+        if self._size is None:
+            return
+
+        if item.isdir:
+            if item._size is None:
+                self._clearTotals()
+            else:
+                self._addTotals(sign * item._size, sign * item._fileCount, sign * (item._dirCount + 1))
+            return
+
+        size = item._size
+        if size is None and sign > 0:
+            try:
+                size = item.size
+            except OSError:
+                pass
+        if size is None:
+            self._clearTotals()
+        else:
+            self._addTotals(sign * size, sign, 0)
+
+
     @property
     def contents(self):
         """
@@ -479,12 +1224,15 @@ class Directory(FSObject):
         been refreshed yet, accessing this property will trigger a ``refresh(recursive=False)``
         before returning the dict.
 
+        If the contents of this directory are available in a tree cache that was loaded
+        lazily, they are loaded from the cache instead of refreshing the directory.
+
         If you have code accessing a single specific file or directory object in an inner
         loop, a small optimization could be calling ``directory.contents[filename]``
         instead of ``directory[filename]``, due to the number of overloads in
         ``Directory.__getitem__``.
         """
-        if self._contents is None:
+        if self._contents is None and not self._loadCachedContents():
             self.refresh(recursive=False)
         return self._contents
 
@@ -499,7 +1247,7 @@ class Directory(FSObject):
         has never been run on this directory.
         """
         if self._order is None:
-            if self._contents is None:
+            if self._contents is None and not self._loadCachedContents():
                 self.refresh(recursive=False)
             else:
                 self._order = self.root._orderDirectory(self._contents)
@@ -513,16 +1261,85 @@ class Directory(FSObject):
         all files.
 
         If ``recursive=True`` is passed in, then ``refresh()`` will also be called on all subdirectories.
+
+        If ``workers=N`` is passed in along with ``recursive=True``, then directory listings are
+        read on a pool of ``N`` threads so that sibling subdirectories are listed concurrently.
+        This is mostly useful on network filesystems, where most of the time spent refreshing is
+        spent waiting on directory reads. The resulting tree and the order of the
+        ``_directoryRefresh()`` and ``_fileRefresh()`` callbacks are the same as a serial refresh.
         """
-        # extract the recursive argument from kwargs
+        # extract the recursive and workers arguments from kwargs
         recursive = False
         if 'recursive' in kwargs:
             recursive = kwargs['recursive']
+        workers = None
+        if 'workers' in kwargs:
+            workers = kwargs['workers']
+
+        if recursive and workers:
+            lister = _ParallelLister(self.root, workers)
+            try:
+                self._refresh(files, recursive, lister)
+            finally:
+                lister.shutdown()
+        else:
+            self._refresh(files, recursive, None)
+
+
+    async def arefresh(self, *files, recursive=False):
+        """
+        Awaitable version of ``refresh()``. The directory listings and stat calls are made on
+        the thread pool of the root directory, so the event loop keeps running while a large
+        tree is scanned. The FSObjects are created by the event loop thread, one directory at a
+        time. A recursive refresh reads the listings of several directories at once, and goes
+        through the tree breadth-first, so the ``_directoryRefresh()`` and ``_fileRefresh()``
+        callbacks are called in a different order than with ``refresh()``.
+        """
+        if len(files) > 0:
+            path = self.path
+            listings = await self._runBlocking(
+                lambda: [ _pathListing(name, os.path.join(path, name)) for name in files ])
+            self._refresh(listings, False, None)
+            return
+
+        # keep up to twice as many listings queued up as there are threads to read them
+        limit = 2 * getattr(self.root, 'asyncWorkers', 4)
+        queue = deque([ self ])
+        running = deque()
+        try:
+            while queue or running:
+                while queue and len(running) < limit:
+                    dirobj = queue.popleft()
+                    listing = dirobj._runBlocking(lambda path: list(dirlisting(path)), dirobj.path)
+                    running.append((dirobj, asyncio.ensure_future(listing)))
+
+                dirobj, listing = running.popleft()
+                dirobj._refresh((), False, { dirobj.path: await listing })
+                if recursive:
+                    queue.extend(item for item in dirobj._contents.values() if item.isdir)
+        finally:
+            # if a listing failed, the ones that were read ahead aren't needed anymore
+            for dirobj, listing in running:
+                listing.cancel()
+                if listing.done() and not listing.cancelled():
+                    listing.exception()
+
 
+    def _refresh(self, files, recursive, lister):
+        """
+        Does the actual work for ``refresh()``. If ``lister`` is not None, directory listings
+        are retrieved with ``lister.get(path)`` instead of calling ``dirlisting()`` directly.
+        ``files`` can also contain listings that were already made with ``_pathListing()``.
+        """
         # if no files are specified, then we're going to rescan all files. clearing
         # the dict will have the result of removing any files that no longer exist.
+        oldContents = None
         if len(files) == 0:
-            files = dirlisting(self.path)
+            if lister is not None:
+                files = lister.get(self.path)
+            else:
+                files = dirlisting(self.path)
+            oldContents = self._contents
             self._contents = {}
 
             # because we cleared the _contents dict anyway, theres no need to check
@@ -531,27 +1348,34 @@ class Directory(FSObject):
 
         else:
             # make sure the contents dict exists in case this is the first refresh called
-            if self._contents is None:
+            if self._contents is None and not self._loadCachedContents():
                 self._contents = {}
 
             # set up the files array to match the output format of dirlisting()
-            f = []
-            for item in files:
-                itemPath = os.path.join(self.path, item)
-                if os.path.exists(itemPath):
-                    f.append( (item, os.path.isdir(itemPath), os.path.isfile(itemPath) ) )
-                else:
-                    f.append( (item, False, False) )
-            files = f
+            files = [ item if isinstance(item, tuple) else _pathListing(item, os.path.join(self.path, item))
+                for item in files ]
 
             # if we're scanning specific files, we'll need to check if those files
             # still exist.
             checkRemoved = True
 
-        # clear the directory size cache so that it will be recalculated next time it's requested
-        self._size = None
+        # every item is replaced by a full refresh, so the totals have to be calculated again.
+        # a refresh of specific files adjusts them for each file instead.
+        if not checkRemoved:
+            self._clearTotals()
+
+        # the contents are about to change, so they need to be saved again
+        self._markDirty()
 
-        for filename, isdir, isfile in files:
+        # keep the name index up to date with the new contents
+        index = self._getNameIndex()
+        pathIndex = self._getPathIndex()
+        if index is not None or pathIndex is not None:
+            relpath = self.relpath
+        if index is not None and not checkRemoved:
+            index.pending.discard(relpath)
+
+        for filename, isdir, isfile, signature in files:
             fullPath = os.path.join(self.path, filename)
 
             # should we skip this file?
@@ -564,64 +1388,218 @@ class Directory(FSObject):
                 if not isdir and not isfile and filename in self._contents:
                     # callback on deletions
                     self.root._pathDelete(self._contents[filename])
+                    self._updateTotals(self._contents[filename], -1)
+                    if pathIndex is not None:
+                        _updatePathIndex(pathIndex, self._contents[filename], _joinRelpath(relpath, filename), None)
                     del self._contents[filename]
+                    self._orderRemoved(filename, reorder=False)
+                    if index is not None:
+                        index.remove(_joinRelpath(relpath, filename), filename)
                     continue
 
+            # the item is replaced if it's already in the directory
+            oldItem = self._contents.get(filename) if checkRemoved else None
+
             # create a new directory object
             if isdir:
                 DirClass = self.root._getDirectoryClass(fullPath)
                 item = DirClass(fullPath, parent=self)
                 self._contents[filename] = item
+                if pathIndex is not None:
+                    # the contents are added to the index when the directory is refreshed
+                    pathIndex[_joinRelpath(relpath, filename)] = item
 
                 # callback on directory scans
                 self.root._directoryRefresh(item)
 
                 if recursive:
-                    self._contents[filename].refresh(recursive=recursive)
+                    if lister is None:
+                        item.refresh(recursive=recursive)
+                    else:
+                        item._refresh((), recursive, lister)
+
+                if index is not None:
+                    itemRelpath = _joinRelpath(relpath, filename)
+                    index.add(itemRelpath, filename)
+                    # directories that weren't refreshed recursively still need their contents indexed
+                    if item._contents is None:
+                        index.pending.add(itemRelpath)
 
             # create a new file object
             elif isfile:
                 FileClass = self.root._getFileClass(fullPath)
                 item = FileClass(fullPath, parent=self)
+                if signature is not None:
+                    item._size, item._mtimeNs, item._inode, item._device = signature
                 self._contents[filename] = item
+                if pathIndex is not None:
+                    pathIndex[_joinRelpath(relpath, filename)] = item
 
                 # callback on file scans
                 self.root._fileRefresh(item)
 
-        # recalculate ordering
-        self._order = self.root._orderDirectory(self._contents)
+                if index is not None:
+                    index.add(_joinRelpath(relpath, filename), filename)
+
+            else:
+                continue
+
+            if checkRemoved:
+                if oldItem is not None:
+                    self._updateTotals(oldItem, -1)
+                    # anything that was inside the replaced item is gone from the index too
+                    if pathIndex is not None:
+                        _updatePathIndex(pathIndex, oldItem, _joinRelpath(relpath, filename), None)
+                else:
+                    self._orderAdded(filename, reorder=False)
+                self._updateTotals(item, 1)
+
+        # remove the items that disappeared since the last full refresh
+        if index is not None and oldContents is not None:
+            for filename in oldContents:
+                if filename not in self._contents:
+                    index.remove(_joinRelpath(relpath, filename), filename)
+
+        # every old item was replaced, so none of them can stay in the path index
+        if pathIndex is not None and oldContents is not None:
+            for filename, oldItem in oldContents.items():
+                _updatePathIndex(pathIndex, oldItem, _joinRelpath(relpath, filename), None)
+
+        # recalculate ordering, unless only a few files were refreshed and the order was
+        # already updated for each of them
+        if not checkRemoved or self._order is None or not self.root._isDefaultOrder():
+            self._order = self.root._orderDirectory(self._contents)
 
 
-    def sync(self, recursive=False, onAdded=None, onDeleted=None, onModified=None, onRenamed=None):
+    def sync(self, recursive=False, onAdded=None, onDeleted=None, onModified=None, onRenamed=None,
+            onMoved=None, detectMoves=False):
         """
         Rescans the filesystem and adds new files to the index for this directory, as well as
         removing files from the index if they no longer exist.
 
+        Files are only read again to check if they were modified if their size, modification
+        time, inode or device changed since they were last hashed.
+
         If ``recursive`` is set to ``True``, then ``sync()`` will also be called on all subdirectories.
+
+        If ``detectMoves`` is True, files that were moved to another directory are found as
+        well. The removals and additions in the whole tree are collected first, and then new
+        files are matched with the files that disappeared by their inode, modification time
+        and size, or failing that, by their size and fasthash. Moved files keep their
+        ``File`` objects (including any cached hashes), and are reported to ``onMoved`` with
+        the old relative path and the file, instead of to ``onDeleted`` and ``onAdded``.
+        Directories that were moved are still reported as deleted and added.
         """
-        # were any changes were made in this sync operation?
-        dirChanged = False
+        if not detectMoves:
+            return self._sync(recursive, onAdded, onDeleted, onModified, onRenamed, None)
 
-        # get the current directory listing and store the data in a dict so we can reference it easily
-        currentContents = { name: (name, isdir, isfile) for name, isdir, isfile in dirlisting(self.path) }
+        moves = _SyncMoves()
+        dirChanged = self._sync(recursive, onAdded, onDeleted, onModified, onRenamed, moves)
+        moves.finish(self.root, onAdded, onDeleted, onMoved)
+        return dirChanged
 
-        # an index of all current files with their fasthash as the dict key
-        fasthashIndex = {}
-        for item in self._contents.values():
-            if not item.isdir and item._fasthash is not None:
-                fasthashIndex[item._fasthash] = item
 
-        # iterate over the current index contents (before adding new files/dirs)
-        for name, item in self._contents.items():
+    async def asyncSync(self, recursive=False, onAdded=None, onDeleted=None, onModified=None, onRenamed=None,
+            onMoved=None, detectMoves=False):
+        """
+        Awaitable version of ``sync()`` (``async`` is a reserved word). The directory listings
+        are read, and the files that are new or changed are hashed, on the thread pool of the
+        root directory, so the event loop keeps running. The tree is updated by the event loop
+        thread, one directory at a time. Matching moved files with ``detectMoves=True`` may
+        still have to hash a few files that are in new directories on the event loop thread.
+        """
+        moves = _SyncMoves() if detectMoves else None
+        dirChanged = False
+        queue = deque([ self ])
+        while queue:
+            dirobj = queue.popleft()
+            path = dirobj.path
+            listing = await dirobj._runBlocking(lambda: list(dirlisting(path)))
+
+            # hash the files that sync would read, all at once
+            dirobj._loadCachedContents()
+            contents = dirobj._contents or {}
+            names = []
+            for name, isdir, isfile, signature in listing:
+                if not isfile or signature is None:
+                    continue
+                item = contents.get(name)
+                if item is None:
+                    if not self.root._ignorePath(name, os.path.join(path, name), isdir):
+                        names.append(name)
+                elif not item.isdir and (item._fasthash is None or item._statChanged(signature)):
+                    names.append(name)
+            results = await asyncio.gather(*[ dirobj._runBlocking(_hashFile, "fasthash", os.path.join(path, name))
+                for name in names ], return_exceptions=True)
+            # files that couldn't be read are left to _sync(), which raises the error
+            hashes = { name: result for name, result in zip(names, results) if not isinstance(result, Exception) }
+
+            if dirobj._sync(False, onAdded, onDeleted, onModified, onRenamed, moves, (listing, hashes)):
+                dirChanged = True
+
+            if recursive:
+                existing = set(entry[0] for entry in listing)
+                queue.extend(item for item in dirobj._contents.values() if item.isdir and item.name in existing)
+
+        if moves is not None:
+            moves.finish(self.root, onAdded, onDeleted, onMoved)
+        return dirChanged
+
+
+    def _sync(self, recursive, onAdded, onDeleted, onModified, onRenamed, moves, prefetched=None):
+        """
+        Does the actual work for ``sync()``. If ``moves`` is not None, the changes that could
+        be moves are collected in it (see ``_SyncMoves``) instead of being made right away.
+        ``prefetched`` is either None, or a 2-tuple of the directory listing and a dict of
+        file names to ``_hashFile()`` results that were read ahead by ``asyncSync()``.
+        """
+        # were any changes were made in this sync operation?
+        dirChanged = False
+
+        # make sure the contents are available if they are only in the tree cache so far.
+        # a directory that was never refreshed is empty as far as the index is concerned.
+        if not self._loadCachedContents():
+            self._contents = {}
+
+        # get the current directory listing and store the data in a dict so we can reference it easily
+        if prefetched is None:
+            currentContents = { listing[0]: listing for listing in dirlisting(self.path) }
+            hashes = {}
+        else:
+            currentContents = { listing[0]: listing for listing in prefetched[0] }
+            hashes = prefetched[1]
+
+        def fasthash(item):
+            # use the hash that was read ahead if the file didn't change since then
+            hashed = hashes.get(item.name)
+            if hashed is not None and not item._statChanged(hashed[0]):
+                item._storeHashResult("fasthash", *hashed)
+            return item.fasthash()
+
+        # an index of all current files with their fasthash as the dict key
+        fasthashIndex = {}
+        for item in self._contents.values():
+            if not item.isdir and item._fasthash is not None:
+                fasthashIndex[item._fasthash] = item
+
+        # iterate over the current index contents (before adding new files/dirs)
+        for name, item in self._contents.items():
             if item.isdir or item.name not in currentContents:
                 continue
 
             # need to check if the fasthash value changed, so keep the old one
-            origFasthash = self._contents[name]._fasthash
-
-            # intentionally refresh the fasthash value on all files because we need them refreshed
-            # to scan for renamed files in the next step anyway
-            newFasthash = self._contents[name].fasthash(refresh=True)
+            origFasthash = item._fasthash
+
+            # only files that changed on disk since they were last hashed need to be read again.
+            # the fasthash values are needed to scan for renamed files in the next step anyway.
+            signature = currentContents[name][3]
+            if signature is None:
+                signature = _statSignature(os.stat(item.path))
+            if origFasthash is None or item._statChanged(signature):
+                item._updateStat(signature)
+                newFasthash = fasthash(item)
+            else:
+                newFasthash = origFasthash
 
             # update the fasthashIndex
             if origFasthash is not None:
@@ -637,7 +1615,7 @@ class Directory(FSObject):
                     onModified(item)
 
         # scan for new files
-        for name, isdir, isfile in currentContents.values():
+        for name, isdir, isfile, signature in currentContents.values():
             fullPath = os.path.join(self.path, name)
 
             # should we skip this file?
@@ -653,6 +1631,8 @@ class Directory(FSObject):
                     DirClass = self.root._getDirectoryClass(fullPath)
                     newDir = DirClass(fullPath, parent=self)
                     self._push(newDir, reorder=False)
+                    if moves is not None:
+                        moves.addedDirs.append(newDir)
 
                     if onAdded is not None:
                         onAdded(newDir)
@@ -664,23 +1644,30 @@ class Directory(FSObject):
                     # create a new file object
                     FileClass = self.root._getFileClass(fullPath)
                     newFile = FileClass(fullPath)
+                    newFile._updateStat(signature or _statSignature(os.stat(fullPath)))
 
                     # first find out if this file is just renamed and not new
-                    newFileFasthash = newFile.fasthash(refresh=True)
+                    newFileFasthash = fasthash(newFile)
 
                     if newFileFasthash in fasthashIndex:
                         # grab the old file object and delete it from the index
                         origFile = fasthashIndex[newFileFasthash]
                         origFilename = origFile.name
+                        origFile._updateStat((newFile._size, newFile._mtimeNs, newFile._inode, newFile._device))
                         self._pop(origFile)
                         # rename the file object and push it back into the index
                         origFile.name = name
+                        origFile._fasthash = newFileFasthash
                         self._push(origFile, reorder=False)
                         self.root._fileRefresh(origFile)
 
                         if onRenamed is not None:
                             onRenamed(origFilename, newFile)
 
+                    elif moves is not None:
+                        # this file may have been moved here from another directory
+                        moves.added.append((self, newFile))
+
                     else:
                         # this must be a new file, so just push it as-is into the index
                         self._push(newFile, reorder=False)
@@ -695,6 +1682,11 @@ class Directory(FSObject):
         for name in [ name for name in self._contents.keys() if name not in currentContents ]:
             dirChanged = True
 
+            if moves is not None:
+                # this may have been moved somewhere else, which is only known at the end
+                moves.removed.append(self._contents[name])
+                continue
+
             if onDeleted is not None:
                 onDeleted(self._contents[name])
 
@@ -707,19 +1699,21 @@ class Directory(FSObject):
         # now sync recursively if needed
         if recursive:
             for item in self._contents.values():
-                if item.isdir:
-                    subdirChanged = item.sync(recursive=recursive, onAdded=onAdded, onDeleted=onDeleted,
-                        onModified=onModified, onRenamed=onRenamed)
+                # directories that disappeared are still in the contents if moves are detected
+                if item.isdir and item.name in currentContents:
+                    subdirChanged = item._sync(recursive, onAdded, onDeleted, onModified, onRenamed, moves)
                     if subdirChanged:
                         dirChanged = True
 
-        # only need to recalculate size and order if something actually changed
+        # only need to recalculate the order if something actually changed. the totals
+        # were adjusted for each change already.
         if dirChanged:
-            # clear the directory size cache so that it will be recalculated next time it's requested
-            self._size = None
+            # the contents changed, so they need to be saved again
+            self._markDirty()
 
-            # recalculate ordering
-            self._order = self.root._orderDirectory(self._contents)
+            # recalculate ordering, unless it was already updated for each change
+            if not self.root._isDefaultOrder():
+                self._order = self.root._orderDirectory(self._contents)
 
         # return a bool indicating if anything was changed
         return dirChanged
@@ -743,15 +1737,13 @@ class Directory(FSObject):
             # fnmatch() uses case-sensitive searching on case-sensitive filesystems,
             # so we have to lowercase everything ourselves
             pattern = pattern.lower()
-            for item in self.all(recursive=recursive, dirs=dirs, files=files):
-                if fnmatch.fnmatch(item.name.lower(), pattern):
-                    yield item
+            match = lambda item: fnmatch.fnmatch(item.name.lower(), pattern)
 
         # use fnmatch.fnmatchcase for case-sensitive searching regardless of OS
         else:
-            for item in self.all(recursive=recursive, dirs=dirs, files=files):
-                if fnmatch.fnmatchcase(item.name, pattern):
-                    yield item
+            match = lambda item: fnmatch.fnmatchcase(item.name, pattern)
+
+        return self._matchNames(match, _globLiterals(pattern), recursive, dirs, files)
 
 
     def search(self, regex, recursive=False, dirs=True, files=True, flags=re.IGNORECASE):
@@ -768,9 +1760,35 @@ class Directory(FSObject):
         ``directory.search(r'(.*)\.txt')``
         """
         check = re.compile(regex, flags=flags)
-        for item in self.all(recursive=recursive, dirs=dirs, files=files):
-            if check.search(item.name):
-                yield item
+        match = lambda item: check.search(item.name)
+        return self._matchNames(match, _regexLiterals(regex, flags), recursive, dirs, files)
+
+
+    def _matchNames(self, match, literals, recursive, dirs, files):
+        """
+        Generator used by ``filter()`` and ``search()`` that yields every item for which
+        ``match(item)`` is True. ``literals`` is a list of strings that are part of the name
+        of every item that can match, or None if they are not known.
+
+        Recursive searches use the name index of the root directory to find the items that
+        contain those strings if there is one (see ``RootDirectory.createNameIndex()``).
+        Otherwise every item is checked.
+        """
+        candidates = None
+        if recursive and literals and self._getNameIndex() is not None:
+            candidates = self.root._nameIndexCandidates(literals, self)
+
+        if candidates is None:
+            for item in self.all(recursive=recursive, dirs=dirs, files=files):
+                if match(item):
+                    yield item
+
+        else:
+            if dirs == False and files == False:
+                raise ValueError("If both dirs and files are both False, no results will ever be generated.")
+            for item in candidates:
+                if (dirs if item.isdir else files) and match(item):
+                    yield item
 
 
     def query(self, query, recursive=False, dirs=True, files=True):
@@ -801,13 +1819,256 @@ class Directory(FSObject):
 
         All directories that contain a file called "asdf.txt":
             >>> directory.query(lambda d: "asdf.txt" in d, recursive=True, files=False)
+
+        ``query`` can also be a query string (see ``parseQuery()``) or a parsed query. Those
+        are run by a planner, which uses the name and metadata indexes of the root directory
+        if there are any, checks the cheapest conditions first, and skips directories that
+        can't contain any results. Results found with an index are yielded in the order of
+        their relative paths.
+
+        All files larger than 1MB by "John Smith" from 2000 or later:
+            >>> directory.query('size > 1MB and author == "John Smith" and year >= 2000', recursive=True)
+
+        All flac files with "live" in their name:
+            >>> directory.query('ext == "flac" and name ~ "*live*"', recursive=True)
+        """
+        if isinstance(query, str):
+            query = parseQuery(query)
+        if isinstance(query, QueryNode):
+            return self._runQuery(query, recursive, dirs, files)
+        return self._queryFunction(query, recursive, dirs, files)
+
+
+    def _queryFunction(self, query, recursive, dirs, files):
+        """
+        Generator used by ``query()`` for query functions
         """
         for item in self.all(recursive=recursive, dirs=dirs, files=files):
             if query(item):
                 yield item
 
 
-    def all(self, recursive=False, reverse=False, dirs=True, files=True):
+    def _runQuery(self, query, recursive, dirs, files):
+        """
+        Generator used by ``query()`` to run a parsed query
+        """
+        if dirs == False and files == False:
+            raise ValueError("If both dirs and files are both False, no results will ever be generated.")
+
+        query = query.optimize()
+
+        candidates = None
+        if recursive and hasattr(self.root, '_queryCandidates'):
+            candidates = self.root._queryCandidates(query, self)
+
+        if candidates is None:
+            items = self._queryWalk(recursive, query.pruneDirectory)
+        else:
+            items = candidates
+
+        for item in items:
+            if (dirs if item.isdir else files) and query.evaluate(item):
+                yield item
+
+
+    def _queryWalk(self, recursive, prune):
+        """
+        Generator that yields everything in this directory like ``all()``, but doesn't go into
+        subdirectories for which ``prune(directory)`` returns True.
+        """
+        return self._walk(recursive, False, True, True, "pre", prune)
+
+
+    def hashAll(self, kind="fasthash", workers=4, recursive=True, refresh=False, processes=False,
+            onProgress=None, onError=None):
+        """
+        Calculates the same value as ``File.crc()``, ``File.md5()`` or ``File.fasthash()``
+        (depending on whether ``kind`` is "crc", "md5" or "fasthash") for every file in this
+        directory, reading up to ``workers`` files at once. Files that already have a cached
+        value are skipped unless ``refresh`` is True. Returns the number of files that were hashed.
+
+        Files are hashed on a pool of threads, or a pool of processes if ``processes`` is True.
+        The pool only reads the files - results are stored on the ``File`` objects by the
+        calling thread as they come in, so none of the FSObjects are touched by other threads.
+
+        * ``recursive`` is passed to ``Directory.all()``.
+        * ``onProgress``, if given, is called after every file with three arguments: the file,
+          the number of files processed so far, and the total number of files to hash.
+        * ``onError``, if given, is called with the file and the exception if a file can't be
+          read (for example, because it was deleted). Otherwise the exception is raised.
+        """
+        if kind not in ("crc", "md5", "fasthash"):
+            raise ValueError("Unknown hash kind '%s'" % kind)
+        attr = "_" + kind
+
+        items = [ item for item in self.all(recursive=recursive, dirs=False)
+            if refresh or getattr(item, attr) is None ]
+        return self._hashFiles(items, kind, workers, processes, onProgress, onError)
+
+
+    async def ahashAll(self, kind="fasthash", recursive=True, refresh=False, onProgress=None, onError=None):
+        """
+        Awaitable version of ``hashAll()``, which reads the files on the thread pool of the
+        root directory (see ``RootDirectory.asyncWorkers``). Files that weren't scanned yet
+        are found with ``aall()``.
+        """
+        if kind not in ("crc", "md5", "fasthash"):
+            raise ValueError("Unknown hash kind '%s'" % kind)
+        attr = "_" + kind
+
+        items = [ item async for item in self.aall(recursive=recursive, dirs=False)
+            if refresh or getattr(item, attr) is None ]
+        total = len(items)
+        itemIter = iter(items)
+
+        # like hashAll(), only a few files per thread are queued up at once
+        pending = {}
+        def submitNext():
+            item = next(itemIter, None)
+            if item is not None:
+                pending[asyncio.ensure_future(item._runBlocking(_hashFile, kind, item.path))] = item
+
+        for i in range(2 * getattr(self.root, 'asyncWorkers', 4)):
+            submitNext()
+
+        count = 0
+        hashed = 0
+        while len(pending) > 0:
+            finished, notFinished = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in finished:
+                item = pending.pop(future)
+                try:
+                    signature, value = future.result()
+                except OSError as e:
+                    if onError is None:
+                        for future in pending:
+                            future.cancel()
+                        raise
+                    onError(item, e)
+                else:
+                    hashed += 1
+                    item._storeHashResult(kind, signature, value)
+
+                count += 1
+                if onProgress is not None:
+                    onProgress(item, count, total)
+                submitNext()
+
+        return hashed
+
+
+    def _hashFiles(self, items, kind, workers, processes, onProgress, onError):
+        """
+        Does the actual work for ``hashAll()``, hashing each file in the list ``items``
+        """
+        total = len(items)
+        itemIter = iter(items)
+
+        # only keep a few files per worker queued up, so large trees don't create
+        # millions of futures at once
+        pending = {}
+        def submitNext(pool):
+            item = next(itemIter, None)
+            if item is not None:
+                pending[pool.submit(_hashFile, kind, item.path)] = item
+
+        Pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        count = 0
+        hashed = 0
+        with Pool(max_workers=workers) as pool:
+            for i in range(workers * 4):
+                submitNext(pool)
+
+            while len(pending) > 0:
+                finished, notFinished = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    item = pending.pop(future)
+                    try:
+                        signature, value = future.result()
+                    except OSError as e:
+                        if onError is None:
+                            raise
+                        onError(item, e)
+                    else:
+                        hashed += 1
+                        item._storeHashResult(kind, signature, value)
+
+                    count += 1
+                    if onProgress is not None:
+                        onProgress(item, count, total)
+                    submitNext(pool)
+
+        return hashed
+
+
+    def findDuplicates(self, recursive=True, minSize=1, workers=4, processes=False, onError=None):
+        """
+        Finds the files in this directory that have identical contents. Returns a list of
+        groups of duplicates, each of which is a list of at least two files sorted by their
+        relative paths. The groups are sorted by the relative path of their first file.
+
+        Files are compared in steps, so that as little as possible has to be read:
+
+        #. Files are grouped by size, which is already known from the last scan. Files
+           with a size that no other file has can't have a duplicate, so they're never read.
+        #. The fasthash of the files in each group is calculated, which only reads a few KB
+           of large files (see ``File.fasthash()``). Cached values are used if there are any.
+        #. Files larger than ``_FASTHASH_FULL_SIZE`` that still share a size and fasthash
+           are confirmed with a full MD5 sum. For smaller files, the fasthash already is one.
+
+        * ``recursive`` is passed to ``Directory.all()``.
+        * Files smaller than ``minSize`` bytes are skipped. By default, that's only empty files.
+        * ``workers`` and ``processes`` are passed to ``hashAll()`` for the hashing steps.
+        * ``onError``, if given, is called with the file and the exception if a file can't be
+          read, and the file is left out. Otherwise the exception is raised.
+        """
+        bySize = {}
+        for item in self.all(recursive=recursive, dirs=False):
+            size = item.size
+            if size >= minSize:
+                bySize.setdefault(size, []).append(item)
+        candidates = [ item for group in bySize.values() if len(group) > 1 for item in group ]
+
+        failed = set()
+        def hashError(item, e):
+            if onError is None:
+                raise e
+            failed.add(item)
+            onError(item, e)
+
+        # hashing a file records its current size too, so files are grouped by both
+        unhashed = [ item for item in candidates if item._fasthash is None ]
+        self._hashFiles(unhashed, "fasthash", workers, processes, None, hashError)
+        byFasthash = {}
+        for item in candidates:
+            if item not in failed and item._size >= minSize:
+                byFasthash.setdefault((item._size, item._fasthash), []).append(item)
+
+        groups = []
+        confirm = []
+        for (size, fasthash), group in byFasthash.items():
+            if len(group) < 2:
+                continue
+            if size < _FASTHASH_FULL_SIZE:
+                groups.append(group)
+            else:
+                confirm.extend(group)
+
+        # large files that look the same need to be read completely to be sure
+        unhashed = [ item for item in confirm if item._md5 is None ]
+        self._hashFiles(unhashed, "md5", workers, processes, None, hashError)
+        byMd5 = {}
+        for item in confirm:
+            if item not in failed:
+                byMd5.setdefault((item._size, item._md5), []).append(item)
+        groups.extend(group for group in byMd5.values() if len(group) > 1)
+
+        groups = [ sorted(group, key=lambda item: item.relpath) for group in groups ]
+        groups.sort(key=lambda group: group[0].relpath)
+        return groups
+
+
+    def all(self, recursive=False, reverse=False, dirs=True, files=True, traversal="pre"):
         """
         A generator that yields all files and subdirectories contained within this directory.
 
@@ -815,27 +2076,150 @@ class Directory(FSObject):
         * If ``reverse`` is True, then it will iterate in reverse order.
         * The ``dirs`` argument indicates whether or not directories should be yielded.
         * The ``files`` argument indicates whether or not files should be yielded.
+        * ``traversal`` sets the order of a recursive walk. "pre" (the default) yields each
+          subdirectory before its contents, "post" yields it after its contents, and "breadth"
+          yields the contents of this directory first, then the contents of its
+          subdirectories, and so on.
         """
         if dirs == False and files == False:
             raise ValueError("If both dirs and files are both False, no results will ever be generated.")
+        if traversal not in ("pre", "post", "breadth"):
+            raise ValueError("Unknown traversal '%s'" % traversal)
 
-        if reverse:
-            ordering = reversed(self.order)
-        else:
-            ordering = self.order
+        return self._walk(recursive, reverse, dirs, files, traversal)
 
-        for key in ordering:
-            item = self.contents[key]
 
-            if dirs and item.isdir:
-                yield item
+    async def aall(self, recursive=False, reverse=False, dirs=True, files=True):
+        """
+        Asynchronous generator version of ``all()`` for ``async for`` loops, which walks the
+        tree in the default pre-order. Directories that weren't refreshed yet are refreshed
+        with ``arefresh()`` before their contents are yielded, instead of blocking the event
+        loop while they're scanned.
+        """
+        if dirs == False and files == False:
+            raise ValueError("If both dirs and files are both False, no results will ever be generated.")
 
-            elif files and not item.isdir:
+        async def ordering(dirobj):
+            if not dirobj._loadCachedContents():
+                await dirobj.arefresh()
+            order = list(dirobj.order)
+            return reversed(order) if reverse else iter(order)
+
+        stack = [ (self, await ordering(self)) ]
+        while stack:
+            dirobj, order = stack[-1]
+            key = next(order, None)
+            if key is None:
+                stack.pop()
+                continue
+            # the tree may change while the caller awaits something
+            item = dirobj._contents.get(key)
+            if item is None:
+                continue
+            if dirs if item.isdir else files:
                 yield item
-
             if recursive and item.isdir:
-                for subitem in item.all(recursive=recursive, reverse=reverse, dirs=dirs, files=files):
-                    yield subitem
+                stack.append((item, await ordering(item)))
+
+
+    def _walk(self, recursive, reverse, dirs, files, traversal, prune=None):
+        """
+        Generator used by ``all()``. Walks the tree with an explicit stack (or queue for a
+        breadth-first walk) instead of nesting a generator for each directory level, so the
+        cost of yielding an item doesn't depend on how deep it is. Subdirectories for which
+        ``prune(directory)`` returns True are yielded but not walked.
+        """
+        def ordering(dirobj):
+            # the order is updated in place when the directory changes, so the walk goes
+            # over a copy in case the caller changes the tree while walking it
+            order = list(dirobj.order)
+            return reversed(order) if reverse else iter(order)
+
+        if traversal == "breadth":
+            queue = deque([ self ])
+            while queue:
+                dirobj = queue.popleft()
+                order = ordering(dirobj)
+                contents = dirobj._contents
+                for key in order:
+                    item = contents[key]
+                    if item.isdir:
+                        if dirs:
+                            yield item
+                        if recursive and (prune is None or not prune(item)):
+                            queue.append(item)
+                    elif files:
+                        yield item
+            return
+
+        post = traversal == "post"
+        # each entry is (directory, its contents, iterator over the remaining keys)
+        stack = [ (self, self.contents, ordering(self)) ]
+        while stack:
+            dirobj, contents, order = stack[-1]
+            for key in order:
+                item = contents[key]
+                if item.isdir:
+                    if recursive and (prune is None or not prune(item)):
+                        if dirs and not post:
+                            yield item
+                        order = ordering(item)
+                        stack.append((item, item._contents, order))
+                        break
+                    if dirs:
+                        yield item
+                elif files:
+                    yield item
+            else:
+                stack.pop()
+                if post and dirs and dirobj is not self:
+                    yield dirobj
+
+
+    def _getNameIndex(self):
+        """
+        Returns the name index of the root directory, or None if it doesn't have one
+        """
+        return getattr(self.root, '_nameIndex', None)
+
+
+    def _getPathIndex(self):
+        """
+        Returns the path index of the root directory, or None if it doesn't have one
+        """
+        return getattr(self.root, '_pathIndex', None)
+
+
+    def _markDirty(self):
+        """
+        Marks this directory and all of its parent directories as changed since the directory
+        tree was last saved. Directories that have not changed keep pointing at their existing
+        block in a binary tree cache, so an incremental ``save()`` only has to write out the
+        directories marked here.
+        """
+        # the tree cache is the only copy of the contents of a lazily loaded directory
+        self._loadCachedContents()
+
+        obj = self
+        while obj is not None:
+            obj._treeBlock = None
+            obj = obj.parent
+
+
+    def _loadCachedContents(self):
+        """
+        If the contents of this directory have not been loaded yet but are available in the
+        directory tree cache, loads them from the cache. Returns True if the contents of this
+        directory are available.
+        """
+        if self._contents is None and self._treeBlock is not None:
+            self._contents = self.root._readDirectoryContents(self)
+            pathIndex = self._getPathIndex()
+            if pathIndex is not None and self._contents is not None:
+                relpath = self.relpath
+                for name, item in self._contents.items():
+                    pathIndex[_joinRelpath(relpath, name)] = item
+        return self._contents is not None
 
 
     def _push(self, item, reorder=True):
@@ -847,10 +2231,10 @@ class Directory(FSObject):
         if item.name in self.contents.keys():
             raise FileExistsError(item.name)
         self.contents[item.name] = item
+        self._updateTotals(item, 1)
 
         # reorder directory
-        if reorder:
-            self._order = self.root._orderDirectory(self.contents)
+        self._orderAdded(item.name, reorder)
 
         # set up file to be in this directory
         item.parent = self
@@ -858,6 +2242,25 @@ class Directory(FSObject):
         # clear cached data that is out of date now
         item._relpath = None
         item._abspath = None
+        forgetPaths = getattr(self.root, '_forgetPaths', None)
+        if forgetPaths is not None:
+            forgetPaths(item)
+
+        # marks this directory as changed, as well as the item itself if it's a directory
+        item._markDirty()
+        if item.isdir:
+            self._updateChildPaths(item)
+
+        index = self._getNameIndex()
+        if index is not None:
+            index.add(item.relpath, item.name)
+            # anything inside a directory that was moved here has a new path too
+            if item.isdir:
+                index.pending.add(item.relpath)
+
+        pathIndex = self._getPathIndex()
+        if pathIndex is not None:
+            _updatePathIndex(pathIndex, item, None, item.relpath)
 
 
     def _pop(self, item, reorder=True):
@@ -868,11 +2271,53 @@ class Directory(FSObject):
         """
         if self._contents is not None:
             del self._contents[item.name]
-            if reorder:
-                self._order = self.root._orderDirectory(self._contents)
+            self._updateTotals(item, -1)
+            self._orderRemoved(item.name, reorder)
+            self._markDirty()
+
+            index = self._getNameIndex()
+            if index is not None:
+                index.remove(_joinRelpath(self.relpath, item.name), item.name)
+
+            pathIndex = self._getPathIndex()
+            if pathIndex is not None:
+                _updatePathIndex(pathIndex, item, _joinRelpath(self.relpath, item.name), None)
         return item
 
 
+    def _orderAdded(self, name, reorder=True):
+        """
+        Updates the order after ``name`` was added to the contents. With the default
+        ordering the name is inserted into the sorted order, even if ``reorder`` is False.
+        Otherwise ``_orderDirectory()`` is called again if ``reorder`` is True.
+        """
+        if self._order is None:
+            # the order is calculated when it's needed
+            return
+        if self.root._isDefaultOrder():
+            bisect.insort(self._order, name)
+        elif reorder:
+            self._order = self.root._orderDirectory(self._contents)
+
+
+    def _orderRemoved(self, name, reorder=True):
+        """
+        Updates the order after ``name`` was removed from the contents, like ``_orderAdded()``
+        """
+        if self._order is None:
+            return
+        order = self._order
+        if self.root._isDefaultOrder():
+            i = bisect.bisect_left(order, name)
+            if i < len(order) and order[i] == name:
+                del order[i]
+                return
+            # the order didn't match the contents, so it has to be calculated again
+            reorder = True
+        if reorder:
+            self._order = self.root._orderDirectory(self._contents)
+
+
     def _itemRenamed(self, item, oldName, newName):
         """
         Called by child file or directories when rename is called on them.
@@ -884,152 +2329,1331 @@ class Directory(FSObject):
             del self._contents[oldName]
 
             # recalculate ordering
-            self._order = self.root._orderDirectory(self._contents)
+            self._orderRemoved(oldName)
+            self._orderAdded(newName)
+
+            self._markDirty()
+
+        index = self._getNameIndex()
+        if index is not None:
+            index.remove(_joinRelpath(self.relpath, oldName), oldName)
+            index.add(item.relpath, newName)
+            # entries for the contents of a renamed directory are added before the next search
+            if item.isdir:
+                index.pending.add(item.relpath)
+
+        pathIndex = self._getPathIndex()
+        if pathIndex is not None:
+            _updatePathIndex(pathIndex, item, _joinRelpath(self.relpath, oldName), _joinRelpath(self.relpath, newName))
 
-        # if this is a directory, we need to update the paths of EVERY file inside
         if item.isdir:
-            for f in item.all(recursive=True):
-                f._path = None
-                f._abspath = None
-                f._relpath = None
-                # force the path var to update
-                newPath = f.path
+            item._markDirty()
+            self._updateChildPaths(item)
+
+
+    def _updateChildPaths(self, item):
+        """
+        Called when the directory ``item`` was renamed or moved. Updates the paths of
+        EVERY file inside, unless the paths aren't stored at all.
+        """
+        if getattr(self.root, 'storePaths', True):
+            # only the loaded contents have paths to update - anything else is created with the new paths
+            stack = [ item ]
+            while len(stack) > 0:
+                dirobj = stack.pop()
+                if not dirobj._loadCachedContents():
+                    continue
+                for f in dirobj._contents.values():
+                    f._path = None
+                    f._abspath = None
+                    f._relpath = None
+                    # force the path var to update
+                    newPath = f.path
+                    # the paths are saved in the tree cache, so every directory inside needs to be saved again
+                    if f.isdir:
+                        f._markDirty()
+                        stack.append(f)
+
+
+    def __len__(self):
+        """
+        Return the number of files and directories in this directory
+        """
+        return len(self.contents)
+
+
+    def __iter__(self):
+        for key in list(self.order):
+            yield self.contents[key]
+
+
+    def __contains__(self, key):
+        """
+        Checks if a given file or directory name is contained in this directory
+        """
+        return (key in self.contents)
+
+
+    def __getitem__(self, key):
+        """
+        Directory objects support a number of different indexing methods, all of which
+        either return a single object or a list containing multiple objects, which is
+        useful when you want to assign the results to a variable (as opposed to the
+        searching methods ``filter()``, ``search()``, ``query()``, and ``all()``, which
+        are generators).
+
+        Directories support the following syntaxes for indexing:
+
+        * An ellipsis object returns a list of all children, recursively.
+
+            ``directory[...]``
+                (same as ``list(directory.all(recursive=True))``)
+
+        * An integer, which is treated as an index and returns one item based on the
+          directory ordering. Because the ordering is precalculated, this is O(1).
+          Returns exactly one item.
+
+            ``directory[2]``
+
+        * A slice, which is treated as a range of indices based on the directory ordering.
+
+            ``directory[1:3]``
+
+        * An empty slice, which returns a list of items in the directory.
+
+            ``directory[:]``
+                (same as ``list(directory.all(recursive=False))``)
+
+        * A string key, which is treated as a file or directory name and uses a
+          dict-based lookup for O(1) lookups. Returns exactly one item.
+
+            ``directory["asdf.txt"]``
+
+        * A string which contains either a ``*`` or a ``?``. This string is passed to the
+          Python stdlib library ``fnmatch`` to support searches and returns a list of files
+          or directories that match the pattern. See the documentation for the ``fnmatch``
+          library for more information.
+
+            ``directory["*.txt"]``
+                (same as ``list(directory.filter("*.txt"))``)
+        """
+        # python 3 ellipsis as a shortcut for all files and directories, recursively
+        if key == Ellipsis:
+            return list(self.all(recursive=True))
+
+        # allow indexing by integer using the directory order
+        elif isinstance(key, int):
+            return self.contents[self.order[key]]
+
+        # allow standard slice syntax by passing the slice directly to the ordering list
+        elif isinstance(key, slice):
+            return [ self.contents[item] for item in self.order[key] ]
+
+        # look up the key in the contents dict
+        # this lookup needs to be done BEFORE the filter check just in case there are files
+        # that contain a '*' or '?'
+        elif key in self.contents:
+            return self.contents[key]
+
+        # return the results of a filter so we can support cool search-based keys
+        elif '*' in key or '?' in key:
+            return list(self.filter(key))
+
+        # if none of those previous key syntaxes matched, then raise an exception
+        else:
+            raise KeyError(key)
+
+
+class NameIndex(object):
+    """
+    An index of the names of all files and directories in a ``RootDirectory``, which is used
+    by recursive ``Directory.filter()`` and ``Directory.search()`` calls to find the items whose
+    names contain a string without checking every item in the tree. Created with
+    ``RootDirectory.createNameIndex()``.
+
+    Items are indexed by their relative paths under their lowercase names. All distinct names
+    are also joined into a single string, so that the names containing a string can be found
+    with ``str.find()``. Entries for items that no longer exist are allowed to stay in the
+    index, because every result is looked up in the directory tree before it is used.
+    """
+    # how many names can be added before the joined names are rebuilt
+    maxRecentNames = 10000
+
+    def __init__(self):
+        # lowercase name -> relative path, or a set of relative paths if there is more than one
+        self.names = {}
+
+        # relative paths of directories whose contents still have to be added to the index
+        self.pending = set()
+
+        # all names joined by NUL characters, which can't be part of a filename, and an array
+        # with the position of every name in that string. Built the first time it's needed.
+        self._joinedNames = None
+        self._nameStarts = None
+
+        # names that were added since the joined names were built
+        self._recentNames = set()
+
+        # has the index changed since it was created or loaded?
+        self.changed = False
+
+
+    def add(self, relpath, name):
+        """
+        Adds an item with the name ``name`` and the relative path ``relpath`` to the index
+        """
+        key = name.lower()
+        paths = self.names.get(key)
+        if paths is None:
+            self.names[key] = relpath
+            if self._joinedNames is not None:
+                self._recentNames.add(key)
+                if len(self._recentNames) > self.maxRecentNames:
+                    self._joinedNames = None
+        elif isinstance(paths, set):
+            paths.add(relpath)
+        elif paths != relpath:
+            self.names[key] = {paths, relpath}
+        self.changed = True
+
+
+    def remove(self, relpath, name):
+        """
+        Removes the item with the name ``name`` and the relative path ``relpath`` from the index
+        """
+        key = name.lower()
+        paths = self.names.get(key)
+        if isinstance(paths, set):
+            paths.discard(relpath)
+            if len(paths) == 1:
+                self.names[key] = paths.pop()
+        elif paths == relpath:
+            del self.names[key]
+        self.changed = True
+
+
+    def find(self, literals):
+        """
+        Returns a list of (relative path, lowercase name) tuples for every item whose name contains
+        all of the strings in ``literals``, ignoring case.
+        """
+        literals = [ literal.lower() for literal in literals ]
+        longest = max(literals, key=len)
+
+        if self._joinedNames is None:
+            self._joinNames()
+        joined = self._joinedNames
+        starts = self._nameStarts
+
+        # find the names with the longest literal in them, and check the others afterwards
+        keys = set(key for key in self._recentNames if longest in key)
+        pos = joined.find(longest)
+        while pos != -1:
+            i = bisect.bisect_right(starts, pos) - 1
+            end = starts[i + 1] - 1
+            keys.add(joined[starts[i]:end])
+            pos = joined.find(longest, end + 1)
+
+        results = []
+        for key in keys:
+            paths = self.names.get(key)
+            if paths is None or not all(literal in key for literal in literals):
+                continue
+            if isinstance(paths, set):
+                results.extend((relpath, key) for relpath in paths)
+            else:
+                results.append((paths, key))
+        return results
+
+
+    def _joinNames(self):
+        """
+        Builds the string with all names that is searched by ``find()``
+        """
+        names = list(self.names)
+        self._joinedNames = "\x00".join(names)
+        starts = array.array('q', [0])
+        pos = 0
+        for name in names:
+            pos += len(name) + 1
+            starts.append(pos)
+        self._nameStarts = starts
+        self._recentNames = set()
+
+
+    def serialize(self):
+        """
+        Returns the contents of the index as a tuple that can be written with ``marshal``
+        """
+        if self._joinedNames is None or self._recentNames:
+            self._joinNames()
+        return (self.names, self.pending, self._joinedNames, self._nameStarts.tobytes())
+
+
+    @classmethod
+    def deserialize(cls, data):
+        """
+        Creates an index from the output of ``serialize()``
+        """
+        inst = cls()
+        inst.names, inst.pending, inst._joinedNames, starts = data
+        inst._nameStarts = array.array('q')
+        inst._nameStarts.frombytes(starts)
+        return inst
+
+
+
+# marks a metadata value that didn't exist before or doesn't exist any more
+_MISSING = object()
+
+
+class MetadataDict(dict):
+    """
+    The dict that holds the metadata of a file or directory in a ``RootDirectory``. It
+    informs the root directory about every change, so that the metadata indexes created
+    with ``RootDirectory.createIndex()`` can be kept up to date.
+    """
+    __slots__ = ('_root', '_hash', '_owner')
+
+    def __init__(self, root, fshash, *args):
+        dict.__init__(self, *args)
+        self._root = root
+        self._hash = fshash
+        # the file or directory this metadata was last retrieved for
+        self._owner = None
+
+
+    def __setitem__(self, key, value):
+        old = dict.get(self, key, _MISSING)
+        dict.__setitem__(self, key, value)
+        self._root._metadataChanged(self, key, old, value)
+
+
+    def __delitem__(self, key):
+        old = self[key]
+        dict.__delitem__(self, key)
+        self._root._metadataChanged(self, key, old, _MISSING)
+
+
+    def pop(self, key, *default):
+        old = dict.get(self, key, _MISSING)
+        value = dict.pop(self, key, *default)
+        if old is not _MISSING:
+            self._root._metadataChanged(self, key, old, _MISSING)
+        return value
+
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._root._metadataChanged(self, key, value, _MISSING)
+        return (key, value)
+
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+    def clear(self):
+        for key in list(self.keys()):
+            del self[key]
+
+
+
+def _indexValue(value):
+    """
+    Returns a hashable version of a metadata value to use as a key in a ``MetadataIndex``,
+    or raises TypeError if the value can't be indexed. Lists (from JSON) become tuples.
+    """
+    if isinstance(value, list):
+        return tuple(_indexValue(v) for v in value)
+    hash(value)
+    return value
+
+
+def _sortKey(value):
+    """
+    Returns the key a metadata value is sorted by for range lookups, or None if it can't
+    be sorted. Numbers are sorted before strings.
+    """
+    if isinstance(value, (int, float)):
+        return (0, value)
+    elif isinstance(value, str):
+        return (1, value)
+    return None
+
+
+class MetadataIndex(object):
+    """
+    An index of the values of one metadata key, created with ``RootDirectory.createIndex()``.
+    Maps every value to the hashes (see ``FSObject.hash()``) of the files and directories
+    that have that value, and keeps the numbers and strings sorted for range lookups.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        # value -> set of hashes
+        self.values = {}
+        # sorted list of the _sortKey() of every value that can be sorted
+        self._sorted = []
+
+
+    def add(self, value, fshash):
+        try:
+            value = _indexValue(value)
+        except TypeError:
+            return
+        hashes = self.values.get(value)
+        if hashes is None:
+            hashes = self.values[value] = set()
+            sortKey = _sortKey(value)
+            if sortKey is not None:
+                bisect.insort(self._sorted, sortKey)
+        hashes.add(fshash)
+
+
+    def remove(self, value, fshash):
+        try:
+            value = _indexValue(value)
+        except TypeError:
+            return
+        hashes = self.values.get(value)
+        if hashes is not None:
+            hashes.discard(fshash)
+            if len(hashes) == 0:
+                del self.values[value]
+                sortKey = _sortKey(value)
+                if sortKey is not None:
+                    i = bisect.bisect_left(self._sorted, sortKey)
+                    if i < len(self._sorted) and self._sorted[i] == sortKey:
+                        del self._sorted[i]
+
+
+    def equal(self, value):
+        """
+        Returns the set of hashes of the items with the value ``value``
+        """
+        try:
+            return set(self.values.get(_indexValue(value), ()))
+        except TypeError:
+            return set()
+
+
+    def range(self, low=None, high=None):
+        """
+        Returns a list of the hashes of the items with a value between ``low`` and ``high``
+        (inclusive), sorted by value. Either one can be None to leave out that bound, but
+        not both. Numbers are only compared with numbers and strings with strings.
+        """
+        lowKey = None if low is None else _sortKey(low)
+        highKey = None if high is None else _sortKey(high)
+        group = (lowKey or highKey or (None,))[0]
+        if group is None or (lowKey is not None and highKey is not None and lowKey[0] != highKey[0]):
+            raise ValueError("low and high must both be numbers or strings")
+
+        start = bisect.bisect_left(self._sorted, (group,) if lowKey is None else lowKey)
+        end = bisect.bisect_left(self._sorted, (group + 1,)) if highKey is None else bisect.bisect_right(self._sorted, highKey)
+
+        hashes = []
+        for sortKey in self._sorted[start:end]:
+            hashes.extend(sorted(self.values[sortKey[1]]))
+        return hashes
+
+
+
+class QuerySyntaxError(ValueError):
+    """
+    Raised by ``parseQuery()`` if a query string can't be parsed
+    """
+
+
+# size suffixes in query strings, eg. "size > 10MB"
+_QUERY_SIZE_SUFFIXES = { 'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40 }
+
+_QUERY_TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+      | (?P<number>-?\d+(?:\.\d+)?)(?P<suffix>[kKmMgGtT][bB]?)?(?![\w.])
+      | (?P<op>==|!=|<=|>=|=~|<|>|~|\(|\))
+      | (?P<word>[A-Za-z_]\w*)
+    )""", re.VERBOSE)
+
+_QUERY_CONSTANTS = { 'true': True, 'false': False, 'null': None, 'none': None }
+
+
+class QueryNode(object):
+    """
+    Base class for the nodes of a parsed query. See ``parseQuery()``.
+    """
+
+    def evaluate(self, item):
+        """
+        Returns True if the file or directory ``item`` matches this part of the query
+        """
+        raise NotImplementedError()
+
+
+    def cost(self):
+        """
+        A rough estimate of how expensive ``evaluate()`` is: 0 for things that are stored
+        on the object, 1 for things that may need a syscall, and 2 for things that may
+        need the file to be hashed.
+        """
+        return 0
+
+
+    def optimize(self):
+        """
+        Returns an equivalent query with nested "and" and "or" nodes merged and their
+        parts sorted so the cheapest ones are evaluated first.
+        """
+        return self
+
+
+    def pruneDirectory(self, directory):
+        """
+        Returns True if nothing inside ``directory`` can match the query
+        """
+        return False
+
+
+
+class QueryCompare(QueryNode):
+    """
+    Compares a field of a file or directory with a value. ``field`` can be "name",
+    "relpath", "ext" (the lowercase file extension without the dot) or "size", and
+    anything else is looked up in the metadata. ``op`` is one of ``==``, ``!=``, ``<``,
+    ``<=``, ``>``, ``>=``, ``~`` (matches a glob pattern, ignoring case) or ``=~`` (matches
+    a regex, ignoring case).
+    """
+    # field name -> (cost, function that returns the value of the field)
+    fields = {
+        'name': (0, lambda item: item.name),
+        'relpath': (0, lambda item: item.relpath),
+        'ext': (0, lambda item: "" if item.isdir else os.path.splitext(item.name)[1][1:].lower()),
+        'size': (1, lambda item: item.size),
+    }
+
+    ops = ('==', '!=', '<', '<=', '>', '>=', '~', '=~')
+
+    def __init__(self, field, op, value):
+        if op not in self.ops:
+            raise QuerySyntaxError("Unknown operator '%s'" % op)
+        self.field = field
+        self.op = op
+        self.value = value
+
+        if field in self.fields:
+            self._cost, self._getter = self.fields[field]
+        else:
+            self._cost, self._getter = (2, lambda item: item.get(field))
+
+        if op == '~':
+            self._pattern = str(value).lower()
+        elif op == '=~':
+            self._regex = re.compile(str(value), re.IGNORECASE)
+
+
+    def evaluate(self, item):
+        value = self._getter(item)
+        op = self.op
+        if op == '==':
+            return value == self.value
+        elif op == '!=':
+            return value != self.value
+        elif value is None:
+            return False
+        elif op == '~':
+            return fnmatch.fnmatch(str(value).lower(), self._pattern)
+        elif op == '=~':
+            return self._regex.search(str(value)) is not None
+
+        try:
+            if op == '<':
+                return value < self.value
+            elif op == '<=':
+                return value <= self.value
+            elif op == '>':
+                return value > self.value
+            else:
+                return value >= self.value
+        except TypeError:
+            # values that can't be compared, like a string and a number, don't match
+            return False
+
+
+    def cost(self):
+        return self._cost
+
+
+    def pruneDirectory(self, directory):
+        # a relative path pattern can only match inside directories that share its literal prefix
+        if self.field != 'relpath' or self.op not in ('==', '~'):
+            return False
+        prefix = str(self.value)
+        if self.op == '~':
+            prefix = _GLOB_SPECIAL.split(prefix.lower())[0]
+        dirPath = directory.relpath + os.sep
+        if self.op == '~':
+            dirPath = dirPath.lower()
+        return not (prefix.startswith(dirPath) or dirPath.startswith(prefix))
+
+
+    def __repr__(self):
+        return "QueryCompare(%r, %r, %r)" % (self.field, self.op, self.value)
+
+
+
+class QueryAnd(QueryNode):
+    """
+    Matches if all of its parts match
+    """
+
+    def __init__(self, *parts):
+        self.parts = list(parts)
+
+
+    def evaluate(self, item):
+        for part in self.parts:
+            if not part.evaluate(item):
+                return False
+        return True
+
+
+    def cost(self):
+        return max(part.cost() for part in self.parts)
+
+
+    def optimize(self):
+        parts = []
+        for part in self.parts:
+            part = part.optimize()
+            if type(part) is type(self):
+                parts.extend(part.parts)
+            else:
+                parts.append(part)
+        parts.sort(key=lambda part: part.cost())
+        return self.__class__(*parts)
+
+
+    def pruneDirectory(self, directory):
+        for part in self.parts:
+            if part.pruneDirectory(directory):
+                return True
+        return False
+
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(repr(part) for part in self.parts))
+
+
+
+class QueryOr(QueryAnd):
+    """
+    Matches if any of its parts match
+    """
+
+    def evaluate(self, item):
+        for part in self.parts:
+            if part.evaluate(item):
+                return True
+        return False
+
+
+    def pruneDirectory(self, directory):
+        for part in self.parts:
+            if not part.pruneDirectory(directory):
+                return False
+        return True
+
+
+
+class QueryNot(QueryNode):
+    """
+    Matches if its part doesn't match
+    """
+
+    def __init__(self, part):
+        self.part = part
+
+
+    def evaluate(self, item):
+        return not self.part.evaluate(item)
+
+
+    def cost(self):
+        return self.part.cost()
+
+
+    def optimize(self):
+        return QueryNot(self.part.optimize())
+
+
+    def __repr__(self):
+        return "QueryNot(%r)" % self.part
+
+
+
+def parseQuery(text):
+    """
+    Parses a query string and returns a ``QueryNode`` that can be passed to ``Directory.query()``.
+    Raises ``QuerySyntaxError`` if the string isn't a valid query.
+
+    A query is made of comparisons like ``size > 10MB`` or ``author == "John Smith"``, which
+    can be combined with ``and``, ``or``, ``not`` and parentheses. See ``QueryCompare`` for
+    the available fields and operators. Values can be strings in single or double quotes,
+    numbers with an optional size suffix (``KB``, ``MB``, ``GB`` or ``TB``), ``true``,
+    ``false`` or ``null``.
+
+    *Examples*:
+        >>> parseQuery('ext == "mp3" and (artist ~ "*beatles*" or year < 1970)')
+        >>> parseQuery('name =~ "^track [0-9]+" and not size >= 1GB')
+    """
+    tokens = []
+    # where each token starts in the query string
+    positions = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _QUERY_TOKEN.match(text, pos)
+        if match is None:
+            raise QuerySyntaxError("Unexpected character at position %d: %r" % (pos, text[pos:pos+10]))
+        pos = match.end()
+        positions.append(match.start(match.lastgroup))
+
+        if match.group('string') is not None:
+            try:
+                tokens.append(('value', ast.literal_eval(match.group('string'))))
+            except (SyntaxError, ValueError) as e:
+                raise QuerySyntaxError("Invalid string at position %d: %s" % (positions[-1], e))
+        elif match.group('number') is not None:
+            number = match.group('number')
+            number = float(number) if '.' in number else int(number)
+            suffix = match.group('suffix')
+            if suffix:
+                number = number * _QUERY_SIZE_SUFFIXES[suffix[0].lower()]
+                if isinstance(number, float) and number.is_integer():
+                    number = int(number)
+            tokens.append(('value', number))
+        elif match.group('op') is not None:
+            tokens.append(('op', match.group('op')))
+        else:
+            word = match.group('word')
+            if word.lower() in ('and', 'or', 'not'):
+                tokens.append((word.lower(), word))
+            elif word.lower() in _QUERY_CONSTANTS:
+                tokens.append(('value', _QUERY_CONSTANTS[word.lower()]))
+            else:
+                tokens.append(('field', word))
+
+    tokens.append(('end', None))
+    positions.append(len(text))
+    parser = _QueryParser(tokens, positions)
+    node = parser.parseOr()
+    if parser.peek()[0] != 'end':
+        raise QuerySyntaxError("Unexpected %s" % parser.describe(parser.peek()))
+    return node
+
+
+class _QueryParser(object):
+    """
+    Recursive descent parser used by ``parseQuery()``
+    """
+
+    def __init__(self, tokens, positions):
+        self.tokens = tokens
+        self.positions = positions
+        self.pos = 0
+
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+
+    def next(self):
+        token = self.tokens[self.pos]
+        if token[0] != 'end':
+            self.pos += 1
+        return token
+
+
+    def describe(self, token):
+        return "the end of the query" if token[0] == 'end' else repr(token[1])
+
+
+    def parseOr(self):
+        parts = [self.parseAnd()]
+        while self.peek()[0] == 'or':
+            self.next()
+            parts.append(self.parseAnd())
+        return parts[0] if len(parts) == 1 else QueryOr(*parts)
+
+
+    def parseAnd(self):
+        parts = [self.parseNot()]
+        while self.peek()[0] == 'and':
+            self.next()
+            parts.append(self.parseNot())
+        return parts[0] if len(parts) == 1 else QueryAnd(*parts)
+
+
+    def parseNot(self):
+        if self.peek()[0] == 'not':
+            self.next()
+            return QueryNot(self.parseNot())
+
+        if self.peek() == ('op', '('):
+            self.next()
+            node = self.parseOr()
+            if self.next() != ('op', ')'):
+                raise QuerySyntaxError("Missing ')'")
+            return node
+
+        token = self.next()
+        if token[0] != 'field':
+            raise QuerySyntaxError("Expected a field name, got %s" % self.describe(token))
+        field = token[1]
+        token = self.next()
+        if token[0] != 'op' or token[1] not in QueryCompare.ops:
+            raise QuerySyntaxError("Expected an operator after '%s', got %s" % (field, self.describe(token)))
+        op = token[1]
+        token = self.next()
+        if token[0] != 'value':
+            raise QuerySyntaxError("Expected a value after '%s %s', got %s" % (field, op, self.describe(token)))
+        try:
+            return QueryCompare(field, op, token[1])
+        except re.error as e:
+            raise QuerySyntaxError("Invalid regular expression at position %d: %s" % (self.positions[self.pos - 1], e))
+
+
+
+class RootDirectory(Directory):
+    """
+    The filesystem root directory
+    """
+
+    # what classes to use for file and directory objects?
+    FileClass = File
+    DirectoryClass = Directory
+
+    # If False, files and directories only store their name and parent, and their paths
+    # are put together from the parent chain whenever they are needed. This saves a lot of
+    # memory on large trees, at the cost of making path lookups slower. The paths of the
+    # last pathCacheSize directories that were used are kept, so the paths of their contents
+    # only take one join. Set these in a subclass, since the tree cache is loaded by the
+    # constructor.
+    storePaths = True
+    pathCacheSize = 10000
+
+    # the number of threads that the asyncio methods (``arefresh()``, ``asyncSync()``,
+    # ``File.amd5()`` and so on) use for blocking filesystem calls, which is also the most
+    # filesystem calls they make at once
+    asyncWorkers = 4
+
+    def __init__(self, path):
+        Directory.__init__(self, path, None)
+
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        if not os.path.isdir(path):
+            raise ValueError("Root path must be a directory (got '%s')" % path)
+
+        # directory -> path of the directory paths put together most recently if storePaths is False
+        self._pathCache = OrderedDict()
+        # relative path -> file or directory, see createPathIndex()
+        self._pathIndex = None
+        # thread pool for the asyncio methods, created when it's first needed
+        self._asyncExecutor = None
+        # where the relative path starts in those paths
+        base = self.abspath
+        self._relpathStart = len(base) if base.endswith(os.sep) else len(base) + 1
+
+        self._md = self._readMetadata()
+        self._contents, self._order = self._readTreeData()
+
+        # make sure all direct child objects have the correct parent set
+        if self._contents is not None:
+            for item in self._contents.values():
+                item.parent = self
+                # may as well set the root attribute too
+                item._root = self
+
+        self._nameIndex = self._readNameIndex()
+
+        # metadata key -> MetadataIndex
+        self._mdIndexes = {}
+        # hash -> set of relative paths of files that were found with that hash, which is
+        # used to look up the files for the hashes in the metadata indexes
+        self._mdLocations = {}
+        # was the whole tree searched for the locations of the hashes in the metadata?
+        self._mdLocationsComplete = False
+
+        indexes = self._readMetadataIndexes()
+        if indexes is not None:
+            keys, self._mdLocations, self._mdLocationsComplete = indexes
+            for key in keys:
+                self.createIndex(key)
+
+
+    def rename(self, newName, syscall=True):
+        # renaming the root directory would break things somewhat...
+        raise OSError("You can't rename the root directory.")
+
+
+    def _materializePath(self, item):
+        """
+        Puts together the absolute path of ``item`` from its parent chain. Used when
+        ``storePaths`` is False.
+        """
+        cache = self._pathCache
+        if not item.isdir:
+            # the usual case, a file in a directory that was used recently
+            parentPath = cache.get(item.parent)
+            if parentPath is not None:
+                cache.move_to_end(item.parent)
+                return parentPath + os.sep + item.name
+        else:
+            path = cache.get(item)
+            if path is not None:
+                cache.move_to_end(item)
+                return path
+
+        chain = []
+        obj = item
+        path = self.abspath
+        while obj is not self and obj is not None:
+            chain.append(obj)
+            obj = obj.parent
+            # the path of a parent directory that was put together recently saves going further up
+            parentPath = cache.get(obj)
+            if parentPath is not None:
+                cache.move_to_end(obj)
+                path = parentPath
+                break
+
+        # only the paths of directories are kept, since the paths of their contents are
+        # quick to put together from them
+        cacheSize = self.pathCacheSize
+        for obj in reversed(chain):
+            path = os.path.join(path, obj.name)
+            if cacheSize > 0 and obj.isdir:
+                cache[obj] = path
+        while len(cache) > cacheSize:
+            cache.popitem(last=False)
+        return path
+
+
+    def _getAsyncExecutor(self):
+        """
+        Returns the thread pool used by ``FSObject._runBlocking()``
+        """
+        if self._asyncExecutor is None:
+            self._asyncExecutor = ThreadPoolExecutor(max_workers=self.asyncWorkers)
+        return self._asyncExecutor
+
+
+    def _forgetPaths(self, item):
+        """
+        Called when ``item`` was renamed or moved. Forgets the paths that were put together
+        for it and everything inside it if ``storePaths`` is False.
+        """
+        if self.storePaths:
+            return
+        item._path = item._relpath = item._abspath = None
+        if item.isdir:
+            self._pathCache.clear()
+
+
+    @property
+    def root(self):
+        # Normally the ``root`` property figures out what the root directory is and returns it.
+        # This object IS the root, so just return self.
+        return self
+
+
+    def save(self):
+        """
+        Write all metadata to disk.
+        """
+        self._writeMetadata(self._md)
+        self._writeTreeData(self._contents, self._order)
+        if self._nameIndex is not None:
+            self._writeNameIndex(self._nameIndex)
+        self._writeMetadataIndexes(list(self._mdIndexes), self._mdLocations, self._mdLocationsComplete)
+
+
+    def createIndex(self, key):
+        """
+        Creates an index of the values of the metadata key ``key``, which is used by
+        ``lookupMetadata()`` and ``lookupMetadataRange()`` to find files and directories by
+        their metadata without checking (or hashing) every file in the tree. The index is
+        kept up to date when metadata is changed. Returns the ``MetadataIndex`` object.
+
+        Only values that are numbers, strings, booleans, None or lists of those are indexed.
+        """
+        index = self._mdIndexes.get(key)
+        if index is None:
+            index = self._mdIndexes[key] = MetadataIndex(key)
+            for fshash, md in self._md.items():
+                if key in md:
+                    index.add(md[key], fshash)
+        return index
+
+
+    def dropIndex(self, key):
+        """
+        Removes the index created by ``createIndex(key)``
+        """
+        self._mdIndexes.pop(key, None)
+        if len(self._mdIndexes) == 0:
+            self._mdLocations = {}
+            self._mdLocationsComplete = False
+
+
+    def lookupMetadata(self, key, value):
+        """
+        A generator that yields every file and directory whose metadata value for ``key``
+        is equal to ``value``, sorted by their relative paths. Uses the index created with
+        ``createIndex(key)`` if there is one. Otherwise it's the same as
+        ``query(lambda f: f.get(key) == value, recursive=True)``.
+
+        *Example*:
+            >>> fs.createIndex('author')
+            >>> list(fs.lookupMetadata('author', "John Smith"))
+        """
+        index = self._mdIndexes.get(key)
+        if index is None:
+            for item in self.query(lambda f: key in f.metadata and f.metadata[key] == value, recursive=True):
+                yield item
+        else:
+            for item in sorted(self._itemsForHashes(index.equal(value)), key=lambda item: item.relpath):
+                yield item
+
+
+    def lookupMetadataRange(self, key, low=None, high=None):
+        """
+        A generator that yields every file and directory whose metadata value for ``key`` is
+        between ``low`` and ``high`` (inclusive), sorted by value. Either bound can be None,
+        but not both. Numbers are only compared with numbers, and strings with strings.
+        Uses the index created with ``createIndex(key)`` if there is one, and checks every
+        file and directory otherwise.
+
+        *Example*:
+            >>> fs.createIndex('year')
+            >>> list(fs.lookupMetadataRange('year', 2000, 2009))
+        """
+        index = self._mdIndexes.get(key)
+        if index is None:
+            index = MetadataIndex(key)
+            items = {}
+            for item in self.all(recursive=True):
+                if key in item.metadata:
+                    index.add(item.metadata[key], item.relpath)
+                    items[item.relpath] = item
+            for relpath in index.range(low, high):
+                yield items[relpath]
+        else:
+            for fshash in index.range(low, high):
+                for item in sorted(self._itemsForHashes((fshash,)), key=lambda item: item.relpath):
+                    yield item
+
+
+    def _metadataChanged(self, md, key, oldValue, newValue):
+        """
+        Called by ``MetadataDict`` when the value of ``key`` changes. ``oldValue`` or
+        ``newValue`` is ``_MISSING`` if the key was added or removed.
+        """
+        index = self._mdIndexes.get(key)
+        if index is not None:
+            if oldValue is not _MISSING:
+                index.remove(oldValue, md._hash)
+            if newValue is not _MISSING:
+                index.add(newValue, md._hash)
+
+            # remember where the file is, so it can be found without hashing every file
+            owner = md._owner
+            if owner is not None and not owner.isdir and self._mdLocationsComplete:
+                self._mdLocations.setdefault(md._hash, set()).add(owner.relpath)
 
 
-    def __len__(self):
+    def _itemsForHashes(self, hashes):
         """
-        Return the number of files and directories in this directory
+        A generator that yields the files and directories whose ``hash()`` is in ``hashes``.
+
+        Directories use their relative path as their hash. Files are looked up in the locations
+        recorded by ``_findMetadataLocations()``, which searches the whole tree once, and the
+        locations recorded whenever metadata changes after that. If a file isn't where it was
+        recorded any more, the tree is searched again.
         """
-        return len(self.contents)
+        if not self._mdLocationsComplete:
+            self._findMetadataLocations()
 
+        moved = []
+        for fshash in hashes:
+            item = self._lookupRelpath(fshash)
+            if item is not None and item.isdir and item.hash() == fshash:
+                yield item
+                continue
 
-    def __iter__(self):
-        for key in self.order:
-            yield self.contents[key]
+            found = False
+            stale = False
+            relpaths = self._mdLocations.get(fshash, ())
+            for relpath in list(relpaths):
+                item = self._lookupRelpath(relpath)
+                if item is not None and not item.isdir and item.hash() == fshash:
+                    found = True
+                    yield item
+                else:
+                    # the file was moved, deleted or changed
+                    relpaths.discard(relpath)
+                    stale = True
+            if stale and not found:
+                moved.append(fshash)
 
+        if len(moved) > 0:
+            self._findMetadataLocations()
+            for fshash in moved:
+                for relpath in self._mdLocations.get(fshash, ()):
+                    yield self._lookupRelpath(relpath)
 
-    def __contains__(self, key):
+
+    def _findMetadataLocations(self):
         """
-        Checks if a given file or directory name is contained in this directory
+        Records the location of every file in the tree that has metadata
         """
-        return (key in self.contents)
+        self._mdLocations = {}
+        for item in self.all(recursive=True, dirs=False):
+            fshash = item.hash()
+            if self._md.get(fshash):
+                self._mdLocations.setdefault(fshash, set()).add(item.relpath)
+        self._mdLocationsComplete = True
 
 
-    def __getitem__(self, key):
+    def createNameIndex(self):
         """
-        Directory objects support a number of different indexing methods, all of which
-        either return a single object or a list containing multiple objects, which is
-        useful when you want to assign the results to a variable (as opposed to the
-        searching methods ``filter()``, ``search()``, ``query()``, and ``all()``, which
-        are generators).
-
-        Directories support the following syntaxes for indexing:
+        Creates an index of the names of all files and directories, which makes recursive
+        ``filter()`` and ``search()`` calls much faster on large trees. The index is used
+        whenever the pattern or regex contains at least 3 literal characters, for example
+        ``fs.filter("*beatles*", recursive=True)``. Results found with the index are
+        returned in the order of their relative paths.
+
+        The index is built the first time it is used, which requires the whole directory
+        tree, and is kept up to date when the tree changes. Returns the ``NameIndex`` object.
+        """
+        if self._nameIndex is None:
+            self._nameIndex = NameIndex()
+            self._nameIndex.pending.add(".")
+        return self._nameIndex
 
-        * An ellipsis object returns a list of all children, recursively.
 
-            ``directory[...]``
-                (same as ``list(directory.all(recursive=True))``)
+    def dropNameIndex(self):
+        """
+        Removes the index created by ``createNameIndex()``
+        """
+        self._nameIndex = None
 
-        * An integer, which is treated as an index and returns one item based on the
-          directory ordering. Because the ordering is precalculated, this is O(1).
-          Returns exactly one item.
 
-            ``directory[2]``
+    def createPathIndex(self):
+        """
+        Creates an index of the relative paths of all files and directories, which lets
+        ``lookup()`` find any item without walking down the directory tree. The index holds
+        every item that has been loaded so far and is kept up to date by refreshes, syncs,
+        renames and moves. Items in directories that weren't loaded yet are added when
+        they're loaded.
+        """
+        if self._pathIndex is None:
+            self._pathIndex = {}
+            _updatePathIndex(self._pathIndex, self, None, ".")
 
-        * A slice, which is treated as a range of indices based on the directory ordering.
 
-            ``directory[1:3]``
+    def dropPathIndex(self):
+        """
+        Removes the index created by ``createPathIndex()``
+        """
+        self._pathIndex = None
 
-        * An empty slice, which returns a list of items in the directory.
 
-            ``directory[:]``
-                (same as ``list(directory.all(recursive=False))``)
+    def lookup(self, relpath, default=None):
+        """
+        Returns the file or directory with the relative path ``relpath``, or ``default`` if it
+        doesn't exist in the directory tree. Both "/" and the platform's path separator can
+        be used in ``relpath``, and "." or "" is the root directory itself. This only takes a
+        dict lookup if the root directory has a path index, see ``createPathIndex()``.
+        """
+        index = self._pathIndex
+        if index is not None:
+            item = index.get(relpath)
+            if item is not None:
+                return item
 
-        * A string key, which is treated as a file or directory name and uses a
-          dict-based lookup for O(1) lookups. Returns exactly one item.
+        relpath = os.path.normpath(relpath.replace("/", os.sep).strip(os.sep) or ".")
+        if index is not None:
+            item = index.get(relpath)
+            if item is not None:
+                return item
 
-            ``directory["asdf.txt"]``
+        # not in the index yet, so the directories on the way are loaded (and indexed)
+        item = self._lookupRelpath(relpath)
+        return default if item is None else item
 
-        * A string which contains either a ``*`` or a ``?``. This string is passed to the
-          Python stdlib library ``fnmatch`` to support searches and returns a list of files
-          or directories that match the pattern. See the documentation for the ``fnmatch``
-          library for more information.
 
-            ``directory["*.txt"]``
-                (same as ``list(directory.filter("*.txt"))``)
+    def _lookupRelpath(self, relpath):
         """
-        # python 3 ellipsis as a shortcut for all files and directories, recursively
-        if key == Ellipsis:
-            return list(self.all(recursive=True))
-
-        # allow indexing by integer using the directory order
-        elif isinstance(key, int):
-            return self.contents[self.order[key]]
+        Returns the file or directory with the relative path ``relpath``, or None if it
+        doesn't exist in the directory tree.
+        """
+        item = self
+        if relpath == ".":
+            return item
+        for name in relpath.split(os.sep):
+            if not item.isdir:
+                return None
+            item = item.contents.get(name)
+            if item is None:
+                return None
+        return item
 
-        # allow standard slice syntax by passing the slice directly to the ordering list
-        elif isinstance(key, slice):
-            return [ self.contents[item] for item in self.order[key] ]
 
-        # look up the key in the contents dict
-        # this lookup needs to be done BEFORE the filter check just in case there are files
-        # that contain a '*' or '?'
-        elif key in self.contents:
-            return self.contents[key]
+    def _updateNameIndex(self):
+        """
+        Adds the contents of every directory in ``NameIndex.pending`` to the name index
+        """
+        index = self._nameIndex
+        while len(index.pending) > 0:
+            relpath = index.pending.pop()
+            dirobj = self._lookupRelpath(relpath)
+            if dirobj is None or not dirobj.isdir:
+                continue
 
-        # return the results of a filter so we can support cool search-based keys
-        elif '*' in key or '?' in key:
-            return list(self.filter(key))
+            # walk the whole directory, refreshing anything that wasn't refreshed yet
+            stack = [ (dirobj, relpath) ]
+            while len(stack) > 0:
+                dirobj, relpath = stack.pop()
+                for name, item in dirobj.contents.items():
+                    itemRelpath = _joinRelpath(relpath, name)
+                    index.add(itemRelpath, name)
+                    if item.isdir:
+                        stack.append((item, itemRelpath))
+                index.pending.discard(relpath)
 
-        # if none of those previous key syntaxes matched, then raise an exception
-        else:
-            raise KeyError(key)
 
+    def _nameIndexCandidates(self, literals, directory):
+        """
+        Uses the name index to find all items inside ``directory`` (recursively) that contain
+        all strings in ``literals`` in their name. Returns a list of items sorted by their
+        relative paths, or None if the strings are too short to use the index.
+        """
+        if max(len(literal) for literal in literals) < 3:
+            return None
 
-class RootDirectory(Directory):
-    """
-    The filesystem root directory
-    """
+        index = self._nameIndex
+        self._updateNameIndex()
 
-    # what classes to use for file and directory objects?
-    FileClass = File
-    DirectoryClass = Directory
+        prefix = None
+        if directory is not self:
+            prefix = directory.relpath + os.sep
 
-    def __init__(self, path):
-        Directory.__init__(self, path, None)
+        items = []
+        for relpath, name in sorted(index.find(literals)):
+            if prefix is not None and not relpath.startswith(prefix):
+                continue
+            item = self._lookupRelpath(relpath)
+            if item is None:
+                # the item doesn't exist any more
+                index.remove(relpath, name)
+            else:
+                items.append(item)
+        return items
 
-        if not os.path.exists(path):
-            raise FileNotFoundError(path)
-        if not os.path.isdir(path):
-            raise ValueError("Root path must be a directory (got '%s')" % path)
-        self._md = self._readMetadata()
-        self._contents, self._order = self._readTreeData()
 
-        # make sure all direct child objects have the correct parent set
-        if self._contents is not None:
-            for item in self._contents.values():
-                item.parent = self
-                # may as well set the root attribute too
-                item._root = self
+    def _queryCandidates(self, query, directory):
+        """
+        Used by ``Directory.query()`` to find the items inside ``directory`` (recursively)
+        that can match the parsed ``query`` using the name and metadata indexes. Every
+        comparison that has to be true for the query to match and that can use an index
+        is looked up, and the smallest result is used. Returns a list of items sorted by
+        their relative paths, or None if no index can be used.
+        """
+        if isinstance(query, QueryAnd) and not isinstance(query, QueryOr):
+            parts = query.parts
+        else:
+            parts = [ query ]
 
+        best = None
+        nameLiterals = None
+        for part in parts:
+            if not isinstance(part, QueryCompare):
+                continue
 
-    def rename(self, newName, syscall=True):
-        # renaming the root directory would break things somewhat...
-        raise OSError("You can't rename the root directory.")
+            if part.field == 'name':
+                # only the name with the most literal characters is looked up in the name index
+                if self._nameIndex is None or not isinstance(part.value, str):
+                    continue
+                if part.op == '~':
+                    literals = _globLiterals(part.value.lower())
+                elif part.op == '=~':
+                    literals = _regexLiterals(part.value, re.IGNORECASE)
+                elif part.op == '==':
+                    literals = [ part.value ]
+                else:
+                    continue
+                if literals and (nameLiterals is None or sum(map(len, literals)) > sum(map(len, nameLiterals))):
+                    nameLiterals = literals
+
+            elif part.field not in QueryCompare.fields:
+                index = self._mdIndexes.get(part.field)
+                # the index only has the items that have the key, but a comparison with null
+                # also matches the ones that don't
+                if index is None or part.value is None:
+                    continue
+                try:
+                    if part.op == '==':
+                        hashes = index.equal(part.value)
+                    elif part.op in ('<', '<='):
+                        hashes = index.range(None, part.value)
+                    elif part.op in ('>', '>='):
+                        hashes = index.range(part.value, None)
+                    else:
+                        continue
+                except (TypeError, ValueError):
+                    # values that can't be indexed or compared are checked one by one
+                    continue
+                if best is None or len(hashes) < len(best):
+                    best = hashes
 
+        if nameLiterals is not None and (best is None or len(best) > 0):
+            items = self._nameIndexCandidates(nameLiterals, directory)
+            if items is not None and (best is None or len(items) <= len(best)):
+                return items
 
-    @property
-    def root(self):
-        # Normally the ``root`` property figures out what the root directory is and returns it.
-        # This object IS the root, so just return self.
-        return self
+        if best is not None:
+            return self._queryMetadataCandidates(best, directory)
+        return None
 
 
-    def save(self):
+    def _queryMetadataCandidates(self, hashes, directory):
         """
-        Write all metadata to disk.
+        Returns the items inside ``directory`` (recursively) whose hash is in ``hashes``,
+        sorted by their relative paths
         """
-        self._writeMetadata(self._md)
-        self._writeTreeData(self._contents, self._order)
+        prefix = None
+        if directory is not self:
+            prefix = directory.relpath + os.sep
+
+        items = {}
+        for item in self._itemsForHashes(set(hashes)):
+            if item is None or item is self:
+                continue
+            relpath = item.relpath
+            if prefix is None or relpath.startswith(prefix):
+                items[relpath] = item
+        return [ items[relpath] for relpath in sorted(items) ]
 
 
     def scrubMetadata(self, autoRefresh=True):
@@ -1061,7 +3685,11 @@ class RootDirectory(Directory):
 
         # delete every entry in self._md that is outdated
         for h in outdatedHashes:
-            del self._md[h]
+            md = self._md.pop(h)
+            for key, index in self._mdIndexes.items():
+                if key in md:
+                    index.remove(md[key], h)
+            self._mdLocations.pop(h, None)
 
 
     def _getFileClass(self, path):
@@ -1098,6 +3726,15 @@ class RootDirectory(Directory):
         return order
 
 
+    def _isDefaultOrder(self):
+        """
+        Returns True if ``_orderDirectory()`` wasn't overridden, so directory orders are
+        sorted lists of names and can be updated with ``bisect`` when an item is added or
+        removed. Other orders are calculated again with ``_orderDirectory()``.
+        """
+        return type(self)._orderDirectory is RootDirectory._orderDirectory
+
+
     def _ignorePath(self, name, fullpath, isdir):
         """
         Based on a file or directory name and its full path, return True if a file or directory
@@ -1185,6 +3822,23 @@ class RootDirectory(Directory):
         return (None, None)
 
 
+    def _readDirectoryContents(self, dirobj):
+        """
+        Reads in the contents of a single directory from the tree cache.
+
+        Can be implemented in a subclass to load the directory tree lazily. ``_readTreeData()``
+        can return directories that have a ``_contents`` value of None and a ``_treeBlock``
+        value that is not None, and this method will be called with each of those directories
+        the first time their contents are needed. ``_treeBlock`` can be any value that helps
+        to locate the contents of the directory in the cache.
+
+        Should return a dict with the same format as the first element returned by
+        ``_readTreeData()``, with the ``parent`` attribute of every item set to ``dirobj``,
+        or None if the contents of the directory are not available.
+        """
+        return None
+
+
     def _writeTreeData(self, tree, ordering):
         """
         Writes out the directory tree to a file.
@@ -1198,6 +3852,26 @@ class RootDirectory(Directory):
         """
 
 
+    def _readNameIndex(self):
+        """
+        Reads in the name index (see ``createNameIndex()``) that was written with ``_writeNameIndex()``.
+
+        Can be implemented in a subclass to keep the name index between runs. Should return
+        a ``NameIndex``, or None if there is no name index. The index must match the directory
+        tree returned by ``_readTreeData()``.
+
+        The constructor will run ``self._nameIndex = self._readNameIndex()``.
+        """
+        return None
+
+
+    def _writeNameIndex(self, index):
+        """
+        Writes out the name index. Called by ``save()`` after the directory tree was written,
+        if there is a name index.
+        """
+
+
     def _getMetadataForObject(self, obj):
         """
         Given a FSObject, return a dict or dict-like object representing the metadata
@@ -1209,10 +3883,54 @@ class RootDirectory(Directory):
         fshash = obj.hash()
 
         # no entry for this hash? make one first
-        if fshash not in self._md:
-            self._md[fshash] = {}
+        md = self._md.get(fshash)
+        if md is None:
+            md = self._md[fshash] = MetadataDict(self, fshash)
+        elif type(md) is not MetadataDict:
+            # metadata that was read from a file is stored in plain dicts
+            md = self._md[fshash] = MetadataDict(self, fshash, md)
+
+        md._owner = obj
+        return md
+
+
+    def _readMetadataIndexes(self):
+        """
+        Reads in which metadata keys are indexed (see ``createIndex()``) and where the files
+        with metadata are, as written by ``_writeMetadataIndexes()``.
+
+        Can be implemented in a subclass to keep metadata indexes between runs. Should return
+        a 3-tuple with a list of the indexed keys, a dict with hashes as keys and sets of
+        relative paths as values, and a bool that says if the whole tree was searched for the
+        hashes in the metadata, or None if there are no indexes. The indexes themselves are
+        rebuilt from the metadata.
+        """
+        return None
+
+
+    def _writeMetadataIndexes(self, keys, locations, complete):
+        """
+        Writes out the list of indexed metadata keys, the locations of the files with metadata,
+        and whether the locations are complete. Called by ``save()``.
+        """
 
-        return self._md[fshash]
+
+
+# The binary tree cache starts with a header holding TREE_MAGIC and the format version.
+# It is followed by one marshal-encoded block per directory holding the serialized
+# contents of that directory. Subdirectories are written before their parents, so
+# every directory record can point at the block with its contents. The file ends
+# with a fixed-size trailer that points at the block with the root directory contents.
+#
+# Saves after the first one append the blocks of changed directories (and their parents)
+# followed by a new trailer, so only the last trailer in the file is used. The trailer
+# also records the size of the file after the last complete rewrite, which is used to
+# decide when to compact the file.
+TREE_MAGIC = b'MEDIAFS\x00'
+TREE_VERSION = 2
+_TREE_HEADER = struct.Struct('<8sI')
+_TREE_TRAILER = struct.Struct('<8sQQQ')
+_TREE_TRAILER_MAGIC = b'MFSROOT\x00'
 
 
 
@@ -1224,19 +3942,51 @@ class CachedRootDirectory(RootDirectory):
     They default to `.metadata.json` and `.tree.json`, respectively, and
     can be used to specify the paths to the metadata storage for this filesystem.
 
+    The `treeFormat` argument selects how the directory tree cache is written. It can be
+    either `"json"` or `"binary"`. The binary format is several times faster to save and
+    load, and is much smaller, but can only be read by MediaFS. When loading, the format of
+    an existing tree cache is detected automatically. If `treeFormat` is left as `None`,
+    the tree cache is written in the same format it was loaded in, or as JSON if there
+    was no tree cache yet.
+
     If `metadataFile=None` is passed to the constructor, metadata will not be
     saved or restored.
 
     If `treeFile=None` is passed to the constructor, the filesystem tree cache
     will not be saved or restored.
 
+    When using the binary format, ``save()`` only writes out directories that changed
+    since the tree cache was loaded or last saved, and appends them to the existing file.
+    Once the file has grown to `treeCompactRatio` times its size after the last complete
+    write, the whole file is rewritten to discard the outdated data.
+
+    If `lazyLoad=True` is passed to the constructor and the tree cache uses the binary
+    format, the cache file is memory mapped and only the contents of the root directory
+    are loaded by the constructor. The contents of every other directory are loaded from
+    the cache the first time they are needed, so the time and memory it takes to load the
+    cache depends on how much of the tree is actually used.
+
+    Metadata indexes created with ``RootDirectory.createIndex()`` are saved in a file with
+    the same name as `metadataFile` plus `.index`, and are created again when the metadata
+    is loaded.
+
+    If `nameIndex=True` is passed to the constructor, the root directory gets a name index
+    (see ``RootDirectory.createNameIndex()``), which is saved next to the tree cache in a
+    file with the same name as `treeFile` plus `.names`. The saved index is only used if
+    the tree cache didn't change after it was written.
+
     If `metadataFile` or `treeFile` are left at their default values, they will be
     created inside the root directory. Otherwise the values will be treated as
     paths to the metadata files, so it is up to the user to put them in a
     reasonable place.
     """
 
-    def __init__(self, path, metadataFile=".metadata.json", treeFile=".tree.json"):
+    # how large a binary tree cache can grow from incremental saves, relative to its size
+    # after the last complete write, before it gets compacted
+    treeCompactRatio = 2.0
+
+    def __init__(self, path, metadataFile=".metadata.json", treeFile=".tree.json", treeFormat=None,
+            lazyLoad=False, nameIndex=False):
         # Set the filenames of the metadata and tree files before calling the parent constructor.
         # The parent constructor will call _readMetadata and _readTreeData, so we need these values
         # to be available before that happens.
@@ -1250,6 +4000,21 @@ class CachedRootDirectory(RootDirectory):
             # if the filename is the default one, put it at the root of the filesystem
             self._treeFile = os.path.join(path, treeFile)
 
+        if treeFormat not in (None, "json", "binary"):
+            raise ValueError("Unknown tree cache format '%s'" % treeFormat)
+        self._treeFormat = treeFormat
+
+        # the size of the binary tree cache file when it was last loaded or saved, and
+        # its size after the last complete write
+        self._treeFileEnd = None
+        self._treeFileBase = None
+
+        # when loading lazily, this is a memory map of the binary tree cache file
+        self._lazyLoad = lazyLoad
+        self._treeMap = None
+
+        self._useNameIndex = nameIndex
+
         RootDirectory.__init__(self, path)
 
 
@@ -1291,6 +4056,8 @@ class CachedRootDirectory(RootDirectory):
         transformed back into FSObjects.
         """
         if '__fsobject' in data:
+            if not self.storePaths:
+                data['_path'] = data['_relpath'] = data['_abspath'] = None
             if data['__fsobject'] == 'File':
                 return self._getFileClass(data['name']).deserialize(data)
             elif data['__fsobject'] == 'Directory':
@@ -1311,22 +4078,369 @@ class CachedRootDirectory(RootDirectory):
 
     def _readTreeData(self):
         """
-        Reads the directory cache tree in from a JSON file
+        Reads the directory cache tree in from a JSON or binary file
         """
         if self._treeFile is not None and os.path.exists(self._treeFile):
-            with open(self._treeFile, 'r') as fp:
-                data = json.load(fp, object_hook=self._deserializeHandler)
+            with open(self._treeFile, 'rb') as fp:
+                if self._lazyLoad and fp.read(len(TREE_MAGIC)) == TREE_MAGIC:
+                    return self._readBinaryTreeData(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ), lazy=True)
+                fp.seek(0)
+                data = fp.read()
+
+            # Decoding the tree allocates a huge number of objects and none of them are garbage,
+            # so the cyclic garbage collector would just repeatedly scan the growing tree for nothing.
+            gcEnabled = gc.isenabled()
+            gc.disable()
+            try:
+                if data.startswith(TREE_MAGIC):
+                    return self._readBinaryTreeData(memoryview(data))
+
+                if self._treeFormat is None:
+                    self._treeFormat = "json"
+                data = json.loads(data.decode(), object_hook=self._deserializeHandler)
                 return (data['contents'], data['order'])
+            finally:
+                if gcEnabled:
+                    gc.enable()
         return (None, None)
 
 
     def _writeTreeData(self, tree, order):
         """
-        Writes the directory tree cache out to a JSON file
+        Writes the directory tree cache out to a JSON or binary file
         """
         if self._treeFile is not None:
-            with open(self._treeFile, 'w') as fp:
-                json.dump({'contents':tree, 'order':order}, fp, indent='\t', default=self._serializeHandler)
+            if self._treeFormat == "binary":
+                self._writeBinaryTreeData(tree)
+            else:
+                with open(self._treeFile, 'w') as fp:
+                    json.dump({'contents':tree, 'order':order}, fp, indent='\t', default=self._serializeHandler)
+
+
+    def _metadataIndexFile(self):
+        """
+        Returns the path of the file the metadata indexes are saved in, or None if they aren't saved
+        """
+        if self._mdFile is None:
+            return None
+        return self._mdFile + ".index"
+
+
+    def _readMetadataIndexes(self):
+        """
+        Reads in the indexed metadata keys and the locations of files with metadata from a marshal file
+        """
+        indexFile = self._metadataIndexFile()
+        if indexFile is not None and os.path.exists(indexFile):
+            with open(indexFile, 'rb') as fp:
+                version, keys, locations, complete = marshal.load(fp)
+            if version == TREE_VERSION:
+                return (keys, locations, complete)
+        return None
+
+
+    def _writeMetadataIndexes(self, keys, locations, complete):
+        """
+        Writes out the indexed metadata keys and the locations of files with metadata to a marshal file
+        """
+        indexFile = self._metadataIndexFile()
+        if indexFile is None:
+            return
+        if len(keys) == 0:
+            if os.path.exists(indexFile):
+                os.remove(indexFile)
+            return
+
+        tmpFile = indexFile + ".tmp"
+        with open(tmpFile, 'wb') as fp:
+            marshal.dump((TREE_VERSION, keys, locations, complete), fp)
+        os.replace(tmpFile, indexFile)
+
+
+    def _nameIndexFile(self):
+        """
+        Returns the path of the file the name index is saved in, or None if it isn't saved
+        """
+        if self._treeFile is None:
+            return None
+        return self._treeFile + ".names"
+
+
+    def _treeFileStamp(self):
+        """
+        Returns the size and modification time of the tree cache file, which are saved with
+        the name index to detect whether the tree cache changed after it was written.
+        """
+        st = os.stat(self._treeFile)
+        return (st.st_size, st.st_mtime_ns)
+
+
+    def _readNameIndex(self):
+        """
+        Reads in the name index from a marshal file if ``nameIndex=True`` was passed to the
+        constructor. Creates a new index if the file doesn't exist or doesn't match the tree cache.
+        """
+        self._nameIndexStamp = None
+        if not self._useNameIndex:
+            return None
+
+        indexFile = self._nameIndexFile()
+        if indexFile is not None and os.path.exists(indexFile) and os.path.exists(self._treeFile):
+            with open(indexFile, 'rb') as fp:
+                version, stamp, data = marshal.load(fp)
+            if version == TREE_VERSION and stamp == self._treeFileStamp():
+                self._nameIndexStamp = stamp
+                return NameIndex.deserialize(data)
+
+        self._nameIndex = None
+        return self.createNameIndex()
+
+
+    def _writeNameIndex(self, index):
+        """
+        Writes the name index out to a marshal file, unless neither the index nor the tree
+        cache changed since it was last written.
+        """
+        indexFile = self._nameIndexFile()
+        if indexFile is None:
+            return
+
+        stamp = self._treeFileStamp()
+        if not index.changed and stamp == self._nameIndexStamp:
+            return
+
+        tmpFile = indexFile + ".tmp"
+        with open(tmpFile, 'wb') as fp:
+            marshal.dump((TREE_VERSION, stamp, index.serialize()), fp)
+        os.replace(tmpFile, indexFile)
+        index.changed = False
+        self._nameIndexStamp = stamp
+
+
+    def _writeBinaryTreeData(self, tree):
+        """
+        Writes the directory tree cache out to a binary file. If the file hasn't been touched
+        since this object loaded or saved it, only the directories that were marked as changed
+        are appended to it. Otherwise, or if the file needs to be compacted, the whole tree
+        is written out to a new file.
+        """
+        incremental = (self._treeFileEnd is not None
+            and self._treeFileEnd < self._treeFileBase * self.treeCompactRatio
+            and os.path.exists(self._treeFile)
+            and os.path.getsize(self._treeFile) == self._treeFileEnd)
+
+        # nothing has changed since the last save
+        if incremental and self._treeBlock is not None:
+            return
+
+        # A complete write goes to a temporary file that replaces the cache file afterwards,
+        # because directories that were never loaded are copied over from the old file.
+        tmpFile = self._treeFile + ".tmp"
+        try:
+            with open(self._treeFile if incremental else tmpFile, 'ab' if incremental else 'wb') as fp:
+                if not incremental:
+                    fp.write(_TREE_HEADER.pack(TREE_MAGIC, TREE_VERSION))
+
+                # a zero length root block means the root directory was never refreshed
+                rootBlock = (0, 0)
+                if tree is not None:
+                    rootBlock = self._writeTreeBlock(fp, tree, incremental)
+
+                end = fp.tell() + _TREE_TRAILER.size
+                base = end if not incremental else self._treeFileBase
+                fp.write(_TREE_TRAILER.pack(_TREE_TRAILER_MAGIC, rootBlock[0], rootBlock[1], base))
+        except BaseException:
+            if incremental:
+                # cut off the partly written blocks, so the file still ends with the last
+                # trailer. some directories may point at the blocks that were cut off now,
+                # so the next save has to write the whole tree.
+                with open(self._treeFile, 'r+b') as fp:
+                    fp.truncate(self._treeFileEnd)
+                self._treeFileEnd = None
+            elif os.path.exists(tmpFile):
+                os.remove(tmpFile)
+            raise
+
+        self._treeFileBase = base
+
+        if not incremental:
+            os.replace(tmpFile, self._treeFile)
+            # every directory that hasn't been loaded yet now points at a block in the new file
+            if self._treeMap is not None:
+                self._treeMap.close()
+                with open(self._treeFile, 'rb') as fp:
+                    self._treeMap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._treeBlock = rootBlock
+        self._treeFileEnd = end
+
+
+    def _readBinaryTreeData(self, data, lazy=False):
+        """
+        Reads the directory tree from the contents of a binary tree cache file. If the file
+        was written by an incompatible version of MediaFS, the cache is ignored.
+
+        If ``lazy`` is True, ``data`` must be a memory map of the file, and only the contents
+        of the root directory are decoded.
+        """
+        if self._treeFormat is None:
+            self._treeFormat = "binary"
+
+        if len(data) < _TREE_HEADER.size + _TREE_TRAILER.size:
+            return (None, None)
+        magic, version = _TREE_HEADER.unpack_from(data, 0)
+        if version != TREE_VERSION:
+            return (None, None)
+
+        # the file normally ends with the trailer of the last save. if a save was interrupted,
+        # the trailer before the partly written data is used instead.
+        end = len(data)
+        while end >= _TREE_HEADER.size + _TREE_TRAILER.size:
+            magic, offset, length, base = _TREE_TRAILER.unpack_from(data, end - _TREE_TRAILER.size)
+            if magic == _TREE_TRAILER_MAGIC and offset + length <= end and base <= end:
+                try:
+                    contents = None
+                    if length > 0:
+                        contents = self._readTreeBlock(data, offset, length, recursive=not lazy)
+                except (ValueError, EOFError, TypeError, IndexError):
+                    contents = None
+                else:
+                    break
+            end = self._findTreeTrailer(data, end - 1)
+        else:
+            # there's no usable tree in the file, so it's written out again by the next save
+            return (None, None)
+
+        # remember where everything is. the next save can only be incremental if the file
+        # wasn't damaged, since it appends to the end of the file.
+        self._treeFileEnd = end
+        self._treeFileBase = base
+        self._treeBlock = (offset, length)
+
+        if lazy:
+            self._treeMap = data
+
+        if contents is None:
+            return (None, None)
+        return (contents, self._orderDirectory(contents))
+
+
+    def _findTreeTrailer(self, data, end):
+        """
+        Returns the position right after the last trailer magic that ends before ``end`` in
+        the binary tree cache ``data``, or 0 if there isn't one.
+        """
+        source = data if isinstance(data, mmap.mmap) else data.obj
+        pos = source.rfind(_TREE_TRAILER_MAGIC, _TREE_HEADER.size, end - _TREE_TRAILER.size + len(_TREE_TRAILER_MAGIC))
+        if pos < 0:
+            return 0
+        return pos + _TREE_TRAILER.size
+
+
+    def _readDirectoryContents(self, dirobj):
+        """
+        Reads in the contents of a directory that was not loaded by the constructor from
+        the memory mapped binary tree cache.
+        """
+        if self._treeMap is None or dirobj._treeBlock[1] == 0:
+            return None
+
+        contents = self._readTreeBlock(self._treeMap, dirobj._treeBlock[0], dirobj._treeBlock[1], recursive=False)
+        for item in contents.values():
+            item.parent = dirobj
+        return contents
+
+
+    def _readTreeBlock(self, data, offset, length, recursive=True):
+        """
+        Decodes the block at ``offset`` in the binary tree cache and returns a contents dict.
+        If ``recursive`` is True, the contents of all subdirectories are decoded as well.
+        Otherwise subdirectories only remember the location of their block.
+        """
+        schemas, records = marshal.loads(data[offset:offset + length])
+        contents = {}
+        for record in records:
+            isdir, fields = schemas[record[0]]
+            # the name is always the first serialized field
+            name = record[1][0]
+            if isdir:
+                item = self._getDirectoryClass(name)._deserializeRecord(fields, record[1])
+                item._treeBlock = record[2]
+                if recursive and record[2] is not None:
+                    item._contents = self._readTreeBlock(data, *record[2])
+                    for child in item._contents.values():
+                        child.parent = item
+            else:
+                item = self._getFileClass(name)._deserializeRecord(fields, record[1])
+            if not self.storePaths:
+                item._path = item._relpath = item._abspath = None
+            contents[name] = item
+        return contents
+
+
+    def _writeTreeBlock(self, fp, contents, incremental=False):
+        """
+        Writes one directory's contents to the binary tree cache, after first writing the
+        blocks for all of its subdirectories. Returns the offset and length of the block.
+
+        If ``incremental`` is True, subdirectories that haven't been marked as changed
+        since they were last written are not written again - their records just point
+        at their existing blocks.
+
+        Each block stores the serialized fields of every item as a tuple of values. The
+        field names are only stored once per block for each class that appears in it.
+        """
+        schemas = []
+        schemaIndex = {}
+        records = []
+        for item in contents.values():
+            cls = item.__class__
+            if cls not in schemaIndex:
+                fields = ('name',) + tuple(f for f in cls.serializeFields if f not in ('name', '_contents'))
+                schemaIndex[cls] = len(schemas)
+                schemas.append((item.isdir, fields))
+            idx = schemaIndex[cls]
+            values = tuple([ getattr(item, f) for f in schemas[idx][1] ])
+
+            if item.isdir:
+                if item._contents is None:
+                    # the contents of this directory were never loaded from the tree cache,
+                    # so the old data is either still in place or has to be copied over
+                    if not incremental and item._treeBlock is not None:
+                        item._treeBlock = self._copyTreeBlock(fp, item._treeBlock)
+                elif not incremental or item._treeBlock is None:
+                    item._treeBlock = self._writeTreeBlock(fp, item._contents, incremental)
+                records.append((idx, values, item._treeBlock))
+            else:
+                records.append((idx, values))
+
+        data = marshal.dumps((schemas, records))
+        offset = fp.tell()
+        fp.write(data)
+        return (offset, len(data))
+
+
+    def _copyTreeBlock(self, fp, block):
+        """
+        Copies the block of a directory that was never loaded from the memory mapped tree cache
+        into a new tree cache file, along with the blocks of all of its subdirectories. No
+        FSObjects are created. Returns the offset and length of the new block.
+        """
+        data = self._treeMap[block[0]:block[0] + block[1]]
+        schemas, records = marshal.loads(data)
+
+        # subdirectory blocks are copied first, and then the records that point at them are updated
+        subdirs = False
+        for i in range(len(records)):
+            if len(records[i]) == 3 and records[i][2] is not None:
+                records[i] = records[i][:2] + (self._copyTreeBlock(fp, records[i][2]),)
+                subdirs = True
+        if subdirs:
+            data = marshal.dumps((schemas, records))
+
+        offset = fp.tell()
+        fp.write(data)
+        return (offset, len(data))
 
 
 
@@ -1348,9 +4462,13 @@ def mkRootDirectoryBaseClass(FileCls=File, DirectoryCls=Directory, RootDirectory
         FileClass = FileCls
         DirectoryClass = DirectoryCls
 
+    # attributes that describe the instance layout of a class and can't be copied to another class
+    layoutAttrs = ('__dict__', '__weakref__', '__slots__')
+
     # apply all of the root directory attributes to this new root directory class
     for name, obj in RootDirectory.__dict__.items():
-        setattr(RootDir, name, obj)
+        if name not in layoutAttrs:
+            setattr(RootDir, name, obj)
 
     # if the specified root directory class isn't the default, also apply any extra
     # stuff from the specified one as well.
@@ -1359,7 +4477,13 @@ def mkRootDirectoryBaseClass(FileCls=File, DirectoryCls=Directory, RootDirectory
             raise Exception("The RootDirectoryCls argument must inherit directly from RootDirectory.")
 
         for name, obj in RootDirectoryCls.__dict__.items():
-            setattr(RootDir, name, obj)
+            if name not in layoutAttrs:
+                setattr(RootDir, name, obj)
+
+    # the root directory attributes include the default FileClass and DirectoryClass,
+    # so make sure the requested classes are the ones that get used
+    RootDir.FileClass = FileCls
+    RootDir.DirectoryClass = DirectoryCls
 
     return RootDir
 
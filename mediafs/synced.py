@@ -9,27 +9,37 @@ import functools
 import signal
 import logging
 import asyncio
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from mediafs import (RootDirectory, CachedRootDirectory, Directory, mkRootDirectoryBaseClass)
-
-try:
-    import butter
-except ImportError:
-    print("===")
-    print("Butter library not found (Linux-only, https://pypi.python.org/pypi/butter/0.11.1)")
-    print("===")
-    raise
-
-from butter.asyncio.inotify import Inotify_async
-from butter.inotify import (event_name, IN_ACCESS, IN_MODIFY, IN_ATTRIB,
-    IN_CLOSE_WRITE, IN_CLOSE_NOWRITE, IN_OPEN, IN_MOVED_FROM, IN_MOVED_TO,
-    IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF, IN_ONLYDIR,
-    IN_DONT_FOLLOW, IN_EXCL_UNLINK, IN_MASK_ADD, IN_ISDIR, IN_ONESHOT,
-    IN_ALL_EVENTS)
+from mediafs.fs import _statSignature
+
+# event flags (from <sys/inotify.h>), which are used by every event source
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_MASK_ADD = 0x20000000
+IN_ISDIR = 0x40000000
+IN_ONESHOT = 0x80000000
+IN_ALL_EVENTS = 0x00000fff
 
 DIR_EVENTS = [IN_MODIFY, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE]
-EVENT_NAMES = { k:v for k,v in event_name.items() if isinstance(k, str) and k != 'IN_ALL_EVENTS' }
+EVENT_NAMES = { k:v for k,v in list(globals().items()) if k.startswith('IN_') and k != 'IN_ALL_EVENTS' }
 DIR_FLAGS = 0
 for evt in DIR_EVENTS:
     DIR_FLAGS |= evt
@@ -40,6 +50,13 @@ for evt in DIR_EVENTS:
 #      "create", "modify", "delete", "movefrom", "moveto"
 FileEvent = namedtuple("FileEvent", ["type", "parent", "name"])
 
+# InotifyEvent named tuple - the events that an EventSource passes on are these, or any other
+# object with the same fields, like the events of the butter library.
+# "wd" is the handle that EventSource.watch() returned for the directory the event happened in,
+# "mask" is a combination of the IN_* flags, "cookie" is the same for both events of a move, and
+# "filename" is the name (str or bytes) of the file or directory inside that directory.
+InotifyEvent = namedtuple("InotifyEvent", ["wd", "mask", "cookie", "filename"])
+
 
 def _flagsToStr(evt):
     """
@@ -53,49 +70,362 @@ def _flagsToStr(evt):
     return flags
 
 
+def _statMtime(path):
+    """
+    Returns the current modification time of ``path`` in nanoseconds, or None if it can't
+    be read. Only takes a path, so that it can be called on another thread.
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+
+class EventSource(object):
+    """
+    Interface for the objects that tell a ``SyncedRootDirectory`` about changes to the
+    directories it watches. The default one is ``InotifySource``.
+    """
+
+    def watch(self, path):
+        """
+        Starts watching the directory at ``path`` for files and directories that are created,
+        modified, deleted or moved inside of it, and returns a handle that the events for the
+        directory will have as their ``wd``. Watching a directory that is already watched
+        returns the same handle. Raises an OSError if the directory can't be watched.
+        """
+        raise NotImplementedError()
+
+
+    def unwatch(self, handle):
+        """
+        Stops watching the directory that ``handle`` was returned for
+        """
+        raise NotImplementedError()
+
+
+    def attach(self, loop, onEvents):
+        """
+        Starts passing events to ``onEvents``, which is called by ``loop`` with a list of
+        ``InotifyEvent`` objects (or objects with the same fields) in the order they happened.
+        """
+        raise NotImplementedError()
+
+
+    def detach(self):
+        """
+        Stops passing events to the callback given to ``attach()``
+        """
+        raise NotImplementedError()
+
+
+
+class InotifySource(EventSource):
+    """
+    Reads inotify events with the butter library (Linux-only, https://pypi.python.org/pypi/butter).
+    Every event that is available is read as soon as the inotify file descriptor becomes readable.
+    """
+
+    def __init__(self):
+        try:
+            from butter.inotify import Inotify, IN_NONBLOCK
+        except ImportError:
+            raise ImportError("Butter library not found (Linux-only, https://pypi.python.org/pypi/butter/0.11.1)")
+
+        self._inotify = Inotify(IN_NONBLOCK)
+        self._loop = None
+        self._onEvents = None
+
+
+    def watch(self, path):
+        return self._inotify.watch(path, DIR_FLAGS)
+
+
+    def unwatch(self, handle):
+        self._inotify.del_watch(handle)
+
+
+    def attach(self, loop, onEvents):
+        self._loop = loop
+        self._onEvents = onEvents
+        loop.add_reader(self._inotify.fileno(), self._readEvents)
+
+
+    def detach(self):
+        if self._loop is not None:
+            self._loop.remove_reader(self._inotify.fileno())
+            self._loop = None
+            self._onEvents = None
+
+
+    def _readEvents(self):
+        """
+        Called by the event loop when the inotify file descriptor is readable. Reads every
+        event that is available without waiting.
+        """
+        events = []
+        while True:
+            try:
+                batch = self._inotify.read_events()
+            except BlockingIOError:
+                break
+            if not batch:
+                break
+            events.extend(batch)
+
+        if len(events) > 0:
+            self._onEvents(events)
+
+
+
+class ScriptedEventSource(EventSource):
+    """
+    An event source that doesn't look at the filesystem at all, and only passes on the events
+    it's given to ``replay()``. Useful for testing and benchmarking the handling of events
+    without depending on the kernel. The ``create()``, ``modify()``, ``delete()``, ``move()``
+    and ``overflow()`` methods make the events that inotify would send for each change.
+
+    Like inotify, there are only events for the directories that are watched, and removing a
+    watch passes on an IN_IGNORED event for it. Directories are identified by the path they had
+    when they were first watched.
+    """
+
+    def __init__(self):
+        # path -> handle, and handle -> path
+        self._handles = {}
+        self._paths = {}
+        self._nextHandle = 1
+        self._nextCookie = 1
+        self._onEvents = None
+
+
+    def watch(self, path):
+        handle = self._handles.get(path)
+        if handle is None:
+            handle = self._nextHandle
+            self._nextHandle += 1
+            self._handles[path] = handle
+            self._paths[handle] = path
+        return handle
+
+
+    def unwatch(self, handle):
+        del self._handles[self._paths.pop(handle)]
+        self.replay([ InotifyEvent(handle, IN_IGNORED, 0, "") ])
+
+
+    def attach(self, loop, onEvents):
+        self._onEvents = onEvents
+
+
+    def detach(self):
+        self._onEvents = None
+
+
+    def isWatched(self, path):
+        """
+        Returns True if the directory at ``path`` is watched
+        """
+        return path in self._handles
+
+
+    def replay(self, events):
+        """
+        Passes ``events`` on right away, like one read of the inotify file descriptor
+        """
+        if self._onEvents is not None and len(events) > 0:
+            self._onEvents(list(events))
+
+
+    def create(self, path, isDir=False):
+        """
+        Returns the events for creating the file or directory at ``path``
+        """
+        return self._events(path, IN_CREATE, isDir, 0)
+
+
+    def modify(self, path):
+        """
+        Returns the events for writing to the file at ``path``
+        """
+        return self._events(path, IN_MODIFY, False, 0)
+
+
+    def delete(self, path, isDir=False):
+        """
+        Returns the events for deleting the file or directory at ``path``
+        """
+        return self._events(path, IN_DELETE, isDir, 0)
+
+
+    def move(self, srcPath, destPath, isDir=False):
+        """
+        Returns the events for moving the file or directory at ``srcPath`` to ``destPath``
+        """
+        cookie = self._nextCookie
+        self._nextCookie += 1
+        return self._events(srcPath, IN_MOVED_FROM, isDir, cookie) + \
+            self._events(destPath, IN_MOVED_TO, isDir, cookie)
+
+
+    def overflow(self):
+        """
+        Returns the event that is sent when the kernel's event queue overflowed
+        """
+        return [ InotifyEvent(-1, IN_Q_OVERFLOW, 0, "") ]
+
+
+    def _events(self, path, mask, isDir, cookie):
+        handle = self._handles.get(os.path.dirname(path))
+        if handle is None:
+            return []
+        if isDir:
+            mask |= IN_ISDIR
+        return [ InotifyEvent(handle, mask, cookie, os.path.basename(path)) ]
+
+
 
 class SyncedDirectory(Directory):
     """
     A Directory object with helper methods to keep it in sync with the filesystem.
     """
+    # modification time of the directory (in nanoseconds) when its listing was last read
+    __slots__ = ('_mtimeNs',)
+
     def __init__(self, *args, **kwargs):
+        self._mtimeNs = None
         super().__init__(*args, **kwargs)
+
+
+    @classmethod
+    def deserialize(cls, attrs):
+        inst = super().deserialize(attrs)
+        inst._mtimeNs = None
+        return inst
+
+
+    @classmethod
+    def _deserializeRecord(cls, fields, values):
+        inst = super()._deserializeRecord(fields, values)
+        inst._mtimeNs = None
+        return inst
+
+
+    def _refresh(self, files, recursive, lister):
+        # directories are only watched once their contents are loaded, and the watch is set up
+        # before the listing is read so that no change can be missed in between.
+        if len(files) == 0:
+            self.root._inotifyRegister(self)
+
+        # the modification time is read before the listing too, so that any change made while
+        # the listing is read makes it look out of date. a listing from ``lister`` may have
+        # been read earlier, so its directory is never assumed to be unchanged.
+        mtimeNs = None
+        if len(files) == 0 and lister is None:
+            mtimeNs = self._statMtime()
+        super()._refresh(files, recursive, lister)
+        if len(files) == 0:
+            self._mtimeNs = mtimeNs
+
+
+    def _sync(self, recursive, onAdded, onDeleted, onModified, onRenamed, moves, prefetched=None):
+        # see _refresh()
         self.root._inotifyRegister(self)
+        mtimeNs = self._statMtime() if prefetched is None else None
+        dirChanged = super()._sync(recursive, onAdded, onDeleted, onModified, onRenamed, moves, prefetched)
+        self._mtimeNs = mtimeNs
+        return dirChanged
 
 
-    def _inotifyCreate(self, evt, isDir):
+    def _loadCachedContents(self):
+        if self._contents is not None:
+            return True
+        if not super()._loadCachedContents():
+            return False
+        self.root._inotifyRegister(self)
+        return True
+
+
+    @property
+    def contents(self):
+        # directories that are looked at are the last ones to lose their watches
+        self.root._touchWatch(self)
+        return super().contents
+
+
+    @property
+    def order(self):
+        # see contents, this is what walks over the tree look at
+        self.root._touchWatch(self)
+        return super().order
+
+
+    def _statMtime(self):
         """
-        Called when a file or directory is created inside this directory.
+        Returns the current modification time of this directory in nanoseconds, or None if
+        it can't be read.
         """
-        filename = evt.filename.decode()
-        self.refresh(filename)
+        return _statMtime(self.path)
 
 
-    def _inotifyModify(self, evt, isDir):
+    def _inotifyRefresh(self, filenames):
+        """
+        Called with the names of all files and directories that were created or deleted
+        inside this directory in one batch of events.
+        """
+        # a directory that wasn't loaded yet is read when its contents are needed
+        if self._contents is None and not self._loadCachedContents():
+            return
+        self.refresh(*filenames)
+
+
+    def _inotifyModify(self, filename, isDir):
         """
         Called when a file or directory is modified inside this directory.
         """
-        if not isDir:
-            filename = evt.filename.decode()
-            f = self[filename]
-            # invalidate the hashes
+        if not isDir and self._contents is not None:
+            f = self._contents.get(filename)
+            if f is None:
+                # the file was never seen, so it needs to be added
+                self.refresh(filename)
+                return
+            # the size and modification time changed (which updates the totals of the parent
+            # directories), and so did the contents
+            try:
+                f._updateStat(_statSignature(os.stat(f.path)))
+            except OSError:
+                # the file is gone, which the events that come next will show
+                pass
             f._crc = None
             f._md5 = None
             f._fasthash = None
+            f._markDirty()
 
 
-    def _inotifyMove(self, srcEvt, destEvt, destDir, isDir):
+    def _inotifyMove(self, srcFilename, destFilename, destDir, isDir):
         """
         Called when a file or directory in this directory is moved somewhere
         """
-        srcFilename = srcEvt.filename.decode()
-        destFilename = destEvt.filename.decode()
-
-        srcFile = self[srcFilename]
+        srcFile = self._contents.get(srcFilename) if self._contents is not None else None
 
         logging.debug("_inotifyMove '%s' to '%s'" %
             (os.path.join(self.relpath, srcFilename),
-            os.path.join(self.relpath, destFilename)))
+            os.path.join(destDir.relpath, destFilename)))
+
+        # the item was never seen, so only the destination needs to be looked at
+        if srcFile is None:
+            logging.debug("REFRESH METHOD")
+            if destDir._contents is not None:
+                destDir.refresh(destFilename)
+            return
+
+        # anything that was at the destination was replaced
+        if destDir._contents is not None:
+            replaced = destDir._contents.get(destFilename)
+            if replaced is not None and replaced is not srcFile:
+                self.root._pathDelete(replaced)
+                destDir._pop(replaced)
 
         # simple rename operation?
         if self == destDir:
@@ -103,24 +433,16 @@ class SyncedDirectory(Directory):
             srcFile.rename(destFilename, syscall=False)
 
         # move the file object pointer directly if we have dicts available for both dirs
-        elif self._contents is not None and destDir._contents is not None:
+        elif destDir._contents is not None:
             logging.debug("DIRECT METHOD")
             self._pop(srcFile)
+            srcFile.name = destFilename
             destDir._push(srcFile)
 
-        # otherwise just refresh both files on both sides to ensure they're in sync
+        # the destination will be scanned when its contents are needed
         else:
-            logging.debug("REFRESH_METHOD")
-            self.refresh(srcFilename, destFilename)
-            destDir.refresh(srcFilename, destFilename)
-
-
-    def _inotifyDelete(self, evt, isDir):
-        """
-        Called when a file or directory is deleted inside this directory.
-        """
-        filename = evt.filename.decode()
-        self.refresh(filename)
+            logging.debug("REMOVE METHOD")
+            self._pop(srcFile)
 
 
 # make a CachedRootDirectory class that has SyncedDirectory as a subclass
@@ -135,13 +457,109 @@ class SyncedRootDirectory(SyncedCachedRootDir):
     """
     DirectoryClass = SyncedDirectory
 
+    # The most events that are processed in one batch. Everything that the event source can
+    # read is read right away, and split into batches of this size.
+    maxBatchSize = 4096
+
+    # The longest time (in seconds) that an event waits for more events to be read before
+    # its batch is passed on. Events that arrive together are coalesced, so a longer wait
+    # means less work during large copies, and a shorter one means changes show up sooner.
+    maxLatency = 0.01
+
+    # The most inotify watches that are used, or None for no limit. Only directories whose
+    # contents are loaded are watched. When there are more of them, the directories that
+    # haven't been used or had any events for the longest time aren't watched anymore (but
+    # never before their subdirectories), and are checked for changes every ``pollInterval``
+    # seconds instead. Keep this below the system-wide limit in
+    # /proc/sys/fs/inotify/max_user_watches.
+    maxWatches = 8192
+
+    # How often (in seconds) the directories that aren't watched are checked for changes
+    pollInterval = 5.0
+
+
+    def __init__(self, path, loop, eventSource=None):
+        """
+        ``eventSource`` is the ``EventSource`` that the filesystem events come from, which is
+        a new ``InotifySource`` if it's None.
+        """
+        # the root directory doesn't run SyncedDirectory.__init__()
+        self._mtimeNs = None
+        self._loop = loop
+        self._eventSource = eventSource if eventSource is not None else InotifySource()
+        # watch handle -> directory object, least recently used first
+        self._inotifyHandles = OrderedDict()
+        # directory object -> watch handle
+        self._watchHandles = {}
+        # watch handle -> directory object, for watches that were removed by _inotifyRegister()
+        # but still have events waiting to be processed
+        self._evictedHandles = {}
+        # directories that are loaded but not watched, which are polled instead
+        self._unwatched = OrderedDict()
+        self._pollTask = None
+
+        # events that were read but not passed on yet, and the timer that passes them on
+        self._eventBuffer = []
+        self._flushHandle = None
+        # batches of events waiting for processFilesystemEvents()
+        self._eventBatches = asyncio.Queue()
+        # directories that may have missed events -> whether their subdirectories did too
+        self._outOfSync = {}
+        # directories are watched while the tree cache is loaded, so the events are read from
+        # the start
+        self._eventSource.attach(loop, self._eventsRead)
 
-    def __init__(self, path, loop):
         super().__init__(path)
-        self._inotify = Inotify_async(loop=loop)
-        self._inotifyHandles = {}
+
+        # the directories that were loaded from the tree cache need to be watched too
         self._inotifyRegister(self)
-        self._futureInotifyEvent = None
+        stack = [ self ]
+        while stack:
+            dirobj = stack.pop()
+            for item in dirobj._contents.values() if dirobj._contents is not None else ():
+                if item.isdir and item._contents is not None:
+                    self._inotifyRegister(item)
+                    stack.append(item)
+
+        # events only carry the directory and the name, so any other item is found by its path
+        self.createPathIndex()
+
+
+    def _eventsRead(self, events):
+        """
+        Called by the event source with the events that it read. Passes full batches on
+        right away, and the rest after at most ``maxLatency`` seconds.
+        """
+        self._eventBuffer.extend(events)
+
+        while len(self._eventBuffer) >= self.maxBatchSize:
+            self._flushEvents()
+
+        if len(self._eventBuffer) > 0 and self._flushHandle is None:
+            self._flushHandle = self._loop.call_later(self.maxLatency, self._flushEvents)
+
+
+    def _flushEvents(self):
+        """
+        Puts the oldest ``maxBatchSize`` events that were read on the queue of batches
+        """
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+
+        # don't split up the two events of a move
+        size = self.maxBatchSize
+        if len(self._eventBuffer) > size and self._eventBuffer[size - 1].mask & IN_MOVED_FROM and \
+                self._eventBuffer[size].cookie == self._eventBuffer[size - 1].cookie:
+            size += 1
+
+        batch = self._eventBuffer[:size]
+        del self._eventBuffer[:size]
+        if len(batch) > 0:
+            self._eventBatches.put_nowait(batch)
+
+        if len(self._eventBuffer) > 0:
+            self._flushHandle = self._loop.call_later(self.maxLatency, self._flushEvents)
 
 
     def isSynced(self):
@@ -176,17 +594,130 @@ class SyncedRootDirectory(SyncedCachedRootDir):
         return True
 
 
+    def lookup(self, relpath, default=None):
+        item = super().lookup(relpath)
+        if item is None:
+            return default
+        # see SyncedDirectory.contents
+        self._touchWatch(item if item.isdir else item.parent)
+        return item
+
+
+    def _inTree(self, dirobj):
+        """
+        Returns True if ``dirobj`` wasn't removed from the tree. Unlike ``lookup()``, this
+        doesn't count as using the directory.
+        """
+        return dirobj is self or super().lookup(dirobj.relpath) is dirobj
+
+
+    def _touchWatch(self, dirobj):
+        """
+        Marks the watches of ``dirobj`` and of the directories above it as the most recently
+        used ones, so that a directory is never the next one to lose its watch while any of
+        its subdirectories are watched. The root directory is only evicted last.
+        """
+        handles = self._watchHandles
+        while dirobj is not None:
+            handle = handles.get(dirobj)
+            if handle is not None:
+                self._inotifyHandles.move_to_end(handle)
+            dirobj = dirobj.parent
+
+
     def _inotifyRegister(self, dirobj):
         """
         Because the butter library does not do any sort of recursive watching,
-        this callback, which is called in the constructor of every directory
-        object, will set up a watch for that directory.
+        this callback, which is called whenever the contents of a directory object
+        are loaded, will set up a watch for that directory. If that takes the number
+        of watches over ``maxWatches``, the least recently used watch is removed, see
+        ``_touchWatch()``.
         """
-        handle = self._inotify.watch(dirobj.abspath, DIR_FLAGS)
-
-        # allow lookups by either handle or relative path
+        try:
+            handle = self._eventSource.watch(dirobj.abspath)
+        except OSError:
+            # out of watches, or the directory is gone, which polling will find out
+            self._pollDirectory(dirobj)
+            return
+
+        # directories are looked up by their relative path with lookup(), which stays
+        # correct when they're renamed or moved. a directory that was refreshed again is a new
+        # object that gets the watch of the old one.
+        previous = self._inotifyHandles.get(handle)
+        if previous is not None and previous is not dirobj:
+            self._forgetWatch(previous, handle)
         self._inotifyHandles[handle] = dirobj
-        self._inotifyHandles[dirobj.relpath] = handle
+        self._watchHandles[dirobj] = handle
+        self._touchWatch(dirobj)
+        self._unwatched.pop(dirobj, None)
+
+        while self.maxWatches is not None and len(self._inotifyHandles) > self.maxWatches:
+            handle, evicted = self._inotifyHandles.popitem(last=False)
+            self._forgetWatch(evicted, handle)
+            # the watch kept the directory in sync until now, so polling only has to look for
+            # changes from here on. the events that were read before the watch is removed are
+            # still processed, up to its IN_IGNORED event.
+            evicted._mtimeNs = evicted._statMtime()
+            self._evictedHandles[handle] = evicted
+            try:
+                self._eventSource.unwatch(handle)
+            except OSError:
+                pass
+            self._pollDirectory(evicted)
+
+
+    def _forgetWatch(self, dirobj, handle):
+        """
+        Removes ``dirobj`` from the directories that are watched with ``handle``
+        """
+        if self._watchHandles.get(dirobj) == handle:
+            del self._watchHandles[dirobj]
+
+
+    def _pollDirectory(self, dirobj):
+        """
+        Checks ``dirobj`` for changes every ``pollInterval`` seconds until it's watched again
+        """
+        self._unwatched[dirobj] = None
+        if self._pollTask is None:
+            self._pollTask = self._loop.create_task(self._pollUnwatched())
+
+
+    async def _pollUnwatched(self):
+        """
+        Compares the modification times of the directories that aren't watched with the ones
+        they had when their listings were last read. Directories that changed are watched
+        again, since they are in use, and synced with ``_resync()`` by the next call to
+        ``processFilesystemEvents()``. Changes that don't affect the modification time of the
+        directory, like files that were only modified, aren't found this way.
+        """
+        while len(self._unwatched) > 0:
+            await asyncio.sleep(self.pollInterval)
+            dirs = list(self._unwatched)
+            # only the paths are passed to the thread pool, see _resync()
+            paths = [ dirobj.path for dirobj in dirs ]
+            mtimes = await self._runBlocking(lambda: [ _statMtime(path) for path in paths ])
+
+            changed = False
+            for dirobj, mtimeNs in zip(dirs, mtimes):
+                if dirobj not in self._unwatched:
+                    continue
+                if mtimeNs is None or not self._inTree(dirobj):
+                    # the directory is gone, which its parent directory will show
+                    del self._unwatched[dirobj]
+                elif mtimeNs != dirobj._mtimeNs:
+                    # the sync reads the modification time again, this only keeps the change
+                    # from being found twice before that
+                    dirobj._mtimeNs = mtimeNs
+                    self._inotifyRegister(dirobj)
+                    self._markOutOfSync(dirobj, False)
+                    changed = True
+
+            # an empty batch lets processFilesystemEvents() sync them
+            if changed:
+                self._eventBatches.put_nowait([])
+
+        self._pollTask = None
 
 
     def _getInotifyEventDir(self, evt):
@@ -197,14 +728,15 @@ class SyncedRootDirectory(SyncedCachedRootDir):
         return self._inotifyHandles[evt.wd]
 
 
-    @asyncio.coroutine
-    def processFilesystemEvents(self):
+    async def processFilesystemEvents(self, wait=False):
         """
-        Tries to get new events from the filesystem. If any events exist, more events will be
-        retrieved with a timeout of 0.05 seconds until the timeout expires, at which time
-        all of the retrieved events will be processed.
+        Processes the batches of filesystem events that were read so far, so that this
+        object stays in sync with the filesystem. If there aren't any and ``wait`` is True,
+        waits for the next batch first, otherwise an empty list is returned right away.
 
-        Each event will be processed so that this object stays in sync with the filesystem.
+        Events are read from the event source as soon as they are available, and passed on in
+        batches of up to ``maxBatchSize`` events, at most ``maxLatency`` seconds after the first
+        event of the batch was read.
 
         A list of all processed events will be returned in a list of ``FileEvent`` objects,
         which is a namedtuple containing 3 fields: ``type``, ``parent``, ``name``.
@@ -219,98 +751,258 @@ class SyncedRootDirectory(SyncedCachedRootDir):
 
         Note that in the returned list of events, any time a "movefrom" event occurs, a
         "moveto" event is guaranteed to come after it.
+
+        Repeated events for the same file in one batch are coalesced into one, for example
+        a "create" followed by any number of "modify" events is returned as a single "create",
+        and a file that was created and deleted again isn't returned at all. See
+        ``_processEvents()``.
+
+        If events were lost, because the kernel's event queue overflowed or something was
+        moved into or out of the tree, the directories that may have missed them are synced
+        again, and the changes that were found are returned like any other events.
+        """
+        returnValues = []
+        if wait and self._eventBatches.empty():
+            returnValues.extend(await self._processBatch(await self._eventBatches.get()))
+
+        while not self._eventBatches.empty():
+            returnValues.extend(await self._processBatch(self._eventBatches.get_nowait()))
+
+        return returnValues
+
+
+    async def _processBatch(self, events):
+        """
+        Processes one batch of events with ``_processEvents()``, and then resyncs the
+        directories that may have missed events with ``_resync()``.
         """
-        if self._futureInotifyEvent is None:
-            self._futureInotifyEvent = asyncio.ensure_future(self._inotify.get_event())
+        returnValues = self._processEvents(events)
+        if len(self._outOfSync) > 0:
+            returnValues.extend(await self._resync())
+        return returnValues
 
-        results = []
-        if self._futureInotifyEvent is not None and self._futureInotifyEvent.done():
-            try:
-                result = self._futureInotifyEvent.result()
-                results.append(result)
-            except asyncio.CancelledError:
-                return []
-
-            # see if more events will follow this one
-            moreEvents = True
-            while moreEvents:
-                try:
-                    nextResult = yield from asyncio.wait_for(self._inotify.get_event(), 0.05)
-                    results.append(nextResult)
-                except asyncio.TimeoutError:
-                    moreEvents = False
-
-            self._futureInotifyEvent = None
-
-        # for every event, we're going to add a 3-tuple to this array representing the event
+
+    def _processEvents(self, events):
+        """
+        Routes a batch of inotify events to the directory objects, and returns the list of
+        ``FileEvent`` objects for ``processFilesystemEvents()``.
+
+        The events for each file are coalesced first (see ``_coalesceEvent()``), and then each
+        directory gets a single ``_inotifyRefresh()`` call with the names of all files that
+        were created or deleted in it, while files that were only modified go to
+        ``_inotifyModify()``. Moves are matched up by their cookie and handled in order, after
+        everything that happened before them.
+
+        If the kernel's event queue overflowed, or a move doesn't have both of its events (for
+        example because something was moved into or out of the watched tree), the directories
+        that are affected are marked with ``_markOutOfSync()``, to be resynced after the batch.
+        """
+        returnValues = []
+
+        # (directory, name) -> [list of coalesced event types, isDir, whether it needs a refresh]
+        pending = OrderedDict()
+        # cookie -> (directory, name) of MOVED_FROM events that are waiting for their MOVED_TO
+        movedFrom = {}
+
+        for evt in events:
+            if evt.mask & IN_Q_OVERFLOW:
+                # events were lost, so any directory may be out of date
+                logging.warning("Inotify event queue overflowed, resyncing '%s'" % self.abspath)
+                self._markOutOfSync(self, True)
+                # the directories that lost their watches may have changed since their
+                # modification time was read, without an event for it
+                for evicted in self._evictedHandles.values():
+                    self._markOutOfSync(evicted, False)
+                self._evictedHandles.clear()
+                continue
+
+            if evt.mask & IN_IGNORED:
+                # the watch was removed, because the directory was deleted or by _inotifyRegister()
+                dirobj = self._inotifyHandles.pop(evt.wd, None)
+                if dirobj is not None:
+                    self._forgetWatch(dirobj, evt.wd)
+                self._evictedHandles.pop(evt.wd, None)
+                continue
+
+            dirobj = self._inotifyHandles.get(evt.wd)
+            if dirobj is not None:
+                # directories with recent events are the last ones to lose their watches
+                self._touchWatch(dirobj)
+            else:
+                dirobj = self._evictedHandles.get(evt.wd)
+                if dirobj is None:
+                    continue
+            name = os.fsdecode(evt.filename)
+            mask = evt.mask
+            isDir = bool(mask & IN_ISDIR)
+
+            if mask & IN_MOVED_FROM:
+                movedFrom[evt.cookie] = (dirobj, name)
+                continue
+
+            if mask & IN_MOVED_TO:
+                if evt.cookie not in movedFrom:
+                    logging.debug("Got a MOVED_TO event without a MOVED_FROM event for file '%s'" % (
+                        os.path.join(dirobj.abspath, name)))
+                    self._markOutOfSync(dirobj, False)
+                    continue
+                # the move has to see everything that happened before it
+                returnValues.extend(self._applyEvents(pending))
+                pending = OrderedDict()
+
+                srcDir, srcName = movedFrom.pop(evt.cookie)
+                srcDir._inotifyMove(srcName, name, dirobj, isDir)
+                # in our return values, movefrom and moveto will ALWAYS be a pair, and
+                # movefrom will ALWAYS come before moveto.
+                returnValues.append(FileEvent("movefrom", srcDir, srcName))
+                returnValues.append(FileEvent("moveto", dirobj, name))
+                continue
+
+            if mask & IN_CREATE:
+                evtType = "create"
+            elif mask & IN_MODIFY:
+                evtType = "modify"
+            elif mask & IN_DELETE:
+                evtType = "delete"
+            else:
+                continue
+
+            state = pending.get((dirobj, name))
+            if state is None:
+                state = pending[(dirobj, name)] = [ [], isDir, False ]
+            self._coalesceEvent(state[0], evtType)
+            state[1] = isDir
+            state[2] = state[2] or evtType != "modify"
+
+        for dirobj, name in movedFrom.values():
+            logging.debug("Got a MOVED_FROM event without a MOVED_TO event for file '%s'" % (
+                os.path.join(dirobj.abspath, name)))
+            self._markOutOfSync(dirobj, False)
+
+        returnValues.extend(self._applyEvents(pending))
+        return returnValues
+
+
+    def _markOutOfSync(self, dirobj, recursive):
+        """
+        Marks ``dirobj`` as possibly out of sync with the filesystem, so that it's resynced by
+        ``_resync()``. If ``recursive`` is True, all of its subdirectories are resynced as well.
+        """
+        self._outOfSync[dirobj] = self._outOfSync.get(dirobj, False) or recursive
+
+
+    async def _resync(self):
+        """
+        Calls ``asyncSync()`` on each directory that was marked with ``_markOutOfSync()``,
+        instead of rescanning the whole tree. Subdirectories of a directory that is resynced
+        recursively are skipped if their modification time didn't change since their listing
+        was last read, since nothing was added to, removed from or renamed in them. Directories
+        that were never loaded are left alone, they're read when their contents are needed.
+        The directories are listed, and the files in them are hashed, on the thread pool of the
+        root directory, so the event loop keeps running.
+
+        Returns the changes that were found as a list of ``FileEvent`` objects. A file that was
+        renamed is returned as a "movefrom" and "moveto" pair. Files that were moved between
+        directories are returned as a "delete" and a "create". ``asyncSync()`` hashes the files
+        that weren't hashed yet, but they're only returned as modified if their stat signature
+        changed.
+        """
         returnValues = []
 
-        # go through all the results and route them to helper methods on the Directory objects
-        for i in range(len(results)):
-            dirobj = None
+        def onAdded(item):
+            returnValues.append(FileEvent("create", item.parent, item.name))
+        def onDeleted(item):
+            returnValues.append(FileEvent("delete", item.parent, item.name))
+
+        # more directories can be marked while the others are synced
+        while len(self._outOfSync) > 0:
+            outOfSync = self._outOfSync
+            self._outOfSync = {}
+
+            for dirobj, recursive in outOfSync.items():
+                # skip directories that were removed from the tree in the meantime
+                if not self._inTree(dirobj):
+                    continue
+
+                # the directories to look at, parents first
+                dirs = []
+                stack = [ dirobj ]
+                while stack:
+                    item = stack.pop()
+                    if not item._loadCachedContents():
+                        continue
+                    dirs.append(item)
+                    if recursive:
+                        stack.extend(sub for sub in item._contents.values() if sub.isdir)
+
+                # the modification times are read before the listings, see SyncedDirectory._refresh()
+                paths = [ item.path for item in dirs ]
+                mtimes = await self._runBlocking(lambda: [ _statMtime(path) for path in paths ])
+
+                for item, mtimeNs in zip(dirs, mtimes):
+                    if mtimeNs is None:
+                        # the directory is gone, which the sync of its parent directory finds
+                        continue
+                    if item is not dirobj and item._mtimeNs is not None and item._mtimeNs == mtimeNs:
+                        continue
+                    if not self._inTree(item):
+                        continue
+
+                    signatures = { name: (f._size, f._mtimeNs, f._inode, f._device)
+                        for name, f in item._contents.items() if not f.isdir and f._fasthash is None }
+                    def onModified(f, signatures=signatures):
+                        if signatures.get(f.name) != (f._size, f._mtimeNs, f._inode, f._device):
+                            returnValues.append(FileEvent("modify", f.parent, f.name))
+                    def onRenamed(oldName, newFile, item=item):
+                        returnValues.append(FileEvent("movefrom", item, oldName))
+                        returnValues.append(FileEvent("moveto", item, newFile.name))
+                    await item.asyncSync(recursive=False, onAdded=onAdded, onDeleted=onDeleted,
+                        onModified=onModified, onRenamed=onRenamed)
+                    item._mtimeNs = mtimeNs
+
+        return returnValues
 
-            evt = results[i]
 
-            # nextEvt is the event object following this one. we need this because
-            # movefrom and moveto are different events and we need them as a pair
-            if i < len(results) - 1:
-                nextEvt = results[i + 1]
+    @staticmethod
+    def _coalesceEvent(types, evtType):
+        """
+        Adds the event type ``evtType`` to the list of coalesced event types ``types`` for one
+        file. Repeated events are dropped, "modify" events after a "create" are dropped, and
+        a "delete" cancels out a "create" (and any "modify" events) that came before it.
+        """
+        if evtType == "modify":
+            if len(types) == 0:
+                types.append(evtType)
+        elif evtType == "create":
+            if len(types) == 0 or types[-1] != "create":
+                types.append(evtType)
+        else:
+            if len(types) > 0 and types[-1] == "modify":
+                types.pop()
+            if len(types) > 0 and types[-1] == "create":
+                types.pop()
+            elif len(types) == 0 or types[-1] != "delete":
+                types.append(evtType)
+
+
+    def _applyEvents(self, pending):
+        """
+        Applies the coalesced events in ``pending`` (see ``_processEvents()``) to the directory
+        objects, and returns them as a list of ``FileEvent`` objects.
+        """
+        returnValues = []
+        # directory -> names of the files that were created or deleted in it
+        refreshes = OrderedDict()
+        for (dirobj, name), (types, isDir, refresh) in pending.items():
+            if refresh:
+                refreshes.setdefault(dirobj, []).append(name)
             else:
-                nextEvt = None
-
-            # is this a directory event?
-            isDir = False
-            if evt.is_dir_event:
-                isDir = True
-
-            # get the directory object we're going to route the event to
-            dirobj = self._getInotifyEventDir(evt)
-
-            # a file or directory was created
-            if evt.create_event:
-                dirobj._inotifyCreate(evt, isDir)
-                returnValues.append(FileEvent("create", dirobj, evt.filename.decode()))
-
-            # a file or directory was modified
-            elif evt.modify_event:
-                dirobj._inotifyModify(evt, isDir)
-                returnValues.append(FileEvent("modify", dirobj, evt.filename.decode()))
-
-            # a file or directory was deleted
-            elif evt.delete_event:
-                dirobj._inotifyDelete(evt, isDir)
-                returnValues.append(FileEvent("delete", dirobj, evt.filename.decode()))
-
-            # a file or directory was moved
-            elif nextEvt is not None and (evt.moved_from_event or evt.moved_to_event):
-                # we need to figure out the order. one event is movefrom and one event is moveto.
-                evtFrom = None
-                evtTo = None
-
-                if evt.moved_from_event:
-                    evtFrom = evt
-                elif evt.moved_to_event:
-                    evtTo = evt
-
-                if nextEvt.moved_from_event:
-                    evtFrom = nextEvt
-                elif nextEvt.moved_to_event:
-                    evtTo = nextEvt
-
-                # make sure we actually get a movefrom/moveto pair
-                if evtFrom is not None and evtTo is not None:
-                    nextDirobj = self._getInotifyEventDir(nextEvt)
-                    dirobj._inotifyMove(evt, nextEvt, nextDirobj, isDir)
-                    # in our return values, movefrom and moveto will ALWAYS be a pair, and
-                    # movefrom will ALWAYS come before moveto.
-                    returnValues.append(FileEvent("movefrom", dirobj, evtFrom.filename.decode()))
-                    returnValues.append(FileEvent("moveto", nextDirobj, evtTo.filename.decode()))
-
-                # didn't get a pair, log an error
-                else:
-                    filename = os.path.join(dirobj.abspath, evt.filename.decode())
-                    logging.error("Expected a MOVED_FROM and MOVED_TO pair, got %s and %s for file '%s'" % (
-                        _flagsToStr(evt), _flagsToStr(nextEvt), filename))
+                dirobj._inotifyModify(name, isDir)
+            for evtType in types:
+                returnValues.append(FileEvent(evtType, dirobj, name))
+
+        for dirobj, names in refreshes.items():
+            dirobj._inotifyRefresh(names)
 
         return returnValues
 
@@ -324,12 +1016,10 @@ if __name__ == "__main__":
     fs = SyncedRootDirectory("/tmp/mediafs_synctest", loop)
     fs.refresh(recursive=True)
 
-    @asyncio.coroutine
-    def mainloop():
+    async def mainloop():
         while True:
-            filesystemEvents = yield from fs.processFilesystemEvents()
+            filesystemEvents = await fs.processFilesystemEvents(wait=True)
             for evtType, evtObj, filename in filesystemEvents:
                 print(evtType, evtObj, filename)
-            yield from asyncio.sleep(1)
 
     loop.run_until_complete(mainloop())
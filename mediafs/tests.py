@@ -5,13 +5,25 @@ Author: Judd Cohen
 License: MIT (See accompanying file LICENSE or copy at http://opensource.org/licenses/MIT)
 """
 import os
+import gc
+import sys
 import random
+import asyncio
+import time
 import shutil
 import tempfile
 import unittest
+from datetime import datetime
 from zipfile import ZipFile
 
 from fs import *
+from fs import _ParallelLister
+
+# the synced module is only importable when mediafs is installed as a package
+try:
+    from mediafs.synced import SyncedRootDirectory, ScriptedEventSource, InotifyEvent, IN_IGNORED
+except ImportError:
+    SyncedRootDirectory = None
 
 
 class TestMetaFS(unittest.TestCase):
@@ -81,6 +93,291 @@ class TestMetaFS(unittest.TestCase):
         self.assertEqual(len(fs[...]), 16)
 
 
+    def test_traversal(self):
+        """
+        Test the different orders of recursive walks
+        """
+        fs = self._getFS()
+
+        def walk(directory, reverse=False):
+            # the order of a depth-first walk, with each directory before and after its contents
+            for item in directory.all(reverse=reverse):
+                yield ("pre", item)
+                if item.isdir:
+                    for subitem in walk(item, reverse):
+                        yield subitem
+                yield ("post", item)
+
+        for reverse in (False, True):
+            expected = list(walk(fs, reverse))
+            for traversal in ("pre", "post"):
+                self.assertEqual(list(fs.all(recursive=True, reverse=reverse, traversal=traversal)),
+                    [ item for kind, item in expected if kind == traversal ])
+                self.assertEqual(list(fs.all(recursive=True, reverse=reverse, dirs=False, traversal=traversal)),
+                    [ item for kind, item in expected if kind == traversal and not item.isdir ])
+
+        # a breadth-first walk yields items in order of their depth
+        items = list(fs.all(recursive=True, traversal="breadth"))
+        self.assertEqual(sorted(items, key=lambda item: item.relpath), sorted(fs[...], key=lambda item: item.relpath))
+        depths = [ item.relpath.count(os.sep) for item in items ]
+        self.assertEqual(depths, sorted(depths))
+        self.assertEqual(items[:7], fs[:])
+        self.assertEqual(list(fs.all(recursive=True, files=False, traversal="breadth")),
+            [ fs['abc'], fs['def'], fs['abc']['qwerty'], fs['def']['azerty'], fs['abc']['qwerty']['stuff'] ])
+
+        self.assertEqual(list(fs.all(traversal="post")), fs[:])
+        self.assertRaises(ValueError, fs.all, traversal="sideways")
+
+
+    def test_directory_totals(self):
+        """
+        Test that directory sizes and counts are kept up to date as the tree changes
+        """
+        fs = self._getFS()
+        fs.refresh(recursive=True)
+
+        def totals(path):
+            size = fileCount = dirCount = 0
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirCount += len(dirnames)
+                fileCount += len(filenames)
+                size += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+            return (size, fileCount, dirCount)
+
+        def check():
+            for item in [ fs ] + list(fs.all(recursive=True, files=False)):
+                self.assertEqual((item._size, item._fileCount, item._dirCount), totals(item.abspath))
+
+        self.assertEqual(fs.fileCount, 11)
+        self.assertEqual(fs.dirCount, 5)
+        check()
+
+        # the totals are adjusted instead of being calculated again
+        def calculateTotals():
+            raise AssertionError("calculated the totals again")
+        fs._calculateTotals = calculateTotals
+
+        stuff = fs['abc']['qwerty']['stuff']
+        with open(os.path.join(stuff.abspath, "new.txt"), 'w') as fp:
+            fp.write("x" * 1000)
+        stuff.refresh("new.txt")
+        check()
+
+        with open(os.path.join(stuff.abspath, "thing1.txt"), 'a') as fp:
+            fp.write("more")
+        os.remove(os.path.join(fs.abspath, "def", "azerty", "j1.txt"))
+        os.rename(os.path.join(stuff.abspath, "thing2.txt"), os.path.join(stuff.abspath, "thing3.txt"))
+        fs.sync(recursive=True)
+        check()
+
+        shutil.rmtree(os.path.join(fs.abspath, "abc", "qwerty"))
+        fs['abc'].refresh("qwerty")
+        check()
+
+        # new directories are counted the next time the totals are needed
+        os.makedirs(os.path.join(fs.abspath, "def", "new", "dir"))
+        with open(os.path.join(fs.abspath, "def", "new", "dir", "file.txt"), 'w') as fp:
+            fp.write("xyz")
+        fs['def'].refresh("new", recursive=True)
+        self.assertEqual(fs._size, None)
+        self.assertNotEqual(fs['abc']._size, None)
+        del fs._calculateTotals
+        self.assertEqual((fs.size, fs.fileCount, fs.dirCount), totals(fs.abspath))
+
+        # the totals are saved in the tree cache
+        fs = self._getFS(lambda path: CachedRootDirectory(path, treeFormat="binary"))
+        fs.refresh(recursive=True)
+        abcTotals = (fs['abc'].size, fs['abc'].fileCount, fs['abc'].dirCount)
+        fs.save()
+        fs = CachedRootDirectory(fs.path, lazyLoad=True)
+        self.assertEqual((fs['abc'].size, fs['abc'].fileCount, fs['abc'].dirCount), abcTotals)
+        self.assertEqual(fs['abc']._contents, None)
+
+
+    def test_scan_stat(self):
+        """
+        Test that the stat results from scanning a directory are kept on the files
+        """
+        for workers in (None, 2):
+            fs = self._getFS()
+            fs.refresh(recursive=True, workers=workers)
+            for item in fs.all(recursive=True, dirs=False):
+                st = os.stat(item.abspath)
+                self.assertEqual((item._size, item._mtimeNs, item._inode, item._device),
+                    (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev))
+                self.assertAlmostEqual(item.mtime().timestamp(), st.st_mtime, places=5)
+
+        # refreshing single files uses the same stat results
+        with open(os.path.join(fs.abspath, "def", "new.txt"), 'w') as fp:
+            fp.write("new file")
+        fs['def'].refresh("new.txt", "missing.txt")
+        self.assertEqual(fs['def']['new.txt']._size, 8)
+        self.assertFalse("missing.txt" in fs['def'])
+
+
+    def test_path_storage(self):
+        """
+        Test putting paths together from the parent chain instead of storing them
+        """
+        class PathlessRootDirectory(CachedRootDirectory):
+            storePaths = False
+            pathCacheSize = 4
+
+        plainFS = self._getFS()
+        plainFS.refresh(recursive=True)
+        fs = self._getFS(PathlessRootDirectory, clean=False)
+        fs.refresh(recursive=True)
+
+        def paths(root):
+            return [ (item.relpath, item.path, item.abspath) for item in root.all(recursive=True) ]
+
+        self.assertEqual(paths(fs), paths(plainFS))
+        # twice, now that some of them are cached
+        self.assertEqual(paths(fs), paths(plainFS))
+        self.assertEqual(len(fs._pathCache), 4)
+        for item in fs.all(recursive=True):
+            self.assertEqual((item._path, item._relpath, item._abspath), (None, None, None))
+
+        # renaming and moving
+        item = fs['abc']['qwerty']['stuff']['thing1.txt']
+        item.abspath
+        fs['abc']['qwerty'].rename("renamed")
+        self.assertEqual(item.relpath, os.path.join("abc", "renamed", "stuff", "thing1.txt"))
+        self.assertTrue(os.path.exists(item.abspath))
+        item.rename("thing3.txt")
+        self.assertEqual(item.relpath, os.path.join("abc", "renamed", "stuff", "thing3.txt"))
+        fs['def']._push(fs['abc']._pop(fs['abc']['renamed']))
+        self.assertEqual(item.relpath, os.path.join("def", "renamed", "stuff", "thing3.txt"))
+        self.assertEqual(fs['def']['renamed']._path, None)
+
+        # paths aren't stored in the tree cache either
+        fs.save()
+        fs = PathlessRootDirectory(fs.path)
+        self.assertEqual(fs['def']['renamed']['stuff']['thing3.txt'].relpath,
+            os.path.join("def", "renamed", "stuff", "thing3.txt"))
+        for item in fs.all(recursive=True):
+            self.assertEqual(item._path, None)
+
+        # and paths from a tree cache written with the paths are forgotten
+        plainFS.save()
+        fs = PathlessRootDirectory(plainFS.path)
+        self.assertEqual(paths(fs), paths(CachedRootDirectory(plainFS.path)))
+        for item in fs.all(recursive=True):
+            self.assertEqual(item._path, None)
+
+
+    def test_path_lookup(self):
+        """
+        Test looking up items by their relative path, and that the path index stays up to
+        date when the tree changes
+        """
+        def loaded(fs):
+            items = { ".": fs }
+            stack = [ fs ]
+            while len(stack) > 0:
+                dirobj = stack.pop()
+                for item in (dirobj._contents or {}).values():
+                    items[item.relpath] = item
+                    if item.isdir:
+                        stack.append(item)
+            return items
+
+        # lookups work without an index too
+        fs = self._getFS()
+        thing1 = fs['abc']['qwerty']['stuff']['thing1.txt']
+        self.assertTrue(fs.lookup("abc/qwerty/stuff/thing1.txt") is thing1)
+        self.assertTrue(fs.lookup("./abc//qwerty/stuff/") is thing1.parent)
+        self.assertTrue(fs.lookup("") is fs)
+        self.assertEqual(fs.lookup("abc/missing.txt"), None)
+        self.assertEqual(fs.lookup("test.txt/abc", False), False)
+
+        fs.createPathIndex()
+        self.assertEqual(fs._pathIndex, loaded(fs))
+        self.assertTrue(fs.lookup(os.path.join("abc", "qwerty", "stuff", "thing1.txt")) is thing1)
+
+        # refreshes replace the items
+        fs.refresh(recursive=True)
+        self.assertEqual(fs._pathIndex, loaded(fs))
+        stuff = fs.lookup("abc/qwerty/stuff")
+        os.remove(os.path.join(stuff.abspath, "thing2.txt"))
+        with open(os.path.join(stuff.abspath, "new.txt"), 'w') as fp:
+            fp.write("new")
+        stuff.refresh("thing2.txt", "new.txt", "thing1.txt")
+        self.assertEqual(fs.lookup("abc/qwerty/stuff/thing2.txt"), None)
+        self.assertTrue(fs.lookup("abc/qwerty/stuff/new.txt") is stuff['new.txt'])
+        self.assertEqual(fs._pathIndex, loaded(fs))
+
+        # renames and moves
+        fs['abc']['qwerty'].rename("renamed")
+        self.assertEqual(fs.lookup("abc/qwerty/stuff"), None)
+        self.assertTrue(fs.lookup("abc/renamed/stuff") is stuff)
+        fs['def']._push(fs['abc']._pop(fs['abc']['renamed']))
+        self.assertTrue(fs.lookup("def/renamed/stuff/new.txt") is stuff['new.txt'])
+        self.assertEqual(fs._pathIndex, loaded(fs))
+
+        # syncs
+        os.rename(os.path.join(fs.abspath, "def", "azerty"), os.path.join(fs.abspath, "moved"))
+        os.remove(os.path.join(fs.abspath, "test2.txt"))
+        fs.sync(recursive=True)
+        self.assertEqual(fs.lookup("def/azerty"), None)
+        self.assertEqual(fs.lookup("test2.txt"), None)
+        self.assertTrue(fs.lookup("moved/j1.txt") is fs['moved']['j1.txt'])
+        self.assertEqual(fs._pathIndex, loaded(fs))
+
+        # lazily loaded directories are added to the index when they're loaded
+        LazyRoot = lambda path: CachedRootDirectory(path, treeFormat="binary", lazyLoad=True)
+        fs = self._getFS(LazyRoot)
+        fs.refresh(recursive=True)
+        fs.save()
+        fs = self._getFS(LazyRoot, clean=False)
+        fs.createPathIndex()
+        self.assertEqual(len(fs._pathIndex), 8)
+        self.assertEqual(fs.lookup("def/azerty/j3.txt").name, "j3.txt")
+        self.assertEqual(fs['abc']._contents, None)
+        self.assertEqual(fs._pathIndex, loaded(fs))
+
+
+    def test_directory_order(self):
+        """
+        Test that directory orders are kept up to date when items are added, removed and renamed
+        """
+        class ReversedRootDirectory(RootDirectory):
+            def _orderDirectory(self, contents):
+                return sorted(contents, reverse=True)
+
+        for Cls, ordered in ((RootDirectory, sorted), (ReversedRootDirectory, lambda keys: sorted(keys, reverse=True))):
+            fs = self._getFS(Cls)
+            fs.refresh(recursive=True)
+            stuff = fs['abc']['qwerty']['stuff']
+
+            def check():
+                for directory in fs.all(recursive=True, files=False):
+                    self.assertEqual(directory.order, ordered(directory.contents))
+                self.assertEqual(fs.order, ordered(fs.contents))
+
+            # renaming while iterating over a directory
+            for item in stuff:
+                item.rename("renamed " + item.name)
+            self.assertEqual(len(stuff), 2)
+            check()
+
+            stuff._push(fs._pop(fs['test2.txt']))
+            fs['def']._push(stuff._pop(stuff['renamed thing1.txt']))
+            check()
+
+            for name in ("a.txt", "zzz.txt", "m.txt"):
+                with open(os.path.join(stuff.abspath, name), 'w') as fp:
+                    fp.write(name)
+            os.remove(os.path.join(stuff.abspath, "renamed thing2.txt"))
+            stuff.refresh("a.txt", "zzz.txt", "renamed thing2.txt")
+            check()
+            self.assertFalse("m.txt" in stuff)
+
+            fs.sync(recursive=True)
+            self.assertTrue("m.txt" in stuff)
+            check()
+
+
     def test_file_exists(self):
         """
         Make sure we can easily test if a file exists
@@ -163,6 +460,205 @@ class TestMetaFS(unittest.TestCase):
         self.assertEqual(count, 1)
 
 
+    def test_name_index(self):
+        """
+        Test that recursive searches with a name index find the same items as without one
+        """
+        plainFS = self._getFS()
+        fs = self._getFS(clean=False)
+        fs.createNameIndex()
+
+        def relpaths(items):
+            return sorted(item.relpath for item in items)
+
+        searches = [
+            lambda d: d.filter("*.TXT", recursive=True),
+            lambda d: d.filter("thing*", recursive=True),
+            lambda d: d.filter("*qwe[r]ty*", recursive=True, files=False),
+            lambda d: d.filter("Test*", recursive=True, ignoreCase=False),
+            lambda d: d.search(r"(.*)ing(.*)\.txt$", recursive=True),
+            lambda d: d.search(r"^j\d\.txt", recursive=True, dirs=False),
+            lambda d: d.search("azerty", recursive=True),
+            # the characters after a character code escape aren't literals
+            lambda d: d.search(r"\x74est", recursive=True),
+            lambda d: d.search(r"\u0074hing\d", recursive=True),
+            lambda d: d.search(r"\U00000074est", recursive=True),
+            lambda d: d.search(r"\N{LATIN SMALL LETTER T}est", recursive=True),
+            lambda d: d.search(r"\164est\d", recursive=True),
+            lambda d: d.search(r"j\063", recursive=True),
+            lambda d: d.search(r"(t)es\1\d", recursive=True),
+        ]
+        for search in searches:
+            self.assertEqual(relpaths(search(fs)), relpaths(search(plainFS)))
+            self.assertEqual(relpaths(search(fs['abc'])), relpaths(search(plainFS['abc'])))
+        self.assertEqual(len(fs._nameIndex.pending), 0)
+        self.assertEqual(len(list(fs.filter("*.txt", recursive=True))), 11)
+
+        # the index is updated when files are added, removed and renamed
+        with open(os.path.join(fs.abspath, "def", "new_thing.txt"), 'w') as fp:
+            fp.write("new")
+        fs['def'].refresh("new_thing.txt")
+        self.assertEqual(relpaths(fs.filter("*thing*", recursive=True)),
+            [ "abc/qwerty/stuff/thing1.txt", "abc/qwerty/stuff/thing2.txt", "def/new_thing.txt" ])
+
+        os.remove(os.path.join(fs.abspath, "def", "new_thing.txt"))
+        fs.sync(recursive=True)
+        self.assertEqual(len(list(fs.filter("*thing*", recursive=True))), 2)
+
+        fs['abc']['qwerty'].rename("renamed")
+        self.assertEqual(relpaths(fs.filter("thing*", recursive=True)),
+            [ "abc/renamed/stuff/thing1.txt", "abc/renamed/stuff/thing2.txt" ])
+        self.assertEqual(relpaths(fs.filter("*renamed*", recursive=True)), [ "abc/renamed" ])
+
+        # a full refresh replaces the contents of the directory
+        fs.refresh()
+        self.assertEqual(relpaths(fs.filter("thing*", recursive=True)),
+            [ "abc/renamed/stuff/thing1.txt", "abc/renamed/stuff/thing2.txt" ])
+
+        # the index is saved along with the tree cache
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        fs = CachedRootDirectory(fs.path, nameIndex=True, treeFormat="binary")
+        fs.refresh(recursive=True)
+        self.assertEqual(len(list(fs.search("j[0-9]", recursive=True))), 3)
+        fs.save()
+        self.assertTrue(os.path.exists(os.path.join(fs.abspath, ".tree.json.names")))
+
+        # only the directories with results are loaded from a lazily loaded tree cache
+        fs = CachedRootDirectory(fs.path, nameIndex=True, lazyLoad=True)
+        self.assertEqual(fs._nameIndex.pending, set())
+        self.assertEqual(fs._contents['abc']._contents, None)
+        self.assertEqual(relpaths(fs.filter("j3.*", recursive=True)), [ "def/azerty/j3.txt" ])
+        self.assertEqual(fs._contents['abc']._contents, None)
+
+        # a tree cache that was written without the index invalidates the saved index
+        other = CachedRootDirectory(fs.path)
+        other.refresh()
+        other.save()
+        fs = CachedRootDirectory(fs.path, nameIndex=True)
+        self.assertEqual(fs._nameIndex.pending, { "." })
+        self.assertEqual(relpaths(fs.filter("j3.*", recursive=True)), [ "def/azerty/j3.txt" ])
+
+
+    def test_metadata_index(self):
+        """
+        Test looking up files by metadata with a metadata index
+        """
+        fs = self._getFS(CachedRootDirectory)
+        fs.refresh(recursive=True)
+        fs['test2.txt'].metadata['author'] = "Some Dude"
+        fs['test3.txt'].metadata['author'] = "Some Other Dude"
+        fs['abc'].metadata['author'] = "Some Dude"
+        fs['test2.txt'].metadata['year'] = 2008
+        fs['test3.txt'].metadata['year'] = 2010
+        fs['abc']['qwerty']['qwerty.txt'].metadata['year'] = 2009
+        fs['test1.txt'].metadata['year'] = "unknown"
+
+        def relpaths(items):
+            return [ item.relpath for item in items ]
+
+        # the same results with and without an index
+        unindexed = relpaths(fs.lookupMetadata('author', "Some Dude"))
+        unindexedRange = relpaths(fs.lookupMetadataRange('year', 2009))
+        fs.createIndex('author')
+        fs.createIndex('year')
+        self.assertEqual(relpaths(fs.lookupMetadata('author', "Some Dude")), unindexed)
+        self.assertEqual(unindexed, [ "abc", "test2.txt" ])
+        self.assertEqual(relpaths(fs.lookupMetadataRange('year', 2009)), unindexedRange)
+        self.assertEqual(unindexedRange, [ "abc/qwerty/qwerty.txt", "test3.txt" ])
+        self.assertEqual(relpaths(fs.lookupMetadataRange('year', high=2009)), [ "test2.txt", "abc/qwerty/qwerty.txt" ])
+        # thing2.txt is a copy of test1.txt, so they share their metadata
+        self.assertEqual(relpaths(fs.lookupMetadataRange('year', "a", "z")), [ "abc/qwerty/stuff/thing2.txt", "test1.txt" ])
+        self.assertRaises(ValueError, list, fs.lookupMetadataRange('year'))
+
+        # the indexes are updated when metadata changes
+        fs['test3.txt'].metadata['author'] = "Some Dude"
+        del fs['abc'].metadata['author']
+        fs['test2.txt'].metadata.pop('year')
+        self.assertEqual(relpaths(fs.lookupMetadata('author', "Some Dude")), [ "test2.txt", "test3.txt" ])
+        self.assertEqual(relpaths(fs.lookupMetadata('author', "Some Other Dude")), [])
+        self.assertEqual(relpaths(fs.lookupMetadataRange('year', 2000, 2020)), [ "abc/qwerty/qwerty.txt", "test3.txt" ])
+
+        # the indexes and file locations are saved with the metadata
+        fs.save()
+        fs = CachedRootDirectory(fs.path)
+        self.assertEqual(sorted(fs._mdIndexes), [ 'author', 'year' ])
+        self.assertTrue(fs._mdLocationsComplete)
+        # the tree doesn't have to be searched to find the files
+        def findMetadataLocations():
+            raise AssertionError("searched the whole tree")
+        fs._findMetadataLocations = findMetadataLocations
+        self.assertEqual(relpaths(fs.lookupMetadata('author', "Some Dude")), [ "test2.txt", "test3.txt" ])
+        del fs._findMetadataLocations
+
+        # files that were moved are found again
+        os.rename(os.path.join(fs.abspath, "test3.txt"), os.path.join(fs.abspath, "def", "test3.txt"))
+        fs.refresh(recursive=True)
+        self.assertEqual(relpaths(fs.lookupMetadata('author', "Some Dude")), [ "def/test3.txt", "test2.txt" ])
+
+
+    def test_query_language(self):
+        """
+        Test searching with query strings
+        """
+        fs = self._getFS(CachedRootDirectory)
+        fs.refresh(recursive=True)
+        fs['test2.txt'].metadata['author'] = "Some Dude"
+        fs['test3.txt'].metadata['author'] = "Some Other Dude"
+        fs['abc'].metadata['author'] = "Some Dude"
+        fs['test2.txt'].metadata['year'] = 2008
+        fs['abc']['qwerty']['qwerty.txt'].metadata['year'] = 2009
+
+        def relpaths(items):
+            return sorted(item.relpath for item in items)
+
+        queries = [
+            ('ext == "txt"', lambda f: f.name.endswith(".txt")),
+            ('name ~ "thing*" or name =~ "^J[0-9]"', lambda f: f.name.startswith(("thing", "j"))),
+            ('not (size > 0) and ext == "txt"', lambda f: f.name.endswith(".txt") and f.size == 0),
+            ('author == "Some Dude"', lambda f: f.get('author') == "Some Dude"),
+            ('author ~ "*dude" and year >= 2000', lambda f: f.get('author') is not None and f.get('year') is not None),
+            ('year < 2009 or year > 2008.5', lambda f: f.get('year') is not None),
+            ('relpath ~ "abc/qwerty/*" and name != "stuff"', lambda f: f.relpath.startswith("abc/qwerty/") and f.name != "stuff"),
+            ('size <= 1kb and size > 0', lambda f: not f.isdir and 0 < f.size <= 1024),
+            ('author == null', lambda f: f.get('author') is None),
+            ('author == null and year == 2009', lambda f: f.get('author') is None and f.get('year') == 2009),
+            ('author != null', lambda f: f.get('author') is not None),
+        ]
+        def check():
+            for query, function in queries:
+                self.assertEqual(relpaths(fs.query(query, recursive=True)), relpaths(fs.query(function, recursive=True)))
+                self.assertEqual(relpaths(fs['abc'].query(query, recursive=True, dirs=False)),
+                    relpaths(fs['abc'].query(function, recursive=True, dirs=False)))
+        check()
+        self.assertEqual(relpaths(fs.query('author == "Some Dude"', recursive=True)), [ "abc", "test2.txt" ])
+
+        # directories that can't contain results aren't searched
+        self.assertFalse(parseQuery('relpath ~ "abc/qwerty/*"').pruneDirectory(fs['abc']))
+        self.assertTrue(parseQuery('relpath ~ "abc/qwerty/*"').pruneDirectory(fs['def']))
+        self.assertTrue(parseQuery('relpath == "def/j2.txt" or relpath ~ "def*"').pruneDirectory(fs['abc']))
+
+        # the indexes are used when there are any
+        fs.createNameIndex()
+        fs.createIndex('author')
+        fs.createIndex('year')
+        check()
+        def queryWalk(*args):
+            raise AssertionError("searched the whole tree")
+        fs._queryWalk = queryWalk
+        self.assertEqual(relpaths(fs.query('name ~ "thing*" and size > 0', recursive=True)),
+            [ "abc/qwerty/stuff/thing1.txt", "abc/qwerty/stuff/thing2.txt" ])
+        self.assertEqual(relpaths(fs.query('year >= 2009 and name ~ "*.txt"', recursive=True)), [ "abc/qwerty/qwerty.txt" ])
+        self.assertEqual(relpaths(fs['abc'].query('author == "Some Dude"', recursive=True)), [])
+
+        # invalid queries
+        for query in ('', 'size >', 'size > 10 and', '(name == "a"', 'name = "a"', '"a" == name', 'name == "a" year == 1',
+                'name =~ "("', r'name == "\x"'):
+            self.assertRaises(QuerySyntaxError, parseQuery, query)
+        with self.assertRaisesRegex(QuerySyntaxError, "position 21"):
+            parseQuery('size > 1 and name =~ "[a"')
+        self.assertEqual(parseQuery("size >= 1.5KB").value, 1536)
+
+
     def test_duplicate_files(self):
         """
         Test working with duplicate files
@@ -190,6 +686,100 @@ class TestMetaFS(unittest.TestCase):
         self.assertEqual(count, 2)
 
 
+    def test_find_duplicates(self):
+        """
+        Test finding all duplicate files at once
+        """
+        fs = self._getFS()
+        self.assertEqual(fs.findDuplicates(), [
+            [ fs['abc']['qwerty']['stuff']['thing1.txt'], fs['test.txt'] ],
+            [ fs['abc']['qwerty']['stuff']['thing2.txt'], fs['test1.txt'] ],
+        ])
+        self.assertEqual(fs['abc'].findDuplicates(), [])
+
+        # files with a size no other file has are never read
+        sizes = [ item.size for item in fs.all(recursive=True, dirs=False) ]
+        for item in fs.all(recursive=True, dirs=False):
+            if sizes.count(item.size) == 1:
+                self.assertEqual(item._fasthash, None)
+
+        # large files with the same size are only read completely if their fasthashes match,
+        # and the fasthash doesn't include the last bytes of the file
+        size = 2**20
+        data = os.urandom(size)
+        for name, contents in (("big1.bin", data), ("big2.bin", data), ("big3.bin", data[:9000] + b"x" + data[9001:]),
+                               ("big4.bin", data[:-1] + bytes([ data[-1] ^ 1 ]))):
+            with open(os.path.join(fs.abspath, "def", name), 'wb') as fp:
+                fp.write(contents)
+        fs['def'].refresh()
+        groups = fs.findDuplicates(workers=2)
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(groups[2], [ fs['def']['big1.bin'], fs['def']['big2.bin'] ])
+        self.assertNotEqual(fs['def']['big1.bin']._md5, None)
+        self.assertEqual(fs['def']['big3.bin']._md5, None)
+        self.assertNotEqual(fs['def']['big4.bin']._md5, None)
+
+        # files that can't be read are left out
+        os.remove(fs['test.txt'].abspath)
+        fs['test.txt']._fasthash = None
+        errors = []
+        self.assertEqual(len(fs.findDuplicates(onError=lambda f, e: errors.append(f))), 2)
+        self.assertEqual(errors, [ fs['test.txt'] ])
+        self.assertRaises(OSError, fs.findDuplicates)
+
+
+    def test_hash_all(self):
+        """
+        Test hashing all files at once with a thread pool
+        """
+        serialFS = self._getFS()
+        serialFiles = { item.relpath: item for item in serialFS.all(recursive=True, dirs=False) }
+        fs = self._getFS(clean=False)
+
+        progress = []
+        count = fs.hashAll(kind="fasthash", workers=3, onProgress=lambda f, done, total: progress.append((done, total)))
+        files = list(fs.all(recursive=True, dirs=False))
+        self.assertEqual(count, len(files))
+        self.assertEqual(progress[-1], (len(files), len(files)))
+
+        for item in files:
+            self.assertEqual(item._fasthash, serialFiles[item.relpath].fasthash())
+            self.assertEqual(item._md5, serialFiles[item.relpath].md5())
+
+        # everything is hashed already
+        self.assertEqual(fs.hashAll(kind="fasthash"), 0)
+        self.assertEqual(fs.hashAll(kind="crc", workers=2, recursive=False), len(list(fs.all(dirs=False))))
+        for item in fs.all(dirs=False):
+            self.assertEqual(item._crc, serialFiles[item.relpath].crc())
+
+        # files that disappeared are reported, not raised
+        os.remove(fs['test.txt'].abspath)
+        errors = []
+        self.assertEqual(fs.hashAll(kind="md5", refresh=True, onError=lambda f, e: errors.append(f)), len(files) - 1)
+        self.assertEqual(errors, [ fs['test.txt'] ])
+        self.assertRaises(OSError, fs.hashAll, kind="md5", refresh=True)
+        self.assertRaises(ValueError, fs.hashAll, kind="sha1")
+
+
+    def test_large_file_hashes(self):
+        """
+        Test hashing files that are larger than the hash buffer
+        """
+        import hashlib, binascii
+        fs = self._getFS()
+        data = bytes(random.getrandbits(8) for i in range(2**16)) * 40 + b"end"
+        with open(os.path.join(fs.abspath, "large.bin"), 'wb') as fp:
+            fp.write(data)
+        fs.refresh()
+
+        self.assertEqual(fs['large.bin'].md5(), hashlib.md5(data).hexdigest())
+        self.assertEqual(fs['large.bin'].crc(), binascii.crc32(data))
+
+        # hashing on other threads uses separate buffers
+        fs.hashAll(kind="md5", workers=4, refresh=True)
+        self.assertEqual(fs['large.bin'].md5(), hashlib.md5(data).hexdigest())
+
+
     def test_refresh(self):
         """
         Test refreshing
@@ -205,6 +795,65 @@ class TestMetaFS(unittest.TestCase):
         fs.refresh('abc', recursive=True)
 
 
+    def test_parallel_refresh(self):
+        """
+        Test that a refresh using a thread pool builds the same tree as a serial
+        refresh, and calls the refresh callbacks in the same order
+        """
+        class RecordingRoot(RootDirectory):
+            def __init__(self, path):
+                self.refreshed = []
+                RootDirectory.__init__(self, path)
+
+            def _directoryRefresh(self, item):
+                self.refreshed.append(item.relpath)
+
+            def _fileRefresh(self, item):
+                self.refreshed.append(item.relpath)
+
+        serialFS = self._getFS(RecordingRoot)
+        serialFS.refresh(recursive=True)
+
+        parallelFS = self._getFS(RecordingRoot, clean=False)
+        parallelFS.refresh(recursive=True, workers=4)
+
+        self.assertEqual(parallelFS.refreshed, serialFS.refreshed)
+        self.assertEqual(len(parallelFS.refreshed), 16)
+        self.assertEqual([ item.relpath for item in parallelFS.all(recursive=True) ],
+            [ item.relpath for item in serialFS.all(recursive=True) ])
+
+        # every directory was refreshed, so nothing should be lazily evaluated any more
+        for item in parallelFS.all(recursive=True, files=False):
+            self.assertTrue(isinstance(item._contents, dict))
+            self.assertTrue(isinstance(item._order, list))
+
+        # refreshing a single subdirectory in parallel
+        parallelFS.refresh('abc', recursive=True, workers=2)
+        self.assertEqual(len(parallelFS['abc']['qwerty']['stuff']), 2)
+
+        # if the refresh fails, the listings that were queued up aren't read anymore
+        path = tempfile.mkdtemp()
+        listed = []
+        origList = _ParallelLister._list
+        def slowList(lister, dirPath):
+            listed.append(dirPath)
+            time.sleep(0.01)
+            return origList(lister, dirPath)
+        class FailingRoot(RootDirectory):
+            def _directoryRefresh(self, item):
+                if item.name.startswith("sub"):
+                    raise KeyboardInterrupt()
+        try:
+            for i in range(100):
+                os.makedirs(os.path.join(path, "dir", "sub %d" % i))
+            _ParallelLister._list = slowList
+            self.assertRaises(KeyboardInterrupt, FailingRoot(path).refresh, recursive=True, workers=2)
+            self.assertTrue(len(listed) < 20)
+        finally:
+            _ParallelLister._list = origList
+            shutil.rmtree(path)
+
+
     def test_lazy_refresh(self):
         """
         Test lazy evaluation of refresh()
@@ -249,6 +898,452 @@ class TestMetaFS(unittest.TestCase):
         self.assertEqual(item._root, rootValue)
 
 
+    def test_sync_stat_signature(self):
+        """
+        Test that sync() only rehashes files whose size, mtime, inode or device changed
+        """
+        fs = self._getFS()
+        fs.refresh(recursive=True)
+        fs.sync(recursive=True)
+
+        item = fs['test.txt']
+        st = os.stat(item.abspath)
+        self.assertEqual((item._size, item._mtimeNs, item._inode, item._device),
+            (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev))
+        origFasthash = item._fasthash
+
+        # overwrite the file with the same size and mtime - sync doesn't read the file again
+        with open(item.abspath, 'wb') as fp:
+            fp.write(b"x" * st.st_size)
+        os.utime(item.abspath, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertFalse(fs.sync())
+        self.assertEqual(item._fasthash, origFasthash)
+
+        # once the mtime changes, the file is rehashed and reported as modified
+        modified = []
+        os.utime(item.abspath, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertTrue(fs.sync(onModified=modified.append))
+        self.assertEqual(modified, [ item ])
+        self.assertNotEqual(item._fasthash, origFasthash)
+        # small files use the md5 as the fasthash, which must not be the stale one
+        self.assertEqual(item._md5, item._fasthash)
+
+        # the stat fields are saved in the tree cache
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        fs.refresh(recursive=True)
+        fs.sync(recursive=True)
+        fs.save()
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(fs['test.txt']._mtimeNs, st.st_mtime_ns + 10**9)
+        modified = []
+        fs.sync(recursive=True, onModified=modified.append)
+        self.assertEqual(modified, [])
+
+
+    def test_sync_moves(self):
+        """
+        Test that sync(detectMoves=True) reports files moved between directories as moves
+        """
+        fs = self._getFS()
+        fs.refresh(recursive=True)
+        # files that disappeared can only be matched by their hash if it was calculated before
+        fs.sync(recursive=True)
+        fs.createPathIndex()
+        test2 = fs['test2.txt']
+        thing1 = fs['abc']['qwerty']['stuff']['thing1.txt']
+        j1 = fs['def']['azerty']['j1.txt']
+        j1Md5 = j1.md5()
+        path = lambda *names: os.path.join(fs.abspath, *names)
+
+        # a plain move, a move into a new directory, a directory that was moved, and a file
+        # that was copied to a new place before the original was deleted (a new inode)
+        os.rename(path("test2.txt"), path("def", "test2 moved.txt"))
+        os.mkdir(path("new"))
+        os.rename(path("def", "azerty", "j1.txt"), path("new", "j1.txt"))
+        os.rename(path("abc", "qwerty", "stuff"), path("def", "stuff"))
+        shutil.copy(path("test3.txt"), path("abc", "test3 copy.txt"))
+        os.remove(path("test3.txt"))
+        os.remove(path("some_other_test.txt"))
+        with open(path("def", "azerty", "brand new.txt"), 'w') as fp:
+            fp.write("nothing else has these contents")
+
+        added, deleted, moved = [], [], []
+        self.assertTrue(fs.sync(recursive=True, detectMoves=True, onAdded=added.append, onDeleted=deleted.append,
+            onMoved=lambda relpath, item: moved.append((relpath, item.relpath))))
+
+        self.assertEqual(sorted(moved), [
+            (os.path.join("abc", "qwerty", "stuff", "thing1.txt"), os.path.join("def", "stuff", "thing1.txt")),
+            (os.path.join("abc", "qwerty", "stuff", "thing2.txt"), os.path.join("def", "stuff", "thing2.txt")),
+            (os.path.join("def", "azerty", "j1.txt"), os.path.join("new", "j1.txt")),
+            ("test2.txt", os.path.join("def", "test2 moved.txt")),
+            ("test3.txt", os.path.join("abc", "test3 copy.txt")),
+        ])
+        self.assertEqual(sorted(item.relpath for item in added),
+            [ os.path.join("def", "azerty", "brand new.txt"), os.path.join("def", "stuff"), "new" ])
+        self.assertEqual(sorted(item.name for item in deleted), [ "some_other_test.txt", "stuff" ])
+
+        # moved files keep their objects and hashes
+        self.assertTrue(fs['def']['test2 moved.txt'] is test2)
+        self.assertTrue(fs['def']['stuff']['thing1.txt'] is thing1)
+        self.assertTrue(fs['new']['j1.txt'] is j1)
+        self.assertEqual(j1._md5, j1Md5)
+        self.assertTrue(fs.lookup("new/j1.txt") is j1)
+        self.assertEqual(fs.lookup("def/azerty/j1.txt"), None)
+        mirror = RootDirectory(fs.abspath)
+        self.assertEqual(sorted(item.relpath for item in fs.all(recursive=True)),
+            sorted(item.relpath for item in mirror.all(recursive=True)))
+        self.assertEqual((fs.size, fs.fileCount, fs.dirCount), (mirror.size, mirror.fileCount, mirror.dirCount))
+        self.assertFalse(fs.sync(recursive=True, detectMoves=True))
+
+
+    def test_asyncio(self):
+        """
+        Test the awaitable versions of refresh(), sync(), all() and the hash methods
+        """
+        serialFS = self._getFS()
+        serialFS.refresh(recursive=True)
+        serialFS.sync(recursive=True)
+        fs = self._getFS(clean=False)
+        fs.asyncWorkers = 2
+
+        async def run():
+            # the event loop keeps running while the tree is scanned
+            ticks = []
+            async def tick():
+                while True:
+                    ticks.append(1)
+                    await asyncio.sleep(0)
+            ticker = asyncio.ensure_future(tick())
+
+            await fs.arefresh(recursive=True)
+            self.assertEqual(sorted(item.relpath for item in fs.all(recursive=True)),
+                sorted(item.relpath for item in serialFS.all(recursive=True)))
+            self.assertEqual((fs.size, fs.fileCount, fs.dirCount), (serialFS.size, serialFS.fileCount, serialFS.dirCount))
+            self.assertTrue(len(ticks) > 0)
+
+            items = [ item async for item in fs.aall(recursive=True) ]
+            self.assertEqual(items, list(fs.all(recursive=True)))
+            items = [ item async for item in fs['abc'].aall(recursive=True, reverse=True, dirs=False) ]
+            self.assertEqual(items, list(fs['abc'].all(recursive=True, reverse=True, dirs=False)))
+
+            item = fs['test.txt']
+            self.assertEqual(await item.amd5(), serialFS['test.txt'].md5())
+            self.assertEqual(await item.acrc(), serialFS['test.txt'].crc())
+            self.assertEqual(await item.afasthash(), serialFS['test.txt'].fasthash())
+            self.assertEqual(await fs.ahashAll(kind="fasthash"), fs.fileCount - 1)
+            for item in fs.all(recursive=True, dirs=False):
+                self.assertEqual(item._fasthash, serialFS.lookup(item.relpath)._fasthash)
+
+            # sync reports the same changes as the blocking version
+            with open(os.path.join(fs.abspath, "abc", "new.txt"), 'w') as fp:
+                fp.write("new")
+            os.mkdir(os.path.join(fs.abspath, "def", "new dir"))
+            with open(os.path.join(fs.abspath, "def", "new dir", "new2.txt"), 'w') as fp:
+                fp.write("new 2")
+            with open(os.path.join(fs.abspath, "test.txt"), 'a') as fp:
+                fp.write("changed")
+            os.rename(os.path.join(fs.abspath, "test1.txt"), os.path.join(fs.abspath, "def", "test1.txt"))
+            os.remove(os.path.join(fs.abspath, "test2.txt"))
+            changes = []
+            self.assertTrue(await fs.asyncSync(recursive=True, detectMoves=True,
+                onAdded=lambda item: changes.append(("added", item.relpath)),
+                onDeleted=lambda item: changes.append(("deleted", item.relpath)),
+                onModified=lambda item: changes.append(("modified", item.relpath)),
+                onMoved=lambda relpath, item: changes.append(("moved", relpath, item.relpath))))
+            self.assertEqual(sorted(changes), [
+                ("added", os.path.join("abc", "new.txt")),
+                ("added", os.path.join("def", "new dir")),
+                ("added", os.path.join("def", "new dir", "new2.txt")),
+                ("deleted", "test2.txt"),
+                ("modified", "test.txt"),
+                ("moved", "test1.txt", os.path.join("def", "test1.txt")),
+            ])
+            # new files were hashed on the thread pool
+            hashed = fs['abc']['new.txt']._fasthash
+            self.assertNotEqual(hashed, None)
+            self.assertEqual(fs['abc']['new.txt'].fasthash(refresh=True), hashed)
+            self.assertFalse(await fs.asyncSync(recursive=True))
+            self.assertFalse(fs.sync(recursive=True))
+
+            # a listing that fails doesn't leave the listings that were read ahead behind
+            errors = []
+            asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+            module = sys.modules[RootDirectory.__module__]
+            origListing = module.dirlisting
+            def failingListing(path):
+                if path != fs.path:
+                    raise PermissionError(path)
+                return origListing(path)
+            module.dirlisting = failingListing
+            try:
+                with self.assertRaises(PermissionError):
+                    await RootDirectory(fs.path).arefresh(recursive=True)
+            finally:
+                module.dirlisting = origListing
+            await asyncio.sleep(0.1)
+            gc.collect()
+            self.assertEqual(errors, [])
+
+            ticker.cancel()
+
+        asyncio.run(run())
+
+
+    @unittest.skipIf(SyncedRootDirectory is None, "mediafs.synced can't be imported")
+    def test_synced_events(self):
+        """
+        Test that filesystem events keep a SyncedRootDirectory in sync, using scripted events
+        """
+        path = self._getFS().abspath
+        source = ScriptedEventSource()
+        join = os.path.join
+
+        async def run():
+            fs = SyncedRootDirectory(path, asyncio.get_running_loop(), eventSource=source)
+            fs.refresh(recursive=True)
+            self.assertTrue(source.isWatched(join(path, "abc", "qwerty")))
+            self.assertEqual(await fs.processFilesystemEvents(), [])
+
+            # writes to a new file are coalesced, and so are files that are created and deleted again
+            with open(join(path, "abc", "new.txt"), 'w') as fp:
+                fp.write("new")
+            os.rename(join(path, "test1.txt"), join(path, "def", "test1.txt"))
+            source.replay(source.create(join(path, "abc", "new.txt")) +
+                source.modify(join(path, "abc", "new.txt")) +
+                source.modify(join(path, "abc", "new.txt")) +
+                source.create(join(path, "tmp.txt")) +
+                source.delete(join(path, "tmp.txt")) +
+                source.move(join(path, "test1.txt"), join(path, "def", "test1.txt")))
+            changes = await fs.processFilesystemEvents(wait=True)
+            self.assertEqual([ (event.type, event.parent.relpath, event.name) for event in changes ], [
+                ("create", "abc", "new.txt"),
+                ("movefrom", ".", "test1.txt"),
+                ("moveto", "def", "test1.txt"),
+            ])
+            self.assertTrue("new.txt" in fs['abc'])
+            self.assertTrue("test1.txt" in fs['def'])
+            self.assertFalse("test1.txt" in fs)
+            self.assertTrue(fs.isSynced())
+
+            # a move out of the tree only has one event, and an overflow loses events, so the
+            # directories are synced again
+            outside = tempfile.mkdtemp()
+            try:
+                os.rename(join(path, "abc", "new.txt"), join(outside, "new.txt"))
+                source.replay(source.move(join(path, "abc", "new.txt"), join(outside, "new.txt")))
+                changes = await fs.processFilesystemEvents(wait=True)
+                self.assertEqual([ (event.type, event.parent.relpath, event.name) for event in changes ],
+                    [ ("delete", "abc", "new.txt") ])
+            finally:
+                shutil.rmtree(outside)
+
+            os.remove(join(path, "test2.txt"))
+            with open(join(path, "def", "azerty", "j4.txt"), 'w') as fp:
+                fp.write("j4")
+            with open(join(path, "test.txt"), 'a') as fp:
+                fp.write("changed")
+            source.replay(source.overflow())
+            changes = await fs.processFilesystemEvents(wait=True)
+            # the files that were never hashed are hashed by the sync, but only the one that
+            # changed on disk is reported as modified
+            self.assertEqual(sorted((event.type, event.parent.relpath, event.name) for event in changes), [
+                ("create", join("def", "azerty"), "j4.txt"),
+                ("delete", ".", "test2.txt"),
+                ("modify", ".", "test.txt"),
+            ])
+            self.assertTrue(fs.isSynced())
+
+        asyncio.run(run())
+
+
+    @unittest.skipIf(SyncedRootDirectory is None, "mediafs.synced can't be imported")
+    def test_synced_batches(self):
+        """
+        Test that events are passed on in batches of up to maxBatchSize events, or after maxLatency
+        """
+        path = self._getFS().abspath
+        source = ScriptedEventSource()
+        join = os.path.join
+
+        async def run():
+            fs = SyncedRootDirectory(path, asyncio.get_running_loop(), eventSource=source)
+            fs.maxBatchSize = 4
+            fs.maxLatency = 0.05
+            fs.refresh(recursive=True)
+            files = [ item.path for item in fs.all(recursive=True, dirs=False) ]
+
+            # a partial batch waits for maxLatency
+            source.replay(source.modify(files[0]) + source.modify(files[1]) + source.modify(files[2]))
+            self.assertEqual(fs._eventBatches.qsize(), 0)
+            self.assertEqual(await fs.processFilesystemEvents(), [])
+            await asyncio.sleep(0.1)
+            self.assertEqual(fs._eventBatches.qsize(), 1)
+            self.assertEqual(len(await fs.processFilesystemEvents()), 3)
+
+            # full batches are passed on right away
+            source.replay(sum((source.modify(f) for f in files[:10]), []))
+            self.assertEqual(fs._eventBatches.qsize(), 2)
+            self.assertEqual(len(fs._eventBuffer), 2)
+            self.assertEqual(len(await fs.processFilesystemEvents()), 8)
+            self.assertEqual(len(await fs.processFilesystemEvents(wait=True)), 2)
+
+            # the two events of a move stay in the same batch
+            os.rename(join(path, "test1.txt"), join(path, "abc", "test1.txt"))
+            source.replay(source.modify(files[0]) + source.modify(files[1]) + source.modify(files[2]) +
+                source.move(join(path, "test1.txt"), join(path, "abc", "test1.txt")))
+            self.assertEqual(fs._eventBatches.qsize(), 1)
+            self.assertEqual(len(fs._eventBuffer), 0)
+            changes = await fs.processFilesystemEvents()
+            self.assertEqual([ (event.type, event.parent.relpath, event.name) for event in changes[3:] ], [
+                ("movefrom", ".", "test1.txt"),
+                ("moveto", "abc", "test1.txt"),
+            ])
+            self.assertTrue(fs.isSynced())
+
+        asyncio.run(run())
+
+
+    @unittest.skipIf(SyncedRootDirectory is None, "mediafs.synced can't be imported")
+    def test_synced_modify(self):
+        """
+        Test that modify events update the size and modification time of a file and the totals
+        """
+        path = self._getFS().abspath
+        source = ScriptedEventSource()
+
+        async def run():
+            fs = SyncedRootDirectory(path, asyncio.get_running_loop(), eventSource=source)
+            fs.refresh(recursive=True)
+            f = fs['abc']['qwerty']['qwerty.txt']
+            size, dirSize, totalSize = f.size, fs['abc'].size, fs.size
+            f.md5()
+
+            with open(f.path, 'a') as fp:
+                fp.write("x" * 1000)
+            os.utime(f.path, ns=(0, 10**18))
+            source.replay(source.modify(f.path))
+            changes = await fs.processFilesystemEvents(wait=True)
+            self.assertEqual([ (event.type, event.name) for event in changes ], [ ("modify", "qwerty.txt") ])
+            self.assertEqual(f.size, size + 1000)
+            self.assertEqual(fs['abc'].size, dirSize + 1000)
+            self.assertEqual(fs.size, totalSize + 1000)
+            self.assertEqual(f.mtime(), datetime.fromtimestamp(10**9))
+            self.assertEqual(f._md5, None)
+            self.assertEqual(f.md5(), RootDirectory(path)['abc']['qwerty']['qwerty.txt'].md5())
+
+        asyncio.run(run())
+
+
+    @unittest.skipIf(SyncedRootDirectory is None, "mediafs.synced can't be imported")
+    def test_synced_watches(self):
+        """
+        Test that the least recently used watches are removed when there are more than maxWatches
+        """
+        path = self._getFS().abspath
+        source = ScriptedEventSource()
+        join = os.path.join
+
+        async def run():
+            fs = SyncedRootDirectory(path, asyncio.get_running_loop(), eventSource=ScriptedEventSource())
+            fs.maxWatches = 4
+            fs.pollInterval = 0.02
+            await fs.arefresh(recursive=True)
+            self.assertEqual(len(fs._inotifyHandles), 4)
+            self.assertEqual(len(fs._unwatched), 2)
+            # the root directory is used by everything below it, so it keeps its watch
+            self.assertTrue(fs._eventSource.isWatched(path))
+            # the directories were in sync when they lost their watches
+            await asyncio.sleep(0.1)
+            self.assertEqual(fs._outOfSync, {})
+
+            fs = SyncedRootDirectory(path, asyncio.get_running_loop(), eventSource=source)
+            fs.pollInterval = 60
+            fs.refresh(recursive=True)
+            self.assertEqual(len(fs._inotifyHandles), 6)
+
+            # lookups and walks count as using a directory
+            fs.maxWatches = 3
+            fs.lookup("abc/qwerty")
+            list(fs['def'].all())
+            fs['def']['azerty'].refresh()
+            self.assertEqual(set(fs._inotifyHandles.values()), { fs, fs['def'], fs['def']['azerty'] })
+            self.assertEqual(set(fs._unwatched), { fs['abc'], fs['abc']['qwerty'], fs['abc']['qwerty']['stuff'] })
+
+            # the events that were read before a watch is removed are still processed
+            azerty = fs['def']['azerty']
+            with open(join(azerty.path, "new.txt"), 'w') as fp:
+                fp.write("new")
+            source.replay(source.create(join(azerty.path, "new.txt")))
+            fs.lookup("abc/qwerty/stuff").refresh()
+            self.assertFalse(source.isWatched(azerty.path))
+            self.assertTrue(source.isWatched(join(path, "abc", "qwerty", "stuff")))
+            changes = await fs.processFilesystemEvents(wait=True)
+            self.assertEqual([ (event.type, event.parent, event.name) for event in changes ],
+                [ ("create", azerty, "new.txt") ])
+            self.assertEqual(fs._evictedHandles, {})
+            self.assertEqual(len(fs._inotifyHandles), 3)
+            self.assertTrue(fs.isSynced())
+
+            # the watch of a directory that is deleted is removed
+            handle = fs._watchHandles[fs['def']]
+            source.replay([ InotifyEvent(handle, IN_IGNORED, 0, "") ])
+            self.assertEqual(await fs.processFilesystemEvents(wait=True), [])
+            self.assertFalse(handle in fs._inotifyHandles)
+            self.assertFalse(fs['def'] in fs._watchHandles)
+
+        asyncio.run(run())
+
+
+    @unittest.skipIf(SyncedRootDirectory is None, "mediafs.synced can't be imported")
+    def test_synced_polling(self):
+        """
+        Test that directories without a watch are polled for changes
+        """
+        path = self._getFS().abspath
+        join = os.path.join
+
+        class FailingEventSource(ScriptedEventSource):
+            def watch(self, path):
+                if os.path.basename(path) == "azerty":
+                    raise OSError("No space left on device")
+                return super().watch(path)
+        source = FailingEventSource()
+
+        async def run():
+            fs = SyncedRootDirectory(path, asyncio.get_running_loop(), eventSource=source)
+            fs.maxWatches = 3
+            fs.pollInterval = 0.02
+            fs.refresh(recursive=True)
+            azerty = fs['def']['azerty']
+            self.assertFalse(source.isWatched(azerty.path))
+            self.assertTrue(azerty in fs._unwatched)
+            self.assertEqual(len(fs._unwatched), 3)
+
+            # directories that didn't change aren't synced again
+            await asyncio.sleep(0.1)
+            self.assertEqual(fs._outOfSync, {})
+            self.assertEqual(await fs.processFilesystemEvents(), [])
+
+            # a directory that changed is watched again (if it can be) and synced
+            evicted = [ dirobj for dirobj in fs._unwatched if dirobj is not azerty ][0]
+            for dirobj in (evicted, azerty):
+                with open(join(dirobj.path, "polled.txt"), 'w') as fp:
+                    fp.write("polled")
+                os.utime(dirobj.path, ns=(0, 10**18))
+            changes = await asyncio.wait_for(fs.processFilesystemEvents(wait=True), 5)
+            self.assertEqual(sorted((event.type, event.parent.relpath, event.name) for event in changes),
+                sorted([ ("create", evicted.relpath, "polled.txt"), ("create", azerty.relpath, "polled.txt") ]))
+            self.assertTrue(source.isWatched(evicted.path))
+            self.assertTrue(azerty in fs._unwatched)
+            self.assertEqual(len(fs._inotifyHandles), 3)
+            self.assertTrue(fs.isSynced())
+
+            await asyncio.sleep(0.1)
+            self.assertEqual(fs._outOfSync, {})
+
+        asyncio.run(run())
+
+
     def test_metadata_cache(self):
         fs = self._getFS(CachedRootDirectory)
         fs.refresh(recursive=True)
@@ -321,6 +1416,233 @@ class TestMetaFS(unittest.TestCase):
             fs['non-existant-file.asdf']
 
 
+    def test_binary_filesystem_cache(self):
+        fs = self._getFS(CachedRootDirectory)
+        fs.refresh(recursive=True)
+        fasthashValue = fs['def']['azerty']['j2.txt'].fasthash()
+        fs['test.txt'].metadata['author'] = "Some Dude"
+        fs._treeFormat = "binary"
+        fs.save()
+
+        with open(fs._treeFile, 'rb') as fp:
+            self.assertTrue(fp.read().startswith(TREE_MAGIC))
+
+        # the format is detected automatically when loading
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(fs._treeFormat, "binary")
+        self.assertEqual(len(fs), 7)
+        self.assertEqual(len(fs[...]), 16)
+        self.assertEqual(fs.order, sorted(fs.contents.keys()))
+        self.assertEqual(fs['def']['azerty']['j2.txt']._fasthash, fasthashValue)
+        self.assertEqual(fs['def']['azerty']['j2.txt'].size, 505050)
+        self.assertEqual(fs['def']['azerty']['j2.txt'].parent, fs['def']['azerty'])
+        self.assertEqual(fs['def']['azerty']['j2.txt'].root, fs)
+        self.assertEqual(fs['abc']['qwerty']['stuff']['thing1.txt'].metadata['author'], "Some Dude")
+
+        # directories that were never refreshed are still lazily refreshed
+        fs = self._getFS(CachedRootDirectory, clean=True)
+        fs._treeFormat = "binary"
+        fs.save()
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(fs._contents, None)
+        fs.refresh()
+        fs.save()
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(fs['def']._contents, None)
+        self.assertEqual(len(fs['def']['azerty']), 3)
+
+        # converting the cache back to json
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        fs._treeFormat = "json"
+        fs.save()
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(fs._treeFormat, "json")
+        self.assertEqual(len(fs['def']['azerty']), 3)
+
+        with self.assertRaises(ValueError):
+            self._getFS(lambda path: CachedRootDirectory(path, treeFormat="xml"), clean=False)
+
+
+    def test_incremental_cache(self):
+        fs = self._getFS(lambda path: CachedRootDirectory(path, treeFormat="binary"))
+        fs.refresh(recursive=True)
+        fs.save()
+        fullSize = os.path.getsize(fs._treeFile)
+
+        # saving again without any changes doesn't write anything
+        fs.save()
+        self.assertEqual(os.path.getsize(fs._treeFile), fullSize)
+
+        # hashing a file only rewrites the directories from that file up to the root
+        azerty = fs['def']['azerty']
+        azerty['j1.txt'].md5()
+        self.assertEqual(azerty._treeBlock, None)
+        self.assertEqual(fs['def']._treeBlock, None)
+        self.assertEqual(fs._treeBlock, None)
+        self.assertNotEqual(fs['abc']._treeBlock, None)
+        self.assertNotEqual(fs['abc']['qwerty']['stuff']._treeBlock, None)
+        fs.save()
+        incrementalSize = os.path.getsize(fs._treeFile) - fullSize
+        self.assertTrue(0 < incrementalSize < fullSize)
+
+        # directories that changed are saved, and the others are still loaded from their old blocks
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(fs['def']['azerty']['j1.txt']._md5, azerty['j1.txt']._md5)
+        self.assertEqual(fs['abc']['qwerty']['stuff'].order, ['thing1.txt', 'thing2.txt'])
+        self.assertEqual(len(fs[...]), 16)
+
+        # renaming a file and removing a directory
+        with open(os.path.join(fs.abspath, "abc", "new.txt"), 'w') as fp:
+            fp.write("new file")
+        fs['abc'].refresh("new.txt")
+        fs['test3.txt'].rename("test4.txt")
+        shutil.rmtree(fs['def'].abspath)
+        fs.refresh("def")
+        fs.save()
+
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertTrue("new.txt" in fs['abc'])
+        self.assertTrue("test4.txt" in fs)
+        self.assertFalse("test3.txt" in fs)
+        self.assertFalse("def" in fs)
+        self.assertEqual(len(fs[...]), 12)
+
+        # keep saving changes until the file gets compacted
+        sizes = [os.path.getsize(fs._treeFile)]
+        for i in range(20):
+            fs['abc']['qwerty']['stuff'].refresh()
+            fs.save()
+            sizes.append(os.path.getsize(fs._treeFile))
+        self.assertTrue(any(sizes[i + 1] < sizes[i] for i in range(len(sizes) - 1)))
+        self.assertTrue(max(sizes) < fs._treeFileBase * (fs.treeCompactRatio + 1))
+
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(len(fs[...]), 12)
+
+        # if the file is changed by something else, the whole tree is written out again
+        with open(fs._treeFile, 'ab') as fp:
+            fp.write(b'junk')
+        fs['abc'].refresh()
+        fs.save()
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(len(fs[...]), 12)
+
+        # an incremental save that fails is cut off again, and the next save writes everything
+        size = os.path.getsize(fs._treeFile)
+        def failingWrite(fp, contents, incremental=False):
+            fp.write(b'partial block')
+            raise OSError("No space left on device")
+        fs._writeTreeBlock = failingWrite
+        fs['abc'].refresh()
+        self.assertRaises(OSError, fs.save)
+        self.assertEqual(os.path.getsize(fs._treeFile), size)
+        del fs._writeTreeBlock
+        fs.save()
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(len(fs[...]), 12)
+
+        # a file with a damaged end is read up to the last complete save
+        with open(fs._treeFile, 'ab') as fp:
+            fp.write(bytes(37))
+        for lazyLoad in (False, True):
+            fs = self._getFS(lambda path: CachedRootDirectory(path, lazyLoad=lazyLoad), clean=False)
+            self.assertEqual(len(fs[...]), 12)
+        fs['abc'].refresh()
+        fs.save()
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(len(fs[...]), 12)
+        self.assertEqual(os.path.getsize(fs._treeFile), fs._treeFileEnd)
+
+        # without any complete save in it, the file is ignored
+        with open(fs._treeFile, 'r+b') as fp:
+            fp.truncate(40)
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(fs._contents, None)
+
+
+    def test_lazy_cache(self):
+        LazyRoot = lambda path: CachedRootDirectory(path, treeFormat="binary", lazyLoad=True)
+        fs = self._getFS(LazyRoot)
+        fs.refresh(recursive=True)
+        md5Value = fs['def']['azerty']['j3.txt'].md5()
+        fs.save()
+
+        # only the root directory is loaded at first
+        fs = self._getFS(LazyRoot, clean=False)
+        self.assertEqual(len(fs._contents), 7)
+        self.assertEqual(fs['abc']._contents, None)
+        self.assertEqual(fs['def']._contents, None)
+
+        # directories are loaded from the cache when they are accessed
+        azerty = fs['def']['azerty']
+        self.assertEqual(azerty['j3.txt']._md5, md5Value)
+        self.assertEqual(azerty['j3.txt'].parent, azerty)
+        self.assertEqual(azerty['j3.txt'].root, fs)
+        self.assertEqual(azerty.order, ['j1.txt', 'j2.txt', 'j3.txt'])
+        self.assertEqual(fs['abc']._contents, None)
+
+        # incremental saves keep the directories that were never loaded
+        azerty['j1.txt'].md5()
+        fs.save()
+        fs = self._getFS(LazyRoot, clean=False)
+        self.assertEqual(len(fs['abc']['qwerty']['stuff']), 2)
+        self.assertEqual(fs['def']['azerty']['j1.txt']._md5, azerty['j1.txt']._md5)
+
+        # directories that were never loaded are copied over when the cache is compacted
+        fs = self._getFS(LazyRoot, clean=False)
+        fs.treeCompactRatio = 1.0
+        fs['test.txt'].md5()
+        fs.save()
+        self.assertEqual(fs['abc']._contents, None)
+        self.assertEqual(len(fs['abc']['qwerty']['stuff']), 2)
+        self.assertEqual(fs['def']['azerty']['j3.txt']._md5, md5Value)
+
+        fs = self._getFS(CachedRootDirectory, clean=False)
+        self.assertEqual(len(fs[...]), 16)
+        self.assertEqual(fs['def']['azerty']['j3.txt']._md5, md5Value)
+        self.assertEqual(fs['abc']['qwerty']['stuff']['thing1.txt'].relpath,
+            os.path.join("abc", "qwerty", "stuff", "thing1.txt"))
+
+
+    def test_compact_nodes(self):
+        """
+        Test that file and directory objects don't carry a per-instance __dict__, and
+        that custom subclasses still work with the tree cache
+        """
+        fs = self._getFS()
+        self.assertFalse(hasattr(fs['test.txt'], '__dict__'))
+        self.assertFalse(hasattr(fs['abc'], '__dict__'))
+
+        class SlottedFile(File):
+            __slots__ = ('_extra',)
+            serializeFields = File.serializeFields + ('_extra',)
+
+            def __init__(self, path, parent=None):
+                File.__init__(self, path, parent)
+                self._extra = None
+
+        class PlainDirectory(Directory):
+            pass
+
+        CustomRoot = mkRootDirectoryBaseClass(FileCls=SlottedFile, DirectoryCls=PlainDirectory,
+            RootDirectoryCls=CachedRootDirectory)
+
+        fs = self._getFS(CustomRoot)
+        fs.refresh(recursive=True)
+        fs['test.txt']._extra = "extra value"
+        fs['abc'].someAttribute = 5
+        md5Value = fs['abc']['qwerty']['qwerty.txt'].md5()
+        fs.save()
+
+        fs = self._getFS(CustomRoot, clean=False)
+        self.assertTrue(isinstance(fs['test.txt'], SlottedFile))
+        self.assertTrue(isinstance(fs['abc'], PlainDirectory))
+        self.assertEqual(fs['test.txt']._extra, "extra value")
+        self.assertEqual(fs['test1.txt']._extra, None)
+        self.assertEqual(fs['abc']['qwerty']['qwerty.txt']._md5, md5Value)
+        self.assertEqual(len(fs[...]), 16)
+
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -188,8 +188,8 @@ class XAttrRootDirectory(CachedRootDirectory):
     attributes at all, and others may need to have particular mount options to work correctly.
     """
 
-    def __init__(self, path, treeFile=".tree.json"):
-        CachedRootDirectory.__init__(self, path, metadataFile=None, treeFile=treeFile)
+    def __init__(self, path, treeFile=".tree.json", treeFormat=None):
+        CachedRootDirectory.__init__(self, path, metadataFile=None, treeFile=treeFile, treeFormat=treeFormat)
 
 
     def _getMetadataForObject(self, obj):
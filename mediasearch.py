@@ -10,12 +10,15 @@ or script using MediaFS.
 For example, if you stored ID3 tag information from some MP3 files as metadata for
 a directory, you could use this script to search by metadata:
     $ mediasearch.py --query="f.get('author') == 'The Beatles'"
+
+or, without evaluating any Python code:
+    $ mediasearch.py --where='author == "The Beatles" and year < 1970'
 """
 import os
 import sys
 import argparse
 
-from mediafs import CachedRootDirectory
+from mediafs import CachedRootDirectory, QuerySyntaxError, parseQuery
 
 
 def getargs():
@@ -29,6 +32,9 @@ def getargs():
         help="Search the filesystem with a glob (eg. --filter=\"*qwerty*\")")
     searchgroup.add_argument("--search", "-s", type=str, nargs=1, dest='search',
         help="Search the filesystem with a regex (eg. --query=\"(.*)qwerty(.*)\")")
+    searchgroup.add_argument("--where", "-W", type=str, nargs=1, dest='where',
+        help="Search the filesystem with a query string (eg. --where='ext == \"mp3\" and size > 10MB') "
+        "Equivalent to fs.query(WHERE)")
 
     parser.add_argument("--refresh", "-r", action="store_true", dest="refresh",
         help="Refresh the directory tree cache")
@@ -36,9 +42,18 @@ def getargs():
     parser.add_argument("--refresh-metadata", "-m", action="store_true", dest="refreshMetadata",
         help="When refreshing the directory tree cache, also compute metadata hashes for faster subsequent searching")
 
+    parser.add_argument("--jobs", "-j", type=int, dest="jobs", default=4,
+        help="Number of files to hash at once when refreshing metadata (default 4)")
+
     parser.add_argument("--write", "-w", action="store_true", dest="write",
         help="Writes out the updated cache before exiting (speeds subsequent runs)")
 
+    parser.add_argument("--tree-format", type=str, choices=("json", "binary"), dest="treeFormat", default=None,
+        help="Format to write the directory tree cache in. Defaults to the format of the existing cache")
+
+    parser.add_argument("--name-index", "-i", action="store_true", dest="nameIndex",
+        help="Use an index of all names for --filter and --search, which is saved with the tree cache")
+
     parser.add_argument("--non-recursive", "-n", action="store_true", dest="nonrecursive",
         help="Do not search recursively")
 
@@ -58,10 +73,14 @@ def getargs():
 def main():
     args = getargs()
 
-    fs = CachedRootDirectory(os.getcwd())
+    # load the tree cache lazily, so only the directories that are searched get loaded
+    fs = CachedRootDirectory(os.getcwd(), treeFormat=args.treeFormat, lazyLoad=True, nameIndex=args.nameIndex)
 
     if args.refresh:
         if args.refreshMetadata:
+            # hash all the files up front using several threads, so looking up
+            # the metadata doesn't have to read the files one by one
+            fs.hashAll(kind="fasthash", workers=args.jobs, recursive=True)
             for item in fs.all(recursive=True):
                 item.metadata
         else:
@@ -91,6 +110,16 @@ def main():
             for f in fs.query(queryFunc, recursive=recursive, dirs=dirs, files=files):
                 exec(resultExec)
 
+    elif args.where:
+        try:
+            query = parseQuery(args.where[0])
+        except QuerySyntaxError as e:
+            print("Error parsing query: %s" % e)
+            sys.exit(2)
+
+        for f in fs.query(query, recursive=recursive, dirs=dirs, files=files):
+            exec(resultExec)
+
     elif args.filter:
         for f in fs.filter(args.filter[0], recursive=recursive, dirs=dirs, files=files):
             exec(resultExec)